@@ -1,18 +1,21 @@
 import streamlit as st
-import os
 import shutil
 import hashlib
 import asyncio
 import json
+import uuid
 from datetime import datetime
 from email_mcp_server import EmailMCPServer
 from email_ui import email_automation_page
 from rag_module import (
     create_rag_chain,
-    query_expansion,
+    create_corpus_chain,
     add_confidence_score,
-    retrieve_docs_for_queries,
-    format_docs_with_pages,
+    speculative_retrieve,
+    pack_context,
+    detect_mode,
+    answer_cache,
+    engine_registry,
 )
 
 # ---------------------------
@@ -263,9 +266,43 @@ def run_async(coro):
             new_loop.close()
 
 
+def render_stream(chunks, placeholder) -> str:
+    """스트리밍 청크를 받는 대로 placeholder에 누적 표시하고 전체 텍스트 반환"""
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        placeholder.markdown(text + " ▌")
+    return text
+
+
+@st.fragment(run_every=1.0)
+def render_ingest_progress(retriever):
+    """
+    백그라운드 인덱싱 진행률을 1초마다 갱신 (이 부분만 다시 실행됨)
+
+    백그라운드 스레드는 Streamlit 위젯을 갱신할 수 없으므로 ingest_status를 주기적으로 읽어 표시하고,
+    끝나거나 실패하면 앱 전체를 다시 실행해 완료/오류 처리(답변 캐시 사용, 실패 엔진 정리)를 적용합니다.
+    """
+    status = retriever.ingest_status
+    if status["done"] or status["error"]:
+        st.rerun()
+    total = status["total_pages"]
+    st.progress(
+        min(1.0, status["pages"] / total) if total else 0.0,
+        text=(
+            f"⏳ 문서 인덱싱 진행 중: {status['pages']}/{total} 페이지. "
+            "지금 질문하면 인덱싱된 페이지까지만 검색합니다."
+        ),
+    )
+
+
 if "current_page" not in st.session_state:
     st.session_state.current_page = "문서 챗봇"
 
+# 공유 엔진 레지스트리에서 이 세션을 구분하기 위한 id
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 if "emphasize" not in st.session_state:
     st.session_state.emphasize = True
 if "show_confidence" not in st.session_state:
@@ -328,52 +365,56 @@ if st.session_state.current_page == "문서 챗봇":
             <div class="setup-section" style="padding: 2rem;">
                 <h3 class="setup-title">📄 PDF 문서 업로드</h3>
                 <div class="setup-guide">
-                    <p><b>📚 문서를 업로드하면</b><br>AI가 내용을 학습하여 복잡한 질문에도 정확하게 답변합니다.</p>
+                    <p><b>📚 문서를 업로드하면</b><br>AI가 내용을 학습하여 복잡한 질문에도 정확하게 답변합니다.<br>여러 문서를 함께 올리면 모든 문서에서 찾아 답변합니다.</p>
                 </div>
             </div>
             """,
             unsafe_allow_html=True
         )
-        uploaded_file = st.file_uploader("", type=["pdf"], label_visibility="collapsed", key="main_uploader")
+        uploaded_files = st.file_uploader(
+            "", type=["pdf"], accept_multiple_files=True, label_visibility="collapsed", key="main_uploader"
+        )
     
-    if uploaded_file:
-        temp_path = f"temp_{uploaded_file.name}"
-        
-        # 파일 내용의 해시값 계산
-        file_hash = hashlib.md5(uploaded_file.getvalue()).hexdigest()
+    if uploaded_files:
+        # 파일별 내용 해시값 계산 (업로드마다 한 번만, 이후 rerun에서는 재사용)
+        upload_hashes = st.session_state.setdefault("upload_hashes", {})
+        upload_docs = {}  # 문서 해시 -> 업로드 파일 (같은 내용의 파일은 한 번만)
+        for f in uploaded_files:
+            upload_key = getattr(f, "file_id", None) or (f.name, f.size)
+            if upload_key not in upload_hashes:
+                upload_hashes[upload_key] = hashlib.md5(f.getbuffer()).hexdigest()
+            upload_docs.setdefault(upload_hashes[upload_key], f)
+        shard_hashes = list(upload_docs)
+        # 문서가 여러 개면 문서 해시 조합으로 코퍼스 키를 만듦 (업로드 순서와 무관)
+        if len(shard_hashes) == 1:
+            file_hash = shard_hashes[0]
+        else:
+            file_hash = "corpus_" + hashlib.md5("".join(sorted(shard_hashes)).encode()).hexdigest()
+        file_names = ", ".join(f.name for f in upload_docs.values())
         
         # 이전 파일과 현재 파일이 다른지 확인
         file_changed = False
         if "current_file_hash" not in st.session_state:
             st.session_state.current_file_hash = None
             st.session_state.current_file_name = None
+            st.session_state.current_engine_keys = []
         
         # 파일이 변경되었는지 확인 (해시값으로 정확히 감지)
         if st.session_state.current_file_hash != file_hash:
             file_changed = True
+            # 이전 문서(코퍼스와 문서별 샤드) 엔진 사용 해제 (다른 세션이 쓰지 않으면 레지스트리가 정리)
+            for engine_key in st.session_state.current_engine_keys:
+                engine_registry.release(engine_key, st.session_state.session_id)
             st.session_state.current_file_hash = file_hash
-            st.session_state.current_file_name = uploaded_file.name
+            st.session_state.current_file_name = file_names
+            st.session_state.current_engine_keys = list(dict.fromkeys([file_hash, *shard_hashes]))
             
-            # 이전 rag_chain과 messages 삭제
-            if "rag_chain" in st.session_state:
-                del st.session_state.rag_chain
+            # 이전 messages 삭제
             st.session_state.messages = []
-            
-            # 이전 임시 파일 정리
-            import glob
-            for old_file in glob.glob("temp_*"):
-                try:
-                    os.remove(old_file)
-                except:
-                    pass
-        
-        # 임시 파일 저장
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
 
         # 파일 업로드 상단에 시스템 설정 배치
         st.markdown("## 📚 업로드된 문서")
-        st.success(f"✅ 연결됨: {uploaded_file.name}")
+        st.success(f"✅ 연결됨: {file_names}")
         
         # 파일 업로드 경고
         st.warning("⚠️ **새 문서 업로드 시 주의사항**\n\n새로운 문서를 업로드하면:\n• 이전 대화 기록이 삭제됩니다\n• 이전 문서 기반 답변은 불가능합니다")
@@ -400,21 +441,70 @@ if st.session_state.current_page == "문서 챗봇":
         
         st.markdown("---")
 
-        # RAG Chain 생성 (새 파일이거나 rag_chain이 없을 때)
-        if "rag_chain" not in st.session_state:
+        # RAG 엔진 조회 (같은 문서를 연 다른 세션이 이미 만들었으면 그대로 공유)
+        # 문서별 엔진(샤드)도 매번 조회해 코퍼스가 사용하는 동안 해제되지 않도록 함
+        session_id = st.session_state.session_id
+        shard_engines = [engine_registry.get(h, session_id) for h in shard_hashes]
+        engine = shard_engines[0] if len(shard_hashes) == 1 else engine_registry.get(file_hash, session_id)
+        if engine is None:
             with st.status("🚀 AI가 지식 베이스를 생성하고 있습니다...", expanded=True) as status:
-                rag_chain, retriever = create_rag_chain(temp_path)
-                st.session_state.rag_chain = rag_chain
-                st.session_state.retriever = retriever
+                progress_bar = st.progress(0.0, text="문서 분석 중...")
+
+                for i, h in enumerate(shard_hashes):
+                    if shard_engines[i] is not None:
+                        continue
+                    f = upload_docs[h]
+                    name_prefix = f"{f.name} " if len(shard_hashes) > 1 else ""
+
+                    def on_embed_progress(done, total, name_prefix=name_prefix):
+                        ratio = min(1.0, done / total) if total else 1.0
+                        progress_bar.progress(ratio, text=f"문서 인덱싱 중... ({name_prefix}{done}/{total} 페이지)")
+
+                    shard_engines[i] = engine_registry.acquire(
+                        h,
+                        session_id,
+                        # 업로드 내용을 임시 파일 없이 메모리에서 바로 처리 (문서별로 따로 캐시)
+                        lambda f=f, h=h, callback=on_embed_progress: create_rag_chain(
+                            pdf_bytes=f.getvalue(),
+                            source_name=f.name,
+                            doc_hash=h,
+                            progress_callback=callback,
+                        ),
+                    )
+
+                if len(shard_hashes) == 1:
+                    engine = shard_engines[0]
+                else:
+                    # 문서별 인덱스를 묶어 모든 문서를 동시에 검색하는 코퍼스
+                    engine = engine_registry.acquire(
+                        file_hash,
+                        session_id,
+                        lambda: create_corpus_chain([e.retriever for e in shard_engines]),
+                    )
                 status.update(label="준비 완료! 질문을 입력하세요.", state="complete", expanded=False)
             
             # 새 파일 로드 시 알림
             if file_changed and st.session_state.current_file_name:
-                st.info(f"✅ '{uploaded_file.name}' 파일을 기반으로 업데이트되었습니다. 이전 대화 기록은 초기화됩니다.")
+                st.info(f"✅ '{file_names}' 파일을 기반으로 업데이트되었습니다. 이전 대화 기록은 초기화됩니다.")
 
         if "messages" not in st.session_state:
             st.session_state.messages = []
 
+        # 나머지 페이지가 백그라운드에서 인덱싱 중이면 진행 상황 안내
+        ingest_status = engine.retriever.ingest_status
+        if ingest_status["error"]:
+            # 인덱싱 실패: 일부만 인덱싱된 엔진을 레지스트리에서 빼서 다음 요청 때 다시 생성
+            for engine_key, e in [(file_hash, engine), *zip(shard_hashes, shard_engines)]:
+                if e is not None and e.retriever.ingest_status["error"]:
+                    engine_registry.discard(engine_key)
+            st.error(
+                f"⚠️ 문서 인덱싱 중 오류가 발생했습니다: {ingest_status['error']}\n\n"
+                f"지금은 인덱싱된 {ingest_status['pages']}/{ingest_status['total_pages']} 페이지까지만 검색하며, "
+                "다음 요청 때 인덱싱을 다시 시작합니다."
+            )
+        elif not ingest_status["done"]:
+            render_ingest_progress(engine.retriever)
+
         st.subheader("💬 무엇이든 물어보세요")
         
         # Message Display
@@ -429,44 +519,59 @@ if st.session_state.current_page == "문서 챗봇":
                 st.markdown(prompt)
 
             with st.chat_message("assistant"):
-                with st.spinner("답변 생성 중..."):
+                placeholder = st.empty()
+                cache_variant = "expanded" if st.session_state.enable_query_expansion else "default"
+                # 인덱싱 중이거나 실패한 경우 일부 페이지 기준 답변이므로 캐시를 사용하지 않음
+                index_complete = engine.retriever.ingest_status["done"] and not engine.retriever.ingest_status["error"]
+                cached = (
+                    answer_cache.get(st.session_state.current_file_hash, prompt, variant=cache_variant)
+                    if index_complete else None
+                )
+
+                if cached:
+                    # 같은 문서에 대한 같은(또는 같은 뜻의) 질문은 이전 답변 재사용
+                    response, cache_tier = cached
+                else:
+                    cache_tier = None
                     # 쿼리 확장 옵션
                     if st.session_state.enable_query_expansion:
                         with st.spinner("다양한 관점에서 검색 중..."):
-                            expanded_queries = query_expansion(prompt)
+                            # 원본 질문 검색과 쿼리 확장을 동시에 진행
                             docs = run_async(
-                                retrieve_docs_for_queries(
-                                    st.session_state.retriever,
-                                    expanded_queries,
-                                )
-                            )
-                            combined_context = format_docs_with_pages(docs)
-                            response = st.session_state.rag_chain.invoke(
-                                {"question": prompt, "context": combined_context}
+                                speculative_retrieve(engine.retriever, prompt)
                             )
+                            # 여러 쿼리 결과를 토큰 예산 안에서 관련도 순으로 묶음
+                            combined_context, _ = pack_context(docs)
+                        chain_input = {"question": prompt, "context": combined_context}
                     else:
-                        response = st.session_state.rag_chain.invoke(prompt)
-                    
-                    # 신뢰도 표시 추가
-                    if st.session_state.show_confidence:
-                        # 간단한 신뢰도 평가: 컨텍스트 길이 기반
-                        context_length = len(response)
-                        context_quality = min(1.0, context_length / 1500)  # 1500자 이상이면 높은 신뢰도
-                        response_with_confidence = add_confidence_score(response, context_quality)
-                        full_response = f"**[문서 기반 답변]**\n\n{response_with_confidence}" if st.session_state.emphasize else response_with_confidence
+                        chain_input = prompt
+
+                    # 답변은 생성되는 대로 표시하고, 장식(신뢰도/강조)은 완료 후 적용
+                    if detect_mode(prompt) == "pagewise":
+                        placeholder.markdown("⏳ 페이지별 요약 중...")
                     else:
-                        full_response = f"**[문서 기반 답변]**\n\n{response}" if st.session_state.emphasize else str(response)
-                    
-                    st.markdown(full_response)
+                        placeholder.markdown("⏳ 답변 생성 중...")
+                    response = render_stream(engine.rag_chain.stream(chain_input), placeholder)
+                    if index_complete:
+                        answer_cache.put(st.session_state.current_file_hash, prompt, response, variant=cache_variant)
+
+                # 신뢰도 표시 추가
+                if st.session_state.show_confidence:
+                    # 간단한 신뢰도 평가: 컨텍스트 길이 기반
+                    context_length = len(response)
+                    context_quality = min(1.0, context_length / 1500)  # 1500자 이상이면 높은 신뢰도
+                    response_with_confidence = add_confidence_score(response, context_quality)
+                    full_response = f"**[문서 기반 답변]**\n\n{response_with_confidence}" if st.session_state.emphasize else response_with_confidence
+                else:
+                    full_response = f"**[문서 기반 답변]**\n\n{response}" if st.session_state.emphasize else str(response)
+
+                if cache_tier:
+                    cache_label = "같은 질문" if cache_tier == "exact" else "비슷한 질문"
+                    full_response = f"⚡ *캐시된 답변 ({cache_label}의 이전 답변을 재사용했습니다)*\n\n{full_response}"
+
+                placeholder.markdown(full_response)
             
             st.session_state.messages.append({"role": "assistant", "content": full_response})
-        
-        # 정리: 임시 파일 삭제 (옵션)
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
 
     else:
         # Landing Page
@@ -0,0 +1,46 @@
+"""
+PDF 페이지 텍스트 추출 작업 프로세스용 모듈
+
+rag_module.iter_pdf_pages의 프로세스 풀(spawn)이 사용합니다.
+작업 함수를 rag_module이 아닌 이 모듈에 두어, 작업 프로세스가 pymupdf 외의 의존성
+(langchain, faiss 등)을 다시 임포트하지 않도록 합니다.
+"""
+
+import os
+
+import pymupdf
+
+
+# 작업 프로세스가 마지막으로 연 PDF (같은 문서의 다음 작업에서 재사용)
+_worker_pdf_key = None
+_worker_pdf = None
+
+
+def _open_pdf(pdf_path: str):
+    """PDF를 메모리로 읽어 열고 캐시 (파일 핸들을 붙잡지 않아 호출 측이 바로 삭제 가능)"""
+    global _worker_pdf_key, _worker_pdf
+    stat = os.stat(pdf_path)
+    key = (pdf_path, stat.st_mtime_ns, stat.st_size)  # 같은 경로의 파일이 바뀐 경우 다시 엶
+    if _worker_pdf_key != key:
+        if _worker_pdf is not None:
+            _worker_pdf.close()
+        with open(pdf_path, "rb") as f:
+            _worker_pdf = pymupdf.open(stream=f.read(), filetype="pdf")
+        _worker_pdf_key = key
+    return _worker_pdf
+
+
+def extract_page_texts(pdf_path: str, start: int, end: int) -> list[str]:
+    """
+    [start, end) 페이지의 텍스트 추출 (프로세스 풀 작업)
+
+    Args:
+        pdf_path: PDF 파일 경로
+        start: 시작 페이지 (0부터)
+        end: 끝 페이지 (포함하지 않음)
+
+    Returns:
+        페이지 순서의 텍스트 리스트
+    """
+    doc = _open_pdf(pdf_path)
+    return [doc[i].get_text().strip() for i in range(start, end)]
@@ -1,23 +1,45 @@
 import os
 import asyncio
 import re
-from hashlib import md5
+import json
+import logging
+import multiprocessing
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import md5, sha256
+import faiss
+import numpy as np
 from dotenv import load_dotenv
-from rank_bm25 import BM25Okapi
 from langchain_core.documents import Document
+from langchain_core.documents.base import Blob
+from langchain_core.embeddings import Embeddings
 
 from langchain_community.document_loaders import PyMuPDFLoader
+from langchain_community.document_loaders.parsers import PyMuPDFParser
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
 
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableBranch
 from langchain_core.output_parsers import StrOutputParser
 
+import pdf_worker
+
 # .env 파일에 저장된 API 키 로드
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # =========================
 # 파라미터 조정 (파일 내부 수정 방식)
 # =========================
@@ -27,20 +49,132 @@ CHUNK_OVERLAP = 200  # 청크를 자를 때 겹치는 부분 (문맥 단절 최
 RETRIEVER_K = 10  # 최종적으로 LLM에 넣을 청크 개수 (더 풍부한 근거)
 RETRIEVER_FETCH_K = 60  # 후보로 더 많이 뽑아놓고 그중에서 다양하게 고르는 폭
 RETRIEVER_LAMBDA = 0.6  # 유사도 vs 다양성 균형 조정 (더 높은 유사도 비중)
+CONTEXT_TOKEN_BUDGET = 4000  # LLM에 넣을 컨텍스트 최대 토큰 수 (관련도 순으로 채움)
 
 # 하이브리드 검색 가중치
 VECTOR_WEIGHT = 0.7  # 벡터 기반 검색 가중치
 BM25_WEIGHT = 0.3    # BM25 기반 검색 가중치
+FUSION_MODE = "minmax"  # 점수 결합 방식: "minmax" / "zscore" / "rrf"
+RRF_K = 60  # RRF(Reciprocal Rank Fusion) 순위 완화 상수
 
 # BM25 파라미터
 BM25_SCORE_THRESHOLD = 0.5  # BM25 점수 임계값 (0 이상만 반환)
+BM25_K1 = 1.5  # 단어 빈도 포화 정도 (rank_bm25 BM25Okapi 기본값과 동일)
+BM25_B = 0.75  # 문서 길이 정규화 강도
+BM25_EPSILON = 0.25  # 음수 IDF 대체 비율 (평균 IDF × epsilon)
+BM25_ENGINE = "sparse"  # "sparse": 전체 점수 벡터화 계산 / "inverted": 역색인 조기 종료 (대규모 코퍼스용)
 
 MODEL_NAME = "gpt-4o"
 TEMPERATURE = 0.1  # 약간의 창의성으로 자연스러운 한국어 표현
+
+# 쿼리 확장
+EXPANSION_MODEL_NAME = MODEL_NAME  # 더 빠르고 저렴한 모델(예: "gpt-4o-mini")로 바꿔도 됨
+EXPANSION_TEMPERATURE = 0.7  # 다양한 표현을 얻기 위해 높게 설정
+EXPANSION_CACHE_MAX_ENTRIES = 1024  # 질문별 확장 결과 최대 저장 수 (LRU)
+EXPANSION_CACHE_TTL = 24 * 60 * 60  # 확장 결과 유효 시간(초)
+EXPANSION_DEADLINE = 5.0  # 확장 쿼리 결과를 기다리는 최대 시간(초), 넘으면 원본 검색 결과만 사용
+
+# 재정렬(Rerank) 방식
+RERANKER_MODE = "local"  # "local": 임베딩/키워드 기반 즉시 재정렬 / "llm": LLM 호출 재정렬
+LOCAL_RERANK_WEIGHTS = (0.5, 0.2, 0.3)  # 로컬 재정렬 가중치 (코사인 유사도, 키워드 겹침, 결합 점수)
+RERANK_GATING = True  # 검색 결과가 확실하면 재정렬 생략
+RERANK_SKIP_MARGIN = 0.3  # (1위 - 2위) 점수 차가 전체 점수 폭에서 차지하는 비율이 이 이상이면 생략
+
+EMBEDDING_MODEL = "text-embedding-ada-002"  # OpenAIEmbeddings 기본 모델
+
+# 인덱스 캐시 (문서 해시 기반 재사용)
+INDEX_CACHE_DIR = os.path.join(".rag_cache", "indexes")  # FAISS/청크/BM25 저장 위치
+INDEX_STORE_VERSION = 7  # 저장 포맷이 바뀌면 증가 (이전 캐시 자동 무효화)
+
+# 벡터 인덱스 종류 (큰 문서는 전수 비교 flat 대신 근사 인덱스 사용)
+FAISS_INDEX_TYPE = "auto"  # "auto"(벡터 수로 선택) / "flat" / "hnsw" / "ivf_flat" / "ivf_pq"
+FAISS_HNSW_MIN_VECTORS = 50_000  # auto: 이 벡터 수 이상이면 HNSW (미만은 정확한 flat)
+FAISS_IVF_MIN_VECTORS = 500_000  # auto: 이 벡터 수 이상이면 IVF-Flat (HNSW 그래프 생성 시간/메모리 절약)
+FAISS_PQ_MIN_VECTORS = 2_000_000  # auto: 이 벡터 수 이상이면 IVF-PQ (벡터 압축으로 메모리 절약)
+FAISS_TRAIN_SAMPLE = 100_000  # IVF/PQ 학습에 사용할 최대 샘플 벡터 수
+FAISS_NPROBE = 16  # IVF 검색 시 탐색할 클러스터 수 (클수록 정확하고 느림)
+FAISS_HNSW_M = 32  # HNSW 노드당 연결 수
+FAISS_HNSW_EF_CONSTRUCTION = 80  # HNSW 생성 시 탐색 폭
+FAISS_HNSW_EF_SEARCH = 128  # HNSW 검색 시 탐색 폭 (RETRIEVER_FETCH_K 이상 권장)
+FAISS_PQ_M = 64  # PQ 부분 벡터 수 = 벡터 1개당 바이트 수 (차원의 약수로 자동 조정)
+
+# 임베딩 캐시 (청크 텍스트 + 모델 해시 기반, 문서/세션 간 공유)
+EMBEDDING_CACHE_PATH = os.path.join(".rag_cache", "embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = 200_000  # 초과 시 오래 사용되지 않은 항목부터 삭제 (LRU)
+
+# 인덱싱 시 청크 임베딩 병렬 처리
+EMBED_BATCH_TOKENS = 8000  # 요청 1건에 담을 최대 토큰 수
+EMBED_MAX_IN_FLIGHT = 4  # 동시에 보낼 최대 요청 수
+EMBED_TOKENS_PER_MINUTE = 1_000_000  # 분당 토큰 한도 (토큰 버킷 속도 제한)
+EMBED_MAX_RETRIES = 3  # 실패한 배치 재시도 횟수
+
+# PDF 페이지 추출 병렬 처리 (대용량 문서)
+PDF_PARALLEL_MIN_PAGES = 300  # 이 페이지 수 이상일 때만 프로세스 풀 사용 (벤치마크: 페이지당 약 1.1ms, 풀 재사용 시 100페이지 오버헤드 약 0.02s)
+PDF_EXTRACT_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))  # 추출 프로세스 수 (UI 프로세스용 코어 1개 남김)
+PDF_PAGES_PER_TASK = 16  # 작업 1건이 맡을 연속 페이지 수
+
+# 증분 인덱싱 (페이지 배치 단위로 분할 → 임베딩 → FAISS/BM25 추가)
+INGEST_BATCH_PAGES = 16  # 배치 1개의 페이지 수 (작을수록 첫 검색 가능 시점이 빠름)
+INGEST_IN_BACKGROUND = True  # 첫 배치 이후 나머지 페이지를 백그라운드 스레드에서 인덱싱
+
+# 프로세스 공유 엔진 (같은 문서를 연 세션들이 인덱스 하나를 함께 사용)
+ENGINE_MEMORY_BUDGET_MB = 1024  # 엔진 전체 메모리 예산, 넘으면 사용 중이 아닌 엔진부터 해제
+ENGINE_IDLE_TTL = 30 * 60  # 사용하는 세션이 없는 엔진을 유지하는 시간(초)
+ENGINE_SESSION_TTL = 60 * 60  # 활동 없는 세션을 사용 중에서 제외하는 시간(초)
+
+# 여러 문서 코퍼스 (문서별 샤드를 동시에 검색한 뒤 전체 상위 k개로 결합)
+CORPUS_MAX_WORKERS = 4  # 샤드 검색을 동시에 실행할 최대 스레드 수
+
+# 페이지별 요약 병렬 처리
+PAGE_SUMMARY_MAX_CONCURRENCY = 6  # 동시에 보낼 최대 요약 요청 수
+PAGE_SUMMARY_REQUESTS_PER_MINUTE = 300  # 분당 요약 요청 한도
+PAGE_SUMMARY_MAX_RETRIES = 2  # 실패한 요약 요청 재시도 횟수
+PAGE_PACK_TOKEN_BUDGET = 1500  # 짧은 페이지를 한 요청으로 묶을 때의 최대 토큰 수
+PAGE_PACK_MAX_PAGES = 4  # 한 요청에 묶을 최대 페이지 수
+
+# 페이지 요약 캐시 (페이지 본문 해시 + 프롬프트 버전 + 모델 기반)
+PAGE_SUMMARY_CACHE_PATH = os.path.join(".rag_cache", "page_summaries.sqlite3")
+PAGE_SUMMARY_CACHE_MAX_ENTRIES = 50_000  # 초과 시 오래 사용되지 않은 항목부터 삭제 (LRU)
+PAGE_SUMMARY_PROMPT_VERSION = 1  # 요약 프롬프트를 수정하면 증가 (이전 요약 자동 무효화)
+
+# 답변 캐시 (문서 해시 + 질문, 정확 일치 → 의미 유사도 순으로 조회)
+ANSWER_CACHE_MAX_ENTRIES = 512  # 최대 저장 답변 수 (LRU)
+ANSWER_CACHE_TTL = 24 * 60 * 60  # 답변 유효 시간(초)
+ANSWER_CACHE_SIMILARITY = 0.97  # 같은 질문으로 볼 최소 코사인 유사도 (숫자/고유명사가 같을 때만 적용)
 # =========================
 
 
+def doc_key(doc: Document):
+    """문서 식별 키 (인덱싱 시 기록한 문서 해시 metadata["doc_id"], 없으면 출처)"""
+    return doc.metadata.get("doc_id") or doc.metadata.get("source")
+
+
+def source_label(doc: Document) -> str:
+    """출처 표기용 문서 이름 (metadata["source"]의 파일 이름)"""
+    source = doc.metadata.get("source")
+    return os.path.basename(str(source)) if source else "?"
+
+
+def source_labels(docs_list) -> dict:
+    """
+    문서 키 -> 출처 표기 이름 (문서 순서 유지)
+
+    파일 이름이 같은 서로 다른 문서는 문서 해시 앞자리를 붙여 구분합니다.
+    """
+    names = {}
+    for d in docs_list:
+        names.setdefault(doc_key(d), source_label(d))
+    counts = Counter(names.values())
+    return {
+        key: f"{name} ({str(key)[:6]})" if counts[name] > 1 else name
+        for key, name in names.items()
+    }
+
+
 def format_docs_with_pages(docs_list):
+    # 여러 문서의 청크가 섞여 있으면 페이지 앞에 문서 이름을 함께 표기
+    labels = source_labels(docs_list)
+    show_source = len(labels) > 1
     blocks = []
     for d in docs_list:
         page = d.metadata.get("page", None)
@@ -49,10 +183,565 @@ def format_docs_with_pages(docs_list):
         text = (d.page_content or "").strip()
         if not text:
             continue
-        blocks.append(f"[p.{page_str}]\n{text}")
+        label = f"{labels[doc_key(d)]} p.{page_str}" if show_source else f"p.{page_str}"
+        blocks.append(f"[{label}]\n{text}")
     return "\n\n---\n\n".join(blocks)
 
 
+# =========================
+# 컨텍스트 패킹 (토큰 예산 기반)
+# =========================
+def _overlap_length(left: str, right: str, max_overlap: int) -> int:
+    """left의 끝과 right의 시작이 겹치는 최대 글자 수"""
+    limit = min(len(left), len(right), max_overlap)
+    for n in range(limit, 0, -1):
+        if left.endswith(right[:n]):
+            return n
+    return 0
+
+
+def _merge_key(doc: Document):
+    """인접 청크 병합 가능 여부 판단용 (문서 키, 페이지, 청크 id), 청크 id가 없으면 None"""
+    chunk_id = doc.metadata.get("chunk_id")
+    if not isinstance(chunk_id, int):
+        return None
+    return doc_key(doc), doc.metadata.get("page"), chunk_id
+
+
+def pack_context(
+    docs_list: list[Document],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+    max_overlap: int = CHUNK_OVERLAP * 2,
+) -> tuple[str, dict]:
+    """
+    관련도 순 청크를 토큰 예산 안에서 골라 컨텍스트 문자열로 묶음
+
+    앞(관련도 높은) 청크부터 예산에 들어가는 만큼 채우고, 같은 페이지의 연속 청크
+    (chunk_id가 1 차이)는 겹치는 부분(CHUNK_OVERLAP)을 한 번만 남기고 하나의 블록으로 합칩니다.
+    합쳐진 블록은 그 안에서 가장 관련도 높은 청크의 위치에 놓입니다.
+
+    Args:
+        docs_list: 관련도 순으로 정렬된 Document 리스트
+        token_budget: 컨텍스트 최대 토큰 수
+        max_overlap: 인접 청크 겹침을 찾을 최대 글자 수
+
+    Returns:
+        (format_docs_with_pages 형식의 컨텍스트, 통계 dict)
+        통계: 입력/선택/제외 청크 수, 블록 수, 원본/패킹 토큰 수, 절약 토큰 수
+    """
+    chunks = []
+    for d in docs_list:
+        text = (d.page_content or "").strip()
+        if text:
+            chunks.append((d, text, count_tokens(text)))
+
+    # 선택된 청크: merge_key -> 텍스트 (이웃과의 겹침 계산용)
+    selected_keys = {}
+    selected = []  # (관련도 순위, Document, 텍스트)
+    used_tokens = 0
+    for rank, (d, text, tokens) in enumerate(chunks):
+        key = _merge_key(d)
+        cost_text = text
+        if key is not None:
+            # 이미 선택된 앞/뒤 이웃과 겹치는 부분은 비용에서 제외
+            prev_text = selected_keys.get((key[0], key[1], key[2] - 1))
+            next_text = selected_keys.get((key[0], key[1], key[2] + 1))
+            start = _overlap_length(prev_text, cost_text, max_overlap) if prev_text else 0
+            cost_text = cost_text[start:]
+            end = _overlap_length(cost_text, next_text, max_overlap) if next_text else 0
+            cost_text = cost_text[:len(cost_text) - end]
+        cost = count_tokens(cost_text) if cost_text != text else tokens
+        if used_tokens + cost > token_budget:
+            continue
+        used_tokens += cost
+        if key is not None:
+            selected_keys[key] = text
+        selected.append((rank, d, text))
+
+    # 같은 페이지의 연속 청크를 하나의 블록으로 병합
+    blocks = []  # [대표 순위, Document, 텍스트, 마지막 merge_key]
+    mergeable = sorted(
+        (item for item in selected if _merge_key(item[1]) is not None),
+        key=lambda item: _merge_key(item[1]),
+    )
+    for rank, d, text in mergeable:
+        key = _merge_key(d)
+        last = blocks[-1] if blocks else None
+        if last is not None and last[3][:2] == key[:2] and last[3][2] + 1 == key[2]:
+            n = _overlap_length(last[2], text, max_overlap)
+            last[2] = last[2] + (text[n:] if n else "\n" + text)
+            last[0] = min(last[0], rank)
+            last[3] = key
+        else:
+            blocks.append([rank, d, text, key])
+    blocks.extend([rank, d, text, None] for rank, d, text in selected if _merge_key(d) is None)
+    blocks.sort(key=lambda b: b[0])
+
+    packed_docs = [Document(page_content=text, metadata=d.metadata) for _, d, text, _ in blocks]
+    context = format_docs_with_pages(packed_docs)
+
+    raw_tokens = sum(tokens for _, _, tokens in chunks)
+    packed_tokens = count_tokens(context) if context else 0
+    stats = {
+        "input_chunks": len(chunks),
+        "selected_chunks": len(selected),
+        "dropped_chunks": len(chunks) - len(selected),
+        "blocks": len(blocks),
+        "raw_tokens": raw_tokens,
+        "packed_tokens": packed_tokens,
+        "saved_tokens": max(0, raw_tokens - packed_tokens),
+    }
+    logger.info(
+        "packed context: %d/%d chunks into %d blocks, %d -> %d tokens",
+        stats["selected_chunks"], stats["input_chunks"], stats["blocks"], raw_tokens, packed_tokens,
+    )
+    return context, stats
+
+
+# =========================
+# BM25 인덱스 (희소 행렬 기반)
+# =========================
+class _MappedVocab:
+    """
+    메모리 맵 파일 위의 읽기 전용 용어 사전
+
+    용어를 UTF-8 바이트 순으로 정렬해 하나의 바이트 배열과 오프셋 배열로 저장하고
+    이진 탐색으로 조회합니다. 파이썬 dict를 만들지 않으므로 여러 프로세스가
+    같은 파일 페이지를 공유합니다.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, term_ids: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+        self.term_ids = term_ids
+
+    def __len__(self) -> int:
+        return len(self.term_ids)
+
+    def _term_at(self, pos: int) -> bytes:
+        return self.blob[self.offsets[pos]:self.offsets[pos + 1]].tobytes()
+
+    def get(self, term: str, default=None):
+        key = term.encode()
+        lo, hi = 0, len(self.term_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.term_ids) and self._term_at(lo) == key:
+            return int(self.term_ids[lo])
+        return default
+
+    def to_dict(self) -> dict[str, int]:
+        return {self._term_at(i).decode(): int(self.term_ids[i]) for i in range(len(self.term_ids))}
+
+
+class BM25Index:
+    """
+    CSR 형태의 용어-문서 행렬로 구현한 벡터화 BM25 (Okapi)
+
+    용어별 행(indptr)에 문서 id와 단어 빈도(tf)를 저장하고, IDF와 문서 길이 정규화 값은
+    미리 계산해 둡니다. 쿼리 시에는 쿼리 용어의 행만 모아 한 번의 bincount로 점수를 합산하므로
+    문서 수만큼 파이썬 루프를 돌지 않습니다. 점수는 rank_bm25의 BM25Okapi와 동일합니다.
+
+    같은 행 구조는 그대로 역색인(용어 → 포스팅 리스트)이기도 하므로, 용어별 최대 기여도를
+    함께 저장해 조기 종료 방식의 top-k 검색(top_k_pruned)도 지원합니다.
+    """
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B, epsilon: float = BM25_EPSILON):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocab: dict[str, int] = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.int32)
+        self.tfs = np.zeros(0, dtype=np.int32)
+        self.doc_len = np.zeros(0, dtype=np.int32)
+        self.idf = np.zeros(0, dtype=np.float64)
+        self.norm = np.zeros(0, dtype=np.float64)
+        self.max_impact = np.zeros(0, dtype=np.float64)
+
+    @classmethod
+    def from_corpus(cls, corpus, **params) -> "BM25Index":
+        """
+        토큰화된 코퍼스로부터 인덱스 생성
+
+        Args:
+            corpus: 문서별 토큰 리스트의 iterable
+            **params: k1, b, epsilon
+
+        Returns:
+            BM25Index 인스턴스
+        """
+        index = cls(**params)
+        term_ids, doc_ids, tfs, doc_len = [], [], [], []
+        for doc_id, tokens in enumerate(corpus):
+            doc_len.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_ids.append(index.vocab.setdefault(term, len(index.vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+        index._set_postings(
+            np.asarray(term_ids, dtype=np.int64),
+            np.asarray(doc_ids, dtype=np.int32),
+            np.asarray(tfs, dtype=np.int32),
+            np.asarray(doc_len, dtype=np.int32),
+        )
+        return index
+
+    def _set_postings(self, term_ids: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray, doc_len: np.ndarray) -> None:
+        """(용어 id, 문서 id, tf) 포스팅을 용어별 행(CSR)으로 정렬해 저장하고 통계 계산"""
+        # 안정 정렬이므로 문서 id 오름차순으로 들어온 포스팅은 같은 용어 안에서도 그 순서 유지
+        order = np.argsort(term_ids, kind="stable")
+        counts = np.bincount(term_ids, minlength=len(self.vocab))
+        self.indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.doc_ids = doc_ids[order]
+        self.tfs = tfs[order]
+        self.doc_len = doc_len
+        self._compute_stats()
+
+    def _term_of_postings(self) -> np.ndarray:
+        """포스팅별 용어 id (CSR 행 번호 복원)"""
+        return np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+
+    def merged(self, other: "BM25Index") -> "BM25Index":
+        """
+        기존 문서 뒤에 다른 인덱스의 문서를 이어 붙인 새 인덱스 반환 (다시 토큰화하지 않음)
+
+        기존 객체는 바꾸지 않으므로, 다른 스레드의 검색은 새 인덱스로 교체되기 전까지
+        이전 인덱스를 그대로 사용합니다. other의 문서 id는 기존 문서 수만큼 밀려 이어집니다.
+
+        Args:
+            other: 같은 k1/b/epsilon으로 만든 BM25Index
+
+        Returns:
+            BM25Index 인스턴스
+        """
+        index = type(self)(k1=self.k1, b=self.b, epsilon=self.epsilon)
+        index.vocab = self.vocab.to_dict() if isinstance(self.vocab, _MappedVocab) else dict(self.vocab)
+        other_vocab = other.vocab.to_dict() if isinstance(other.vocab, _MappedVocab) else other.vocab
+        # other의 용어 id → 합친 사전의 용어 id
+        remap = np.zeros(len(other_vocab), dtype=np.int64)
+        for term, term_id in other_vocab.items():
+            remap[term_id] = index.vocab.setdefault(term, len(index.vocab))
+
+        # 기존 문서 id < other 문서 id 이므로 이어 붙인 뒤 안정 정렬하면 용어별 문서 id 순서 유지
+        index._set_postings(
+            np.concatenate((self._term_of_postings(), remap[other._term_of_postings()])),
+            np.concatenate((self.doc_ids, other.doc_ids + np.int32(self.num_docs))),
+            np.concatenate((self.tfs, other.tfs)),
+            np.concatenate((self.doc_len, other.doc_len)),
+        )
+        return index
+
+    def extended(self, corpus) -> "BM25Index":
+        """
+        기존 문서 뒤에 새 문서를 이어 붙인 새 인덱스 반환
+
+        Args:
+            corpus: 추가할 문서별 토큰 리스트의 iterable
+
+        Returns:
+            BM25Index 인스턴스
+        """
+        return self.merged(type(self).from_corpus(corpus, k1=self.k1, b=self.b, epsilon=self.epsilon))
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_len)
+
+    def _compute_stats(self) -> None:
+        """IDF와 문서 길이 정규화 항 계산 (BM25Okapi와 같은 방식)"""
+        n = self.num_docs
+        df = np.diff(self.indptr).astype(np.float64)
+        idf = np.log(n - df + 0.5) - np.log(df + 0.5)
+        if len(idf):
+            # 너무 흔한 용어(음수 IDF)는 평균 IDF × epsilon으로 대체
+            average_idf = idf.sum() / len(idf)
+            idf[idf < 0] = self.epsilon * average_idf
+        self.idf = idf
+
+        avgdl = self.doc_len.sum() / n if n else 0.0
+        if avgdl > 0:
+            self.norm = self.k1 * (1 - self.b + self.b * self.doc_len / avgdl)
+        else:
+            self.norm = np.full(n, self.k1 * (1 - self.b))
+
+        # 용어별 최대 기여도 (조기 종료용 상한값)
+        self.max_impact = np.zeros(len(self.vocab), dtype=np.float64)
+        if len(self.doc_ids):
+            term_of_posting = self._term_of_postings()
+            tf = self.tfs.astype(np.float64)
+            impact = self.idf[term_of_posting] * tf * (self.k1 + 1) / (tf + self.norm[self.doc_ids])
+            np.maximum.at(self.max_impact, term_of_posting, impact)
+
+    def _query_terms(self, query_tokens: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """쿼리 토큰을 (용어 id, 등장 횟수)로 변환 (사전에 없는 용어는 제외)"""
+        ids = [i for i in map(self.vocab.get, query_tokens) if i is not None]
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.unique(ids, return_counts=True)
+
+    def term_stats(self, terms) -> tuple[int, int, dict[str, int]]:
+        """
+        코퍼스 통합 통계 계산용 원자료
+
+        Args:
+            terms: 문서 빈도를 구할 용어들
+
+        Returns:
+            (문서 수, 전체 토큰 수, 용어별 문서 빈도)
+        """
+        df = {}
+        for term in terms:
+            term_id = self.vocab.get(term)
+            df[term] = 0 if term_id is None else int(self.indptr[term_id + 1] - self.indptr[term_id])
+        return self.num_docs, int(self.doc_len.sum()), df
+
+    @staticmethod
+    def shared_stats(indexes: list["BM25Index"], query_tokens: list[str]) -> dict:
+        """
+        여러 인덱스를 하나의 코퍼스로 볼 때의 쿼리 용어 IDF와 평균 문서 길이
+
+        인덱스마다 IDF와 평균 문서 길이가 다르므로 원점수를 그대로 섞으면 비교할 수 없습니다.
+        이 통계로 각 인덱스를 채점하면 모든 문서를 한 인덱스에 넣었을 때와 같은 점수가 나옵니다.
+        단, 음수 IDF를 대체하는 평균 IDF는 인덱스별 평균 IDF를 문서 수로 가중 평균한 근사값입니다.
+
+        Args:
+            indexes: 같은 k1/b/epsilon을 쓰는 BM25Index 리스트
+            query_tokens: 토큰화된 쿼리
+
+        Returns:
+            {"idf": {용어: IDF}, "avgdl": 평균 문서 길이} (get_scores의 stats 인자)
+        """
+        terms = set(query_tokens)
+        n, total_len = 0, 0
+        df = dict.fromkeys(terms, 0)
+        idf_sum = 0.0
+        for index in indexes:
+            index_n, index_len, index_df = index.term_stats(terms)
+            n += index_n
+            total_len += index_len
+            for term, count in index_df.items():
+                df[term] += count
+            if len(index.idf):
+                idf_sum += index_n * float(np.mean(index.idf))
+
+        idf = {}
+        epsilon = indexes[0].epsilon if indexes else BM25_EPSILON
+        for term, count in df.items():
+            if count == 0:
+                continue
+            value = np.log(n - count + 0.5) - np.log(count + 0.5)
+            # 너무 흔한 용어(음수 IDF)는 평균 IDF × epsilon으로 대체
+            idf[term] = float(value if value >= 0 else epsilon * idf_sum / n)
+        return {"idf": idf, "avgdl": total_len / n if n else 0.0}
+
+    def _scoring_terms(self, query_tokens: list[str], stats: dict | None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """쿼리 용어의 (용어 id, 등장 횟수, IDF) - stats가 있으면 코퍼스 통합 IDF 사용"""
+        term_ids, counts = self._query_terms(query_tokens)
+        if stats is None:
+            return term_ids, counts, self.idf[term_ids]
+        idf_by_id = {self.vocab.get(term): value for term, value in stats["idf"].items()}
+        return term_ids, counts, np.asarray([idf_by_id[t] for t in term_ids.tolist()], dtype=np.float64)
+
+    def _doc_norm(self, docs: np.ndarray, stats: dict | None) -> np.ndarray:
+        """문서 길이 정규화 항 - stats가 있으면 코퍼스 통합 평균 길이 기준"""
+        if stats is None:
+            return self.norm[docs]
+        if stats["avgdl"] > 0:
+            return self.k1 * (1 - self.b + self.b * self.doc_len[docs] / stats["avgdl"])
+        return np.full(len(docs), self.k1 * (1 - self.b))
+
+    _ARRAYS = ("indptr", "doc_ids", "tfs", "doc_len", "idf", "norm", "max_impact")
+
+    def save(self, dir_path: str) -> None:
+        """
+        인덱스를 메모리 맵 가능한 .npy 파일들로 저장
+
+        Args:
+            dir_path: 저장할 디렉터리 경로 (없으면 생성)
+        """
+        os.makedirs(dir_path, exist_ok=True)
+        for name in self._ARRAYS:
+            np.save(os.path.join(dir_path, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+
+        # 용어 사전: UTF-8 바이트 순으로 정렬한 용어를 이어 붙인 바이트 배열 + 오프셋
+        vocab = self.vocab.to_dict() if isinstance(self.vocab, _MappedVocab) else self.vocab
+        items = sorted((term.encode(), term_id) for term, term_id in vocab.items())
+        encoded = [term for term, _ in items]
+        lengths = np.fromiter((len(t) for t in encoded), dtype=np.int64, count=len(encoded))
+        np.save(os.path.join(dir_path, "vocab_blob.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        np.save(os.path.join(dir_path, "vocab_offsets.npy"), np.concatenate(([0], np.cumsum(lengths))).astype(np.int64))
+        np.save(os.path.join(dir_path, "vocab_ids.npy"), np.asarray([i for _, i in items], dtype=np.int32))
+
+        with open(os.path.join(dir_path, "params.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "epsilon": self.epsilon}, f)
+
+    @classmethod
+    def load(cls, dir_path: str, mmap: bool = True) -> "BM25Index":
+        """
+        save()로 저장한 인덱스 로드
+
+        Args:
+            dir_path: 저장된 디렉터리 경로
+            mmap: True면 배열을 읽기 전용 메모리 맵으로 열어 프로세스 간에 페이지를 공유
+
+        Returns:
+            BM25Index 인스턴스
+        """
+        mode = "r" if mmap else None
+        with open(os.path.join(dir_path, "params.json"), encoding="utf-8") as f:
+            index = cls(**json.load(f))
+        for name in cls._ARRAYS:
+            setattr(index, name, np.load(os.path.join(dir_path, f"{name}.npy"), mmap_mode=mode))
+        index.vocab = _MappedVocab(
+            np.load(os.path.join(dir_path, "vocab_blob.npy"), mmap_mode=mode),
+            np.load(os.path.join(dir_path, "vocab_offsets.npy"), mmap_mode=mode),
+            np.load(os.path.join(dir_path, "vocab_ids.npy"), mmap_mode=mode),
+        )
+        return index
+
+    def get_scores(self, query_tokens: list[str], stats: dict | None = None) -> np.ndarray:
+        """
+        전체 문서에 대한 BM25 점수 계산
+
+        Args:
+            query_tokens: 토큰화된 쿼리 (중복 토큰은 BM25Okapi처럼 중복 가산)
+            stats: shared_stats()로 구한 코퍼스 통합 통계 (없으면 이 인덱스의 통계 사용)
+
+        Returns:
+            문서 수 길이의 점수 배열
+        """
+        term_ids, counts, idf = self._scoring_terms(query_tokens, stats)
+        if len(term_ids) == 0:
+            return np.zeros(self.num_docs)
+
+        docs_parts, weight_parts = [], []
+        for term_id, count, term_idf in zip(term_ids, counts, idf):
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end].astype(np.float64)
+            docs_parts.append(docs)
+            weight_parts.append(
+                count * term_idf * tf * (self.k1 + 1) / (tf + self._doc_norm(docs, stats))
+            )
+
+        return np.bincount(
+            np.concatenate(docs_parts),
+            weights=np.concatenate(weight_parts),
+            minlength=self.num_docs,
+        )
+
+    def top_k(
+        self, query_tokens: list[str], k: int, min_score: float = 0.0, stats: dict | None = None
+    ) -> list[tuple[int, float]]:
+        """
+        점수가 min_score보다 큰 상위 k개 문서 (argpartition으로 전체 정렬 회피)
+
+        Args:
+            query_tokens: 토큰화된 쿼리
+            k: 반환할 문서 개수
+            min_score: 점수 하한 (초과하는 문서만 반환)
+            stats: shared_stats()로 구한 코퍼스 통합 통계 (없으면 이 인덱스의 통계 사용)
+
+        Returns:
+            (문서 id, 점수) 리스트 (점수 내림차순, 동점이면 문서 id 오름차순)
+        """
+        scores = self.get_scores(query_tokens, stats)
+        return self._select_top(np.flatnonzero(scores > min_score), scores, k)
+
+    @staticmethod
+    def _select_top(candidates: np.ndarray, scores: np.ndarray, k: int) -> list[tuple[int, float]]:
+        """후보 문서 중 점수 상위 k개 선택 (점수 내림차순, 동점이면 문서 id 오름차순)"""
+        if len(candidates) > k:
+            # k번째 점수와 동점인 문서까지 남긴 뒤 정렬해야 동점 처리가 결정적임
+            kth_score = -np.partition(-scores[candidates], k - 1)[k - 1]
+            candidates = candidates[scores[candidates] >= kth_score]
+        order = np.lexsort((candidates, -scores[candidates]))[:k]
+        return [(int(candidates[i]), float(scores[candidates[i]])) for i in order]
+
+    def top_k_pruned(self, query_tokens: list[str], k: int, min_score: float = 0.0) -> list[tuple[int, float]]:
+        """
+        역색인 + 상한값 기반 조기 종료(MaxScore/WAND 계열)로 상위 k개 문서 검색
+
+        용어를 최대 기여도가 큰 순서(대개 드문 용어)로 처리하며 후보 문서의 부분 점수를 누적합니다.
+        남은 용어들의 상한값 합이 현재 k번째 부분 점수보다 작아지면 새 문서는 결과에 들 수 없으므로,
+        이후 용어의 긴 포스팅 리스트는 전부 훑지 않고 남은 후보만 이진 탐색으로 갱신합니다.
+        드문 용어가 포함된 쿼리에서 효과가 크며, 결과는 top_k()와 동일합니다.
+
+        Args:
+            query_tokens: 토큰화된 쿼리
+            k: 반환할 문서 개수
+            min_score: 점수 하한 (초과하는 문서만 반환)
+
+        Returns:
+            top_k()와 같은 형식의 (문서 id, 점수) 리스트
+        """
+        term_ids, counts = self._query_terms(query_tokens)
+        if len(term_ids) == 0 or k <= 0:
+            return []
+
+        # 부동소수점 오차로 상한값이 실제 기여도보다 작아지지 않도록 약간의 여유
+        upper = counts * self.max_impact[term_ids] * (1 + 1e-9)
+        order = np.argsort(-upper, kind="stable")
+        term_ids, counts, upper = term_ids[order], counts[order], upper[order]
+        # remaining[i]: i번째 이후 용어들로 얻을 수 있는 최대 점수
+        remaining = np.concatenate((np.cumsum(upper[::-1])[::-1], [0.0]))
+
+        scores = np.zeros(self.num_docs)
+        theta = 0.0  # 최종 k번째 점수의 하한 (부분 점수는 줄어들지 않으므로 계속 유효)
+        cand_docs = None  # 새 문서 진입이 닫힌 뒤의 후보 문서 (정렬됨)
+        for i, (term_id, count) in enumerate(zip(term_ids, counts)):
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tfs = self.tfs[start:end]
+
+            if cand_docs is None:
+                # 남은 용어 상한 합이 k번째 부분 점수보다 작으면 새 문서 진입 종료
+                if remaining[i] < theta or remaining[i] <= min_score:
+                    floor = max(theta, min_score)
+                    cand_docs = np.flatnonzero(scores + remaining[i] >= floor)
+
+            # 후보가 포스팅 리스트에 비해 많으면 이진 탐색보다 전체 누적이 저렴
+            # (후보 밖 문서의 점수가 더해져도 최종 선택은 후보 안에서만 이루어짐)
+            if cand_docs is None or len(cand_docs) * 8 > len(docs):
+                tf = tfs.astype(np.float64)
+                # 한 포스팅 리스트 안에서 문서 id는 중복되지 않으므로 바로 누적 가능
+                scores[docs] += count * self.idf[term_id] * tf * (self.k1 + 1) / (tf + self.norm[docs])
+                if cand_docs is None and len(docs) >= k and i + 1 < len(term_ids):
+                    # 이 포스팅의 문서들은 서로 다르므로 그 k번째 부분 점수도 유효한 하한
+                    # (최댓값조차 마지막 용어의 상한보다 작으면 진입을 닫는 데 쓰일 수 없으므로 생략)
+                    term_scores = scores[docs]
+                    if term_scores.max() > remaining[len(term_ids) - 1]:
+                        theta = max(theta, -np.partition(-term_scores, k - 1)[k - 1])
+            else:
+                # 기존 후보의 포스팅만 이진 탐색으로 찾아 갱신 (나머지 구간은 건너뜀)
+                pos = np.searchsorted(docs, cand_docs)
+                matched = pos < len(docs)
+                matched[matched] = docs[pos[matched]] == cand_docs[matched]
+                hit_docs = cand_docs[matched]
+                tf = tfs[pos[matched]].astype(np.float64)
+                scores[hit_docs] += count * self.idf[term_id] * tf * (self.k1 + 1) / (tf + self.norm[hit_docs])
+
+            if cand_docs is None:
+                continue
+
+            # 남은 용어를 모두 더해도 k번째에 못 미치는 후보 제거
+            cand_scores = scores[cand_docs]
+            if len(cand_docs) > k:
+                theta = -np.partition(-cand_scores, k - 1)[k - 1]
+                cand_docs = cand_docs[cand_scores + remaining[i + 1] >= max(theta, min_score)]
+
+        if cand_docs is None:
+            cand_docs = np.flatnonzero(scores > min_score)
+        else:
+            cand_docs = cand_docs[scores[cand_docs] > min_score]
+        return self._select_top(cand_docs, scores, k)
+
+
 # =========================
 # BM25 기반 검색기
 # =========================
@@ -78,17 +767,29 @@ class BM25Retriever:
         # 1글자 토큰 제거 (의미 없는 단문자)
         return [t for t in tokens if len(t) > 1]
     
-    def __init__(self, documents: list[Document]):
+    def __init__(self, documents: list[Document], engine: str = BM25_ENGINE):
         """
         문서 리스트로부터 BM25 인덱스 생성
         
         Args:
             documents: LangChain Document 객체의 리스트
+            engine: top-k 방식 ("sparse": 전체 점수 계산, "inverted": 역색인 조기 종료)
         """
         self.documents = documents
-        # 개선된 토큰화 적용
-        self.corpus = [self.tokenize(doc.page_content) for doc in documents]
-        self.bm25 = BM25Okapi(self.corpus)
+        self.engine = engine
+        # 개선된 토큰화 적용 후 희소 행렬 인덱스로 변환 (토큰 리스트는 보관하지 않음)
+        # 증분 인덱싱 중에는 배치별 세그먼트가 늘어나며, 문서 순서대로 이어 붙이면 전체 인덱스가 됨
+        self.segments: tuple[BM25Index, ...] = (
+            BM25Index.from_corpus(self.tokenize(doc.page_content) for doc in documents),
+        )
+        self._lock = threading.Lock()
+
+    @property
+    def bm25(self) -> BM25Index:
+        """전체 문서의 BM25 인덱스 (세그먼트가 여러 개면 먼저 하나로 합침)"""
+        if len(self.segments) > 1:
+            self.compact()
+        return self.segments[0]
     
     def retrieve(self, query: str, k: int = 10) -> list[Document]:
         """
@@ -101,178 +802,2729 @@ class BM25Retriever:
         Returns:
             유사도가 높은 Document 객체의 리스트
         """
+        return [self.documents[i] for i, _ in self.retrieve_with_scores(query, k=k)]
+
+    def retrieve_with_scores(self, query: str, k: int = 10, stats: dict | None = None) -> list[tuple[int, float]]:
+        """
+        BM25 검색 결과를 청크 id와 원점수로 반환
+
+        Args:
+            query: 검색 쿼리
+            k: 반환할 상위 문서 개수
+            stats: 여러 문서를 함께 검색할 때의 코퍼스 통합 통계 (BM25Index.shared_stats)
+
+        Returns:
+            (청크 id, BM25 점수) 리스트 (점수 내림차순)
+        """
         # 쿼리도 동일한 토큰화 적용
         query_tokens = self.tokenize(query)
-        scores = self.bm25.get_scores(query_tokens)
-        
-        # 상위 k개의 인덱스를 점수와 함께 가져오기
-        top_indices = sorted(
-            range(len(scores)), 
-            key=lambda i: scores[i], 
-            reverse=True
-        )[:k]
-        
-        # 임계값 이상의 점수만 반환
-        return [self.documents[i] for i in top_indices if scores[i] > BM25_SCORE_THRESHOLD]
+        segments = self.segments
 
+        # 임계값 이상의 점수 중 상위 k개
+        if stats is None and len(segments) == 1:
+            top_k = segments[0].top_k_pruned if self.engine == "inverted" else segments[0].top_k
+            return top_k(query_tokens, k, min_score=BM25_SCORE_THRESHOLD)
 
-# =========================
-# 하이브리드 검색기
-# =========================
-class HybridRetriever:
-    """
-    벡터 기반 검색(FAISS)과 BM25 기반 검색을 결합한 하이브리드 검색기
-    
-    점수 정규화 및 가중 합산을 통해 최적의 검색 결과를 제공합니다.
-    """
-    
-    @staticmethod
-    def _get_doc_key(doc: Document) -> tuple:
+        # 세그먼트별 통계가 다르므로 합친 통계로 채점
+        # (조기 종료 상한값은 세그먼트 자체 통계 기준이므로 이 경우에는 전체 점수 계산)
+        if stats is None:
+            stats = BM25Index.shared_stats(list(segments), query_tokens)
+        hits, offset = [], 0
+        for segment in segments:
+            hits.extend(
+                (offset + doc_id, score)
+                for doc_id, score in segment.top_k(query_tokens, k, min_score=BM25_SCORE_THRESHOLD, stats=stats)
+            )
+            offset += segment.num_docs
+        hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        return hits[:k]
+
+    def add_documents(self, documents: list[Document]) -> None:
         """
-        문서의 고유 키 생성 (정규화된 식별)
-        MD5 해시로 내용 기반 중복 제거
-        
+        문서를 추가 인덱싱 (검색과 동시에 호출해도 안전)
+
+        추가한 문서만으로 새 세그먼트를 만들고, 마지막 세그먼트가 바로 앞 세그먼트보다
+        커지지 않도록 비슷한 크기끼리 합칩니다. 배치마다 전체 포스팅을 다시 정렬하지 않으므로
+        세그먼트 수는 로그 수준으로 유지되고 전체 합치기 비용은 O(N log N)입니다.
+        새 세그먼트 목록을 만든 뒤 참조만 교체하므로 진행 중인 검색은 이전 목록으로 끝나며,
+        문서 리스트를 먼저 늘려 두므로 새 세그먼트가 반환하는 id는 항상 유효합니다.
+
         Args:
-            doc: LangChain Document 객체
-        
-        Returns:
-            (source, page, content_hash) 튜플
+            documents: 추가할 Document 리스트 (청크 id는 기존 문서 수부터 이어져야 함)
         """
-        # 처음 8자리만 사용 (충분한 고유성 + 성능)
-        content_hash = md5(doc.page_content.encode()).hexdigest()[:8]
-        return (
-            doc.metadata.get("source"),
-            doc.metadata.get("page"),
-            content_hash
-        )
-    
-    def __init__(
-        self, 
-        vectorstore_retriever,
-        bm25_retriever: BM25Retriever,
-        vector_weight: float = 0.7,
-        bm25_weight: float = 0.3,
-    ):
+        segment = BM25Index.from_corpus(self.tokenize(doc.page_content) for doc in documents)
+        with self._lock:
+            segments = [*self.segments, segment]
+            while len(segments) > 1 and segments[-1].num_docs >= segments[-2].num_docs:
+                segments[-2:] = [segments[-2].merged(segments[-1])]
+            self.documents.extend(documents)
+            self.segments = tuple(segments)
+
+    def compact(self) -> None:
+        """세그먼트를 하나의 인덱스로 합침 (증분 인덱싱이 끝난 뒤 한 번 호출)"""
+        with self._lock:
+            segments = self.segments
+            if len(segments) == 1:
+                return
+            # 뒤쪽 세그먼트일수록 작으므로 뒤에서부터 합쳐 큰 배열 복사를 줄임
+            merged = segments[-1]
+            for segment in reversed(segments[:-1]):
+                merged = segment.merged(merged)
+            self.segments = (merged,)
+
+    def save(self, dir_path: str) -> None:
         """
+        BM25 인덱스를 디렉터리에 저장 (dir_path/bm25 아래 .npy 파일)
+
         Args:
-            vectorstore_retriever: FAISS retriever (MMR 옵션 포함)
-            bm25_retriever: BM25Retriever 인스턴스
-            vector_weight: 벡터 검색의 가중치 (기본값: 0.7)
-            bm25_weight: BM25 검색의 가중치 (기본값: 0.3)
+            dir_path: 저장할 디렉터리 경로
         """
-        self.vectorstore_retriever = vectorstore_retriever
-        self.bm25_retriever = bm25_retriever
-        self.vector_weight = vector_weight
-        self.bm25_weight = bm25_weight
-    
-    def retrieve(self, query: str, k: int = 10) -> list[Document]:
+        self.bm25.save(os.path.join(dir_path, "bm25"))
+
+    @classmethod
+    def load(cls, dir_path: str, documents: list[Document], engine: str = BM25_ENGINE) -> "BM25Retriever":
+        """
+        저장된 BM25 인덱스를 메모리 맵으로 열어 재토큰화 없이 검색기 복원
+
+        Args:
+            dir_path: save()로 저장한 디렉터리 경로
+            documents: 저장 당시와 같은 순서의 Document 리스트
+            engine: top-k 방식 ("sparse" 또는 "inverted")
+
+        Returns:
+            BM25Retriever 인스턴스
+        """
+        retriever = cls.__new__(cls)
+        retriever.documents = documents
+        retriever.engine = engine
+        retriever.segments = (BM25Index.load(os.path.join(dir_path, "bm25")),)
+        retriever._lock = threading.Lock()
+        return retriever
+
+
+# =========================
+# 점수 결합 (Rank Fusion)
+# =========================
+def _normalize_scores(scores: np.ndarray, mode: str) -> np.ndarray:
+    """검색기별 원점수를 결합 가능한 척도로 정규화"""
+    if mode == "zscore":
+        std = scores.std()
+        return (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+    # minmax
+    span = scores.max() - scores.min()
+    return (scores - scores.min()) / span if span > 0 else np.ones_like(scores)
+
+
+def fuse_scores(
+    vector_hits: list[tuple],
+    bm25_hits: list[tuple],
+    vector_weight: float = VECTOR_WEIGHT,
+    bm25_weight: float = BM25_WEIGHT,
+    mode: str = FUSION_MODE,
+    rrf_k: int = RRF_K,
+) -> list[tuple]:
+    """
+    벡터/BM25 검색의 (키, 원점수) 결과를 하나의 점수로 결합
+
+    Args:
+        vector_hits: (청크 키, 유사도 점수) 리스트 (높을수록 관련, 순위순)
+        bm25_hits: (청크 키, BM25 점수) 리스트 (순위순)
+        vector_weight: 벡터 검색 가중치
+        bm25_weight: BM25 검색 가중치
+        mode: "minmax"(최소-최대 정규화), "zscore"(표준화), "rrf"(순위 역수 합)
+        rrf_k: RRF 순위 완화 상수
+
+    Returns:
+        (청크 키, 결합 점수) 리스트 (점수 내림차순)
+    """
+    legs = [(hits, weight) for hits, weight in ((vector_hits, vector_weight), (bm25_hits, bm25_weight)) if hits]
+    fused = dict.fromkeys((key for hits, _ in legs for key, _ in hits), 0.0)
+
+    for hits, weight in legs:
+        if mode == "rrf":
+            contrib = {key: weight / (rrf_k + rank) for rank, (key, _) in enumerate(hits, start=1)}
+            missing = 0.0
+        else:
+            normalized = _normalize_scores(np.asarray([score for _, score in hits], dtype=np.float64), mode)
+            contrib = {key: weight * float(value) for (key, _), value in zip(hits, normalized)}
+            # 한쪽 검색에만 나온 청크는 다른 쪽에서 최저 점수를 받은 것으로 취급
+            missing = weight * float(normalized.min()) if mode == "zscore" else 0.0
+        for key in fused:
+            fused[key] += contrib.get(key, missing)
+
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+# =========================
+# 근사 벡터 인덱스 (HNSW / IVF-Flat / IVF-PQ)
+# =========================
+VECTOR_INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+
+def choose_index_type(num_vectors: int) -> str:
+    """
+    벡터 수에 맞는 FAISS 인덱스 종류 선택
+
+    작은 문서는 정확한 flat을 쓰고, 커질수록 HNSW → IVF-Flat → IVF-PQ 순으로
+    검색 시간과 메모리를 줄이는 근사 인덱스를 사용합니다.
+    """
+    if num_vectors >= FAISS_PQ_MIN_VECTORS:
+        return "ivf_pq"
+    if num_vectors >= FAISS_IVF_MIN_VECTORS:
+        return "ivf_flat"
+    if num_vectors >= FAISS_HNSW_MIN_VECTORS:
+        return "hnsw"
+    return "flat"
+
+
+def index_type_of(index) -> str:
+    """FAISS 인덱스 객체의 종류 이름 (VECTOR_INDEX_TYPES 중 하나)"""
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def _ivf_nlist(num_vectors: int) -> int:
+    # 권장값 4·√N, 클러스터마다 학습 벡터가 39개 이상 되도록 제한
+    return max(1, min(int(4 * np.sqrt(num_vectors)), num_vectors // 39))
+
+
+def _pq_m(dim: int, max_m: int = FAISS_PQ_M) -> int:
+    """max_m 이하인 차원의 가장 큰 약수 (PQ 부분 벡터 수)"""
+    return next(m for m in range(min(max_m, dim), 0, -1) if dim % m == 0)
+
+
+def set_search_params(index, nprobe: int = FAISS_NPROBE, ef_search: int = FAISS_HNSW_EF_SEARCH) -> None:
+    """
+    근사 인덱스의 검색 파라미터 설정 (flat 인덱스는 변경 없음)
+
+    Args:
+        index: FAISS 인덱스
+        nprobe: IVF 검색 시 탐색할 클러스터 수
+        ef_search: HNSW 검색 시 탐색 폭
+    """
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(nprobe, index.nlist)
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+
+
+def build_vector_index(
+    vectors: np.ndarray,
+    index_type: str = FAISS_INDEX_TYPE,
+    train_sample: int = FAISS_TRAIN_SAMPLE,
+    seed: int = 0,
+):
+    """
+    벡터로 FAISS 인덱스 생성 (IVF 계열은 샘플로 학습한 뒤 전체 추가)
+
+    벡터는 입력 순서대로 추가되므로 인덱스 위치 = 청크 id가 그대로 유지됩니다.
+    IVF 계열은 MMR/재정렬에서 index.reconstruct를 쓸 수 있도록 direct map을 만듭니다.
+
+    Args:
+        vectors: (벡터 수, 차원) 배열
+        index_type: "auto" 또는 VECTOR_INDEX_TYPES 중 하나
+        train_sample: IVF/PQ 학습에 사용할 최대 샘플 수
+        seed: 학습 샘플 추출 시드
+
+    Returns:
+        FAISS 인덱스 (L2 거리, 검색 파라미터 적용됨)
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    if index_type == "auto":
+        index_type = choose_index_type(n)
+    if index_type not in VECTOR_INDEX_TYPES:
+        raise ValueError(f"지원하지 않는 인덱스 종류입니다: {index_type}")
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, FAISS_HNSW_M)
+        index.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+    else:
+        nlist = _ivf_nlist(n)
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_pq":
+            # 코드북(2^nbits개 중심) 하나당 학습 벡터가 39개 이상 되도록 비트 수 제한
+            nbits = int(min(8, max(1, np.log2(max(2, n // 39)))))
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m(dim), nbits)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        sample_size = min(n, max(train_sample, 39 * nlist))
+        if sample_size < n:
+            sample = vectors[np.random.default_rng(seed).choice(n, sample_size, replace=False)]
+        else:
+            sample = vectors
+        index.train(sample)
+
+    index.add(vectors)
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    set_search_params(index)
+    return index
+
+
+def vector_index_bytes(index) -> int:
+    """FAISS 인덱스 메모리 대략치 (벡터/코드 + 그래프 연결 또는 역색인 id)"""
+    n = index.ntotal
+    kind = index_type_of(index)
+    if kind == "ivf_pq":
+        # 코드 + 역색인 id + direct map
+        return n * (index.pq.code_size + 16)
+    if kind == "ivf_flat":
+        return n * (index.d * 4 + 16)
+    if kind == "hnsw":
+        # 0층 연결(2M개)이 대부분을 차지
+        return n * (index.d * 4 + index.hnsw.nb_neighbors(0) * 4)
+    return n * index.d * 4
+
+
+def vector_index_report(
+    vectors: np.ndarray,
+    index_types: tuple = ("hnsw", "ivf_flat", "ivf_pq"),
+    k: int = RETRIEVER_FETCH_K,
+    nprobe_values: tuple = (1, 4, 16, 64),
+    ef_search_values: tuple = (32, 64, 128, 256),
+    queries: np.ndarray | None = None,
+    num_queries: int = 200,
+    seed: int = 0,
+) -> list[dict]:
+    """
+    근사 인덱스의 재현율(recall@k)과 쿼리당 검색 시간을 flat(정확 검색) 기준으로 측정
+
+    인덱스 종류와 검색 파라미터(nprobe/efSearch)마다 한 행씩 반환하므로
+    FAISS_NPROBE / FAISS_HNSW_EF_SEARCH와 자동 선택 기준을 정할 때 사용합니다.
+    쿼리를 주지 않으면 저장된 벡터 두 개의 평균을 쿼리로 사용합니다
+    (저장된 벡터를 그대로 쓰면 자기 자신이 항상 1위라 재현율이 부풀려짐).
+
+    Args:
+        vectors: 인덱싱할 (벡터 수, 차원) 배열 (예: vectorstore.index.reconstruct_n(0, ntotal))
+        index_types: 비교할 근사 인덱스 종류
+        k: 재현율을 잴 상위 개수 (기본값: MMR 후보 수 RETRIEVER_FETCH_K)
+        nprobe_values: IVF 계열에서 비교할 nprobe 값
+        ef_search_values: HNSW에서 비교할 efSearch 값
+        queries: 쿼리 임베딩 배열 (없으면 저장된 벡터로 생성)
+        num_queries: 생성할 쿼리 수
+        seed: 쿼리 생성/학습 샘플 시드
+
+    Returns:
+        {"index_type", "param", "value", "recall", "latency_ms", "build_sec", "memory_bytes"} 리스트
+        (첫 행은 flat 기준)
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n = len(vectors)
+    k = min(k, n)
+    if queries is None:
+        rng = np.random.default_rng(seed)
+        queries = (vectors[rng.integers(0, n, num_queries)] + vectors[rng.integers(0, n, num_queries)]) / 2
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    def measure(index) -> tuple[np.ndarray, float]:
+        # 실제 사용처럼 쿼리를 하나씩 검색
+        started = time.perf_counter()
+        ids = np.vstack([index.search(q[None, :], k)[1] for q in queries])
+        return ids, (time.perf_counter() - started) * 1000 / len(queries)
+
+    rows = []
+
+    def add_row(index_type, param, value, index, build_sec, ids, latency_ms):
+        recall = np.mean([len(set(row) & set(truth)) / k for row, truth in zip(ids, exact_ids)])
+        rows.append({
+            "index_type": index_type,
+            "param": param,
+            "value": value,
+            "recall": float(recall),
+            "latency_ms": latency_ms,
+            "build_sec": build_sec,
+            "memory_bytes": vector_index_bytes(index),
+        })
+
+    started = time.perf_counter()
+    flat = build_vector_index(vectors, "flat")
+    build_sec = time.perf_counter() - started
+    exact_ids, latency_ms = measure(flat)
+    add_row("flat", None, None, flat, build_sec, exact_ids, latency_ms)
+
+    for index_type in index_types:
+        started = time.perf_counter()
+        index = build_vector_index(vectors, index_type, seed=seed)
+        build_sec = time.perf_counter() - started
+        if index_type == "hnsw":
+            param, values = "efSearch", ef_search_values
+        else:
+            param, values = "nprobe", nprobe_values
+        for value in values:
+            if param == "efSearch":
+                set_search_params(index, ef_search=value)
+            else:
+                set_search_params(index, nprobe=value)
+            ids, latency_ms = measure(index)
+            add_row(index_type, param, value, index, build_sec, ids, latency_ms)
+
+    for row in rows:
+        logger.info(
+            "vector index %s %s=%s: recall@%d %.3f, %.2f ms/query",
+            row["index_type"], row["param"], row["value"], k, row["recall"], row["latency_ms"],
+        )
+    return rows
+
+
+def format_index_report(rows: list[dict]) -> str:
+    """vector_index_report 결과를 마크다운 표로 변환"""
+    lines = [
+        "| 인덱스 | 파라미터 | 재현율 | 검색(ms) | 생성(s) | 메모리(MB) |",
+        "|---|---|---|---|---|---|",
+    ]
+    for row in rows:
+        param = f"{row['param']}={row['value']}" if row["param"] else "-"
+        lines.append(
+            f"| {row['index_type']} | {param} | {row['recall']:.3f} | {row['latency_ms']:.2f} "
+            f"| {row['build_sec']:.2f} | {row['memory_bytes'] / 2**20:.1f} |"
+        )
+    return "\n".join(lines)
+
+
+# =========================
+# 하이브리드 검색기
+# =========================
+class HybridRetriever:
+    """
+    벡터 기반 검색(FAISS)과 BM25 기반 검색을 결합한 하이브리드 검색기
+    
+    두 검색기의 실제 점수를 정규화(minmax/zscore) 또는 RRF로 결합합니다.
+    청크는 인덱싱 시 부여한 정수 id(metadata["chunk_id"])로 식별하므로
+    쿼리마다 본문을 해시하지 않습니다.
+    """
+    
+    def __init__(
+        self, 
+        vectorstore_retriever,
+        bm25_retriever: BM25Retriever,
+        vector_weight: float = 0.7,
+        bm25_weight: float = 0.3,
+        fusion_mode: str = FUSION_MODE,
+    ):
+        """
+        Args:
+            vectorstore_retriever: FAISS retriever (MMR 옵션 포함)
+            bm25_retriever: BM25Retriever 인스턴스
+            vector_weight: 벡터 검색의 가중치 (기본값: 0.7)
+            bm25_weight: BM25 검색의 가중치 (기본값: 0.3)
+            fusion_mode: 점수 결합 방식 ("minmax", "zscore", "rrf")
+        """
+        self.vectorstore_retriever = vectorstore_retriever
+        self.bm25_retriever = bm25_retriever
+        self.vector_weight = vector_weight
+        self.bm25_weight = bm25_weight
+        self.fusion_mode = fusion_mode
+        # 청크 id → Document (BM25 인덱스와 같은 순서)
+        self.documents = bm25_retriever.documents
+        self.vectorstore = getattr(vectorstore_retriever, "vectorstore", None)
+        self.search_type = getattr(vectorstore_retriever, "search_type", "similarity")
+        self.search_kwargs = dict(getattr(vectorstore_retriever, "search_kwargs", {}) or {})
+        # 증분 인덱싱 중 FAISS 추가와 검색이 겹치지 않도록 보호
+        self._vector_lock = threading.Lock()
+        # 증분 인덱싱 진행 상태 (build_hybrid_retriever가 갱신)
+        # 모든 페이지가 인덱싱되어야 done=True, 실패하면 done=False 그대로 error에 사유 기록
+        self.ingest_status = {"done": True, "pages": 0, "total_pages": 0, "chunks": len(self.documents), "error": None}
+        # 백그라운드 인덱싱 스레드 (없으면 None, 코퍼스가 인덱싱 완료를 기다릴 때 사용)
+        self.ingest_thread: threading.Thread | None = None
+        # IVF-PQ 인덱스의 원래 임베딩 (청크 id 순서의 float32 배열, IndexStore 저장 후에는 mmap)
+        # PQ 복원 벡터는 근사값이므로 MMR/재정렬/인덱스 재변환에는 이 값을 사용
+        self.exact_vectors: np.ndarray | None = None
+        # 인덱스 저장소 키 (build_hybrid_retriever가 설정, 코퍼스 인덱스 변환 결과 저장에 사용)
+        self.doc_hash: str | None = None
+        # 코퍼스 인덱스 종류가 정해졌는지 여부 (여러 코퍼스가 공유해도 한 번만 변환)
+        self.index_settled = False
+        self._settle_lock = threading.Lock()
+        # 페이지 단위 Document (페이지별 요약 모드에서 사용, 증분 인덱싱 중에는 제자리에서 늘어남)
+        self.pages = []
+
+    def add_chunks(self, chunks: list[Document], vectors: list[list[float]]) -> None:
+        """
+        청크와 임베딩을 검색 중인 인덱스에 추가 (FAISS + BM25)
+
+        Args:
+            chunks: chunk_id가 현재 청크 수부터 이어지는 Document 리스트
+            vectors: chunks와 같은 순서의 임베딩
+        """
+        if not chunks:
+            return
+        # BM25(청크 리스트)를 먼저 늘려 FAISS가 반환하는 id가 항상 청크 리스트 안에 있도록 함
+        self.bm25_retriever.add_documents(chunks)
+        if self.vectorstore is not None:
+            with self._vector_lock:
+                self.vectorstore.add_embeddings(
+                    list(zip([d.page_content for d in chunks], vectors)),
+                    metadatas=[d.metadata for d in chunks],
+                )
+
+    @property
+    def embeddings(self):
+        """쿼리 임베딩에 사용하는 Embeddings 객체 (벡터스토어와 동일)"""
+        return getattr(self.vectorstore, "embeddings", None)
+
+    def _vector_search(self, query: str, embedding: list[float] | None = None) -> list[tuple[int, float]]:
+        """
+        벡터 검색 결과를 (청크 id, 유사도 점수)로 반환
+        FAISS 거리(L2)는 작을수록 가까우므로 부호를 바꿔 높을수록 관련되게 함
+        """
+        if self.vectorstore is None:
+            # 점수를 제공하지 않는 retriever: 순위 기반 점수로 대체
+            docs = self.vectorstore_retriever.invoke(query)
+            return [
+                (d.metadata["chunk_id"], float(len(docs) - i))
+                for i, d in enumerate(docs)
+                if "chunk_id" in d.metadata
+            ]
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+        return self._vector_search_by_vector(embedding)
+
+    def _is_lossy_index(self) -> bool:
+        """벡터를 압축 저장해 복원값이 원래 임베딩과 다른 인덱스(IVF-PQ)인지 여부"""
+        return self.vectorstore is not None and index_type_of(self.vectorstore.index) == "ivf_pq"
+
+    def _exact_vectors(self, chunk_ids) -> np.ndarray | None:
+        """저장해 둔 원래 임베딩에서 청크 벡터 조회 (없거나 범위를 벗어나면 None)"""
+        exact = self.exact_vectors
+        chunk_ids = list(chunk_ids)
+        if exact is None or (chunk_ids and max(chunk_ids) >= len(exact)):
+            return None
+        return np.asarray(exact[chunk_ids], dtype=np.float32)
+
+    def chunk_vectors(self, chunk_ids: list[int]) -> np.ndarray | None:
+        """
+        청크 임베딩 조회 (FAISS 인덱스에서 복원)
+
+        IVF-PQ 인덱스의 복원 벡터는 근사값이므로 저장해 둔 원래 임베딩(exact_vectors)을 먼저 사용합니다.
+
+        Args:
+            chunk_ids: 청크 id 리스트
+
+        Returns:
+            (청크 수, 차원) 배열 (조회할 수 없으면 None)
+        """
+        if self._is_lossy_index():
+            vectors = self._exact_vectors(chunk_ids)
+            if vectors is not None:
+                return vectors
+        try:
+            # 청크는 id 순서대로 인덱스에 추가되므로 FAISS 위치 = 청크 id
+            with self._vector_lock:
+                return np.vstack([self.vectorstore.index.reconstruct(int(i)) for i in chunk_ids])
+        except Exception:
+            return None
+
+    def optimize_vector_index(self, index_type: str = FAISS_INDEX_TYPE, num_vectors: int | None = None) -> str:
+        """
+        FAISS 인덱스를 청크 수에 맞는 근사 인덱스(HNSW/IVF/PQ)로 교체
+
+        증분 인덱싱 중에는 학습 없이 바로 추가할 수 있는 flat 인덱스를 쓰고, 인덱싱이 끝난 뒤
+        한 번만 변환합니다. 새 인덱스는 잠금 밖에서 만들고 교체만 잠금 안에서 하므로
+        변환하는 동안에도 기존 인덱스로 검색할 수 있습니다.
+        IVF-PQ로 바꿀 때는 변환 전 원래 임베딩을 exact_vectors로 남겨 두며,
+        IndexStore.save가 인덱스 옆의 .npy 파일로 저장합니다.
+
+        Args:
+            index_type: "auto" 또는 VECTOR_INDEX_TYPES 중 하나
+            num_vectors: "auto"에서 인덱스 종류를 고를 기준 벡터 수 (없으면 이 인덱스의 벡터 수)
+
+        Returns:
+            적용된 인덱스 종류
+        """
+        if self.vectorstore is None:
+            return "flat"
+        index = self.vectorstore.index
+        if index_type == "auto":
+            index_type = choose_index_type(index.ntotal if num_vectors is None else num_vectors)
+        if index.ntotal == 0 or index_type == index_type_of(index):
+            return index_type_of(index)
+
+        if self._is_lossy_index():
+            # PQ 복원 벡터로 다시 만들면 손실이 그대로 남으므로 원래 임베딩이 있을 때만 변환
+            vectors = self.exact_vectors
+            if vectors is None or len(vectors) != index.ntotal:
+                logger.warning(
+                    "kept ivf_pq vector index: exact embeddings for %d chunks are not stored", index.ntotal
+                )
+                return "ivf_pq"
+        else:
+            with self._vector_lock:
+                vectors = index.reconstruct_n(0, index.ntotal)
+        started = time.perf_counter()
+        new_index = build_vector_index(vectors, index_type)
+        with self._vector_lock:
+            self.vectorstore.index = new_index
+            # 손실 없는 인덱스는 복원 벡터가 원래 임베딩과 같으므로 별도로 들고 있지 않음
+            self.exact_vectors = vectors if index_type == "ivf_pq" else None
+        logger.info(
+            "switched vector index to %s (%d vectors, %.1fs)",
+            index_type, new_index.ntotal, time.perf_counter() - started,
+        )
+        return index_type
+
+    def settle_vector_index(self, index_type: str) -> str:
+        """
+        코퍼스가 정한 인덱스 종류를 샤드당 한 번만 적용하고 인덱스 저장소에 반영
+
+        같은 샤드를 벡터 수가 다른 여러 코퍼스가 공유하므로 코퍼스마다 다시 정하면
+        인덱스가 종류를 오가며 변환을 반복합니다. 처음 정한 종류로 고정하고
+        (manifest에 기록되어 재시작 후에도 유지) 이후 호출은 현재 종류를 그대로 반환합니다.
+
+        Args:
+            index_type: VECTOR_INDEX_TYPES 중 하나
+
+        Returns:
+            샤드에 적용된 인덱스 종류
+        """
+        with self._settle_lock:
+            if not self.index_settled:
+                before = index_type_of(self.vectorstore.index)
+                applied = self.optimize_vector_index(index_type)
+                if self.doc_hash is not None:
+                    if applied != before:
+                        index_store.save_vector_index(self.doc_hash, self.vectorstore, self.exact_vectors)
+                        if self.exact_vectors is not None:
+                            # 메모리에 있는 원래 임베딩 대신 저장한 파일을 mmap으로 사용
+                            mapped = index_store.load_exact_vectors(self.doc_hash)
+                            if mapped is not None:
+                                self.exact_vectors = mapped
+                    else:
+                        index_store.update_manifest(self.doc_hash, index_settled=True)
+                self.index_settled = True
+            return index_type_of(self.vectorstore.index)
+
+    def vectors_for_docs(self, docs: list[Document]) -> np.ndarray | None:
+        """
+        검색 결과 문서들의 청크 임베딩 조회 (재정렬기에서 사용)
+
+        Args:
+            docs: 이 검색기가 반환한 Document 리스트
+
+        Returns:
+            (문서 수, 차원) 배열 (chunk_id가 없거나 조회할 수 없으면 None)
+        """
+        chunk_ids = [d.metadata.get("chunk_id") for d in docs]
+        if not all(isinstance(i, int) for i in chunk_ids):
+            return None
+        return self.chunk_vectors(chunk_ids)
+
+    def _exact_mmr_search(self, embedding: list[float], k: int, fetch_k: int, lambda_mult: float) -> list[tuple[int, float]] | None:
+        """
+        IVF-PQ 인덱스에서 후보만 근사 검색하고, MMR 다양성 계산과 점수는 원래 임베딩으로 수행
+
+        Returns:
+            (청크 id, -L2 거리) 리스트 (원래 임베딩을 찾을 수 없으면 None)
+        """
+        query = np.asarray([embedding], dtype=np.float32)
+        with self._vector_lock:
+            _, positions = self.vectorstore.index.search(query, fetch_k)
+        chunk_ids = [int(i) for i in positions[0] if i != -1]
+        if not chunk_ids:
+            return []
+        vectors = self._exact_vectors(chunk_ids)
+        if vectors is None:
+            return None
+        selected = maximal_marginal_relevance(query[0], vectors, k=k, lambda_mult=lambda_mult)
+        # FAISS L2 인덱스와 같은 척도(제곱 거리)로 정확한 거리 계산
+        distances = ((vectors[selected] - query) ** 2).sum(axis=1)
+        return [(chunk_ids[i], -float(d)) for i, d in zip(selected, distances)]
+
+    def _vector_search_by_vector(self, embedding: list[float]) -> list[tuple[int, float]]:
+        """이미 계산된 쿼리 임베딩으로 FAISS 검색"""
+        k = self.search_kwargs.get("k", RETRIEVER_K)
+        if self.search_type == "mmr" and self._is_lossy_index():
+            hits = self._exact_mmr_search(
+                embedding,
+                k,
+                self.search_kwargs.get("fetch_k", RETRIEVER_FETCH_K),
+                self.search_kwargs.get("lambda_mult", RETRIEVER_LAMBDA),
+            )
+            if hits is not None:
+                return hits
+        with self._vector_lock:
+            if self.search_type == "mmr":
+                docs_and_scores = self.vectorstore.max_marginal_relevance_search_with_score_by_vector(
+                    embedding,
+                    k=k,
+                    fetch_k=self.search_kwargs.get("fetch_k", RETRIEVER_FETCH_K),
+                    lambda_mult=self.search_kwargs.get("lambda_mult", RETRIEVER_LAMBDA),
+                )
+            else:
+                docs_and_scores = self.vectorstore.similarity_search_with_score_by_vector(embedding, k=k)
+        return [(d.metadata["chunk_id"], -float(score)) for d, score in docs_and_scores]
+
+    def search_legs(
+        self,
+        query: str,
+        k: int = 10,
+        embedding: list[float] | None = None,
+        bm25_stats: dict | None = None,
+    ) -> tuple[list[tuple[int, float]], list[tuple[int, float]]]:
+        """
+        벡터 검색과 BM25 검색을 각각 실행해 결합 전 결과를 반환
+
+        Args:
+            query: 검색 쿼리
+            k: BM25 후보 개수
+            embedding: 미리 계산된 쿼리 임베딩 (없으면 여기서 계산)
+            bm25_stats: 코퍼스 통합 BM25 통계 (DocumentCorpus에서 전달)
+
+        Returns:
+            (벡터 결과, BM25 결과) - 각각 (청크 id, 원점수) 리스트
+        """
+        # 1. 벡터 기반 검색 (MMR 적용)
+        try:
+            vector_hits = self._vector_search(query, embedding)
+        except Exception as e:
+            print(f"Vector search error: {e}")
+            vector_hits = []
+
+        # 2. BM25 기반 검색
+        try:
+            bm25_hits = self.bm25_retriever.retrieve_with_scores(query, k=k, stats=bm25_stats)
+        except Exception as e:
+            print(f"BM25 search error: {e}")
+            bm25_hits = []
+        return vector_hits, bm25_hits
+
+    def retrieve_with_scores(self, query: str, k: int = 10) -> list[tuple[Document, float]]:
+        """
+        하이브리드 검색 결과를 결합 점수와 함께 반환
+
+        Args:
+            query: 검색 쿼리
+            k: 반환할 상위 문서 개수
+
+        Returns:
+            (Document, 결합 점수) 리스트 (점수 내림차순)
+        """
+        vector_hits, bm25_hits = self.search_legs(query, k=k)
+        # 실제 점수 기반 결합 후 상위 k개
+        return self._fuse(vector_hits, bm25_hits, k)
+
+    def _fuse(self, vector_hits: list, bm25_hits: list, k: int) -> list[tuple[Document, float]]:
+        fused = fuse_scores(
+            vector_hits,
+            bm25_hits,
+            vector_weight=self.vector_weight,
+            bm25_weight=self.bm25_weight,
+            mode=self.fusion_mode,
+        )
+        return [(self.documents[chunk_id], score) for chunk_id, score in fused[:k]]
+
+    async def asearch_legs(
+        self,
+        query: str,
+        k: int = 10,
+        embedding: list[float] | None = None,
+        bm25_stats: dict | None = None,
+    ) -> tuple[list[tuple[int, float]], list[tuple[int, float]]]:
+        """
+        search_legs의 비동기 버전: 벡터 검색과 BM25 검색을 동시에 실행
+
+        쿼리 임베딩, FAISS 검색, BM25 점수 계산 모두 스레드 풀에서 실행해
+        이벤트 루프를 막지 않습니다.
+        (임베딩의 비동기 API는 공유 httpx 클라이언트가 처음 만든 이벤트 루프에 묶여,
+         대화 턴마다 asyncio.run()을 새로 호출하면 두 번째 턴부터 실패하므로 동기 API 사용)
+        """
+        async def _vector_leg():
+            if self.vectorstore is None:
+                return await asyncio.to_thread(self._vector_search, query)
+            vector = embedding if embedding is not None else await asyncio.to_thread(self.embeddings.embed_query, query)
+            return await asyncio.to_thread(self._vector_search_by_vector, vector)
+
+        vector_hits, bm25_hits = await asyncio.gather(
+            _vector_leg(),
+            asyncio.to_thread(self.bm25_retriever.retrieve_with_scores, query, k, bm25_stats),
+            return_exceptions=True,
+        )
+        if isinstance(vector_hits, Exception):
+            print(f"Vector search error: {vector_hits}")
+            vector_hits = []
+        if isinstance(bm25_hits, Exception):
+            print(f"BM25 search error: {bm25_hits}")
+            bm25_hits = []
+        return vector_hits, bm25_hits
+
+    async def aretrieve_with_scores(
+        self, query: str, k: int = 10, embedding: list[float] | None = None
+    ) -> list[tuple[Document, float]]:
+        """
+        비동기 하이브리드 검색
+
+        Args:
+            query: 검색 쿼리
+            k: 반환할 상위 문서 개수
+            embedding: 미리 계산된 쿼리 임베딩 (배치 임베딩 시 사용)
+
+        Returns:
+            (Document, 결합 점수) 리스트 (점수 내림차순)
+        """
+        vector_hits, bm25_hits = await self.asearch_legs(query, k=k, embedding=embedding)
+        return self._fuse(vector_hits, bm25_hits, k)
+
+    async def abatch_retrieve_with_scores(
+        self, queries: list[str], k: int = 10
+    ) -> list[list[tuple[Document, float]]]:
+        """
+        여러 쿼리를 한 번의 임베딩 요청으로 묶어 동시에 검색
+
+        Args:
+            queries: 검색 쿼리 리스트
+            k: 쿼리별 반환 문서 개수
+
+        Returns:
+            쿼리 순서대로의 (Document, 결합 점수) 리스트
+        """
+        embeddings = [None] * len(queries)
+        if self.vectorstore is not None and queries:
+            try:
+                embeddings = await asyncio.to_thread(self.embeddings.embed_documents, list(queries))
+            except Exception as e:
+                # 배치 임베딩 실패 시 쿼리별 임베딩으로 진행
+                print(f"Batch query embedding error: {e}")
+        return await asyncio.gather(*[
+            self.aretrieve_with_scores(q, k=k, embedding=e) for q, e in zip(queries, embeddings)
+        ])
+
+    def retrieve(self, query: str, k: int = 10) -> list[Document]:
+        """
+        하이브리드 검색: 벡터 검색과 BM25 검색의 결과를 가중 합산
+        
+        Args:
+            query: 검색 쿼리
+            k: 반환할 상위 문서 개수
+        
+        Returns:
+            하이브리드 검색 결과 (점수 기반 정렬)
+        """
+        return [doc for doc, _ in self.retrieve_with_scores(query, k=k)]
+    
+    async def ainvoke(self, query: str, k: int = 10) -> list[Document]:
+        """비동기 버전의 retrieve 메서드"""
+        return [doc for doc, _ in await self.aretrieve_with_scores(query, k=k)]
+    
+    def invoke(self, query: str, k: int = 10) -> list[Document]:
+        """RunnableLambda 호환 인터페이스"""
+        return self.retrieve(query, k=k)
+
+
+# =========================
+# 여러 문서 코퍼스 (문서별 샤드)
+# =========================
+# 샤드 검색 전용 스레드 풀 (FAISS/numpy 연산은 GIL을 놓으므로 샤드 간 병렬 실행됨)
+_corpus_executor = ThreadPoolExecutor(max_workers=CORPUS_MAX_WORKERS, thread_name_prefix="corpus-search")
+
+
+class DocumentCorpus:
+    """
+    문서별 HybridRetriever(샤드)를 묶어 하나의 검색기처럼 사용하는 코퍼스
+
+    샤드마다 FAISS + BM25 인덱스를 따로 가지며, 문서 해시별로 따로 캐시/인덱싱됩니다.
+    쿼리 임베딩은 한 번만 계산해 모든 샤드에 동시에 보내고(fan-out), 샤드별 벡터/BM25 결과를
+    (샤드 번호, 청크 id) 키로 모아 한 번에 결합한 뒤 전체 상위 k개를 고릅니다.
+    HybridRetriever와 같은 검색 인터페이스를 제공하므로 체인/재정렬기/추측 검색에 그대로 사용됩니다.
+    """
+
+    def __init__(
+        self,
+        shards: list[HybridRetriever],
+        vector_weight: float = VECTOR_WEIGHT,
+        bm25_weight: float = BM25_WEIGHT,
+        fusion_mode: str = FUSION_MODE,
+    ):
+        """
+        Args:
+            shards: 문서별 HybridRetriever 리스트 (같은 임베딩 모델로 인덱싱되어 있어야 함)
+            vector_weight: 벡터 검색의 가중치
+            bm25_weight: BM25 검색의 가중치
+            fusion_mode: 점수 결합 방식 ("minmax", "zscore", "rrf")
+        """
+        if not shards:
+            raise ValueError("코퍼스에는 문서가 하나 이상 필요합니다.")
+        self.shards = list(shards)
+        self.vector_weight = vector_weight
+        self.bm25_weight = bm25_weight
+        self.fusion_mode = fusion_mode
+
+    @property
+    def embeddings(self):
+        """쿼리 임베딩에 사용하는 Embeddings 객체 (모든 샤드가 같은 모델 사용)"""
+        return self.shards[0].embeddings
+
+    @property
+    def pages(self) -> list[Document]:
+        """모든 샤드의 페이지 (샤드 순서, 인덱싱 중인 샤드는 현재까지의 페이지)"""
+        return [page for shard in self.shards for page in shard.pages]
+
+    @property
+    def ingest_status(self) -> dict:
+        """샤드별 인덱싱 상태 합계 (모든 샤드가 끝나야 done)"""
+        statuses = [shard.ingest_status for shard in self.shards]
+        errors = [status["error"] for status in statuses if status.get("error")]
+        return {
+            "done": all(status["done"] for status in statuses),
+            "pages": sum(status["pages"] for status in statuses),
+            "total_pages": sum(status["total_pages"] for status in statuses),
+            "chunks": sum(status["chunks"] for status in statuses),
+            "error": "; ".join(errors) or None,
+        }
+
+    def _bm25_stats(self, query: str) -> dict | None:
+        """
+        모든 샤드를 하나의 코퍼스로 본 BM25 통계
+
+        샤드마다 IDF와 평균 문서 길이가 달라 샤드별 원점수는 서로 비교할 수 없으므로,
+        모든 샤드를 같은 통계로 채점해 합친 BM25 결과가 한 인덱스의 점수처럼 정렬되게 합니다.
+        """
+        try:
+            return BM25Index.shared_stats(
+                [segment for shard in self.shards for segment in shard.bm25_retriever.segments],
+                BM25Retriever.tokenize(query),
+            )
+        except Exception as e:
+            print(f"BM25 stats error: {e}")
+            return None
+
+    def optimize_vector_indexes(self, index_type: str = FAISS_INDEX_TYPE) -> str:
+        """
+        코퍼스 전체 벡터 수로 인덱스 종류를 정해 모든 샤드에 적용
+
+        쿼리마다 모든 샤드를 검색하므로 검색 비용은 샤드 하나가 아니라 코퍼스 전체 벡터 수에
+        비례합니다. 샤드별 벡터 수로 고르면 작은 문서 여러 개로 이루어진 큰 코퍼스가
+        계속 flat으로 남으므로, 인덱싱이 끝난 샤드들의 합계로 한 번에 정합니다.
+        백그라운드 인덱싱 중인 샤드는 끝날 때까지 기다리고, 실패한 샤드는 건너뜁니다.
+        다른 코퍼스가 이미 종류를 정한 샤드는 그대로 둡니다 (HybridRetriever.settle_vector_index).
+
+        Args:
+            index_type: "auto" 또는 VECTOR_INDEX_TYPES 중 하나
+
+        Returns:
+            이 코퍼스가 정한 인덱스 종류
+        """
+        for shard in self.shards:
+            if shard.ingest_thread is not None:
+                shard.ingest_thread.join()
+        shards = [shard for shard in self.shards if shard.ingest_status["done"] and shard.vectorstore is not None]
+        if index_type == "auto":
+            index_type = choose_index_type(sum(shard.vectorstore.index.ntotal for shard in shards))
+        for shard in shards:
+            try:
+                shard.settle_vector_index(index_type)
+            except Exception as e:
+                print(f"Vector index conversion error: {e}")
+        return index_type
+
+    @staticmethod
+    def _merge_legs(legs: list[tuple[list, list]]) -> tuple[list, list]:
+        """샤드별 (벡터 결과, BM25 결과)를 (샤드 번호, 청크 id) 키로 합쳐 점수순 정렬"""
+        vector_hits, bm25_hits = [], []
+        for shard_idx, (shard_vector_hits, shard_bm25_hits) in enumerate(legs):
+            vector_hits.extend(((shard_idx, chunk_id), score) for chunk_id, score in shard_vector_hits)
+            bm25_hits.extend(((shard_idx, chunk_id), score) for chunk_id, score in shard_bm25_hits)
+        # RRF는 목록 순서를 순위로 사용하므로 전체 점수순으로 정렬
+        vector_hits.sort(key=lambda hit: hit[1], reverse=True)
+        bm25_hits.sort(key=lambda hit: hit[1], reverse=True)
+        return vector_hits, bm25_hits
+
+    def _fuse(self, vector_hits: list, bm25_hits: list, k: int) -> list[tuple[Document, float]]:
+        fused = fuse_scores(
+            vector_hits,
+            bm25_hits,
+            vector_weight=self.vector_weight,
+            bm25_weight=self.bm25_weight,
+            mode=self.fusion_mode,
+        )
+        return [
+            (self.shards[shard_idx].documents[chunk_id], score)
+            for (shard_idx, chunk_id), score in fused[:k]
+        ]
+
+    def search_legs(self, query: str, k: int = 10, embedding: list[float] | None = None) -> tuple[list, list]:
+        """
+        모든 샤드에서 벡터/BM25 검색을 동시에 실행하고 결과를 합침
+
+        Args:
+            query: 검색 쿼리
+            k: 샤드별 후보 개수
+            embedding: 미리 계산된 쿼리 임베딩 (없으면 한 번만 계산해 모든 샤드에 사용)
+
+        Returns:
+            (벡터 결과, BM25 결과) - 각각 ((샤드 번호, 청크 id), 원점수) 리스트
+        """
+        if embedding is None and self.embeddings is not None:
+            try:
+                embedding = self.embeddings.embed_query(query)
+            except Exception as e:
+                print(f"Query embedding error: {e}")
+        bm25_stats = self._bm25_stats(query)
+        futures = [
+            _corpus_executor.submit(shard.search_legs, query, k, embedding, bm25_stats)
+            for shard in self.shards
+        ]
+        return self._merge_legs([future.result() for future in futures])
+
+    async def asearch_legs(self, query: str, k: int = 10, embedding: list[float] | None = None) -> tuple[list, list]:
+        """search_legs의 비동기 버전"""
+        if embedding is None and self.embeddings is not None:
+            try:
+                embedding = await asyncio.to_thread(self.embeddings.embed_query, query)
+            except Exception as e:
+                print(f"Query embedding error: {e}")
+        bm25_stats = self._bm25_stats(query)
+        legs = await asyncio.gather(
+            *[shard.asearch_legs(query, k, embedding, bm25_stats) for shard in self.shards]
+        )
+        return self._merge_legs(legs)
+
+    def retrieve_with_scores(self, query: str, k: int = 10) -> list[tuple[Document, float]]:
+        """
+        전체 샤드 검색 결과를 결합 점수와 함께 반환
+
+        Args:
+            query: 검색 쿼리
+            k: 반환할 전체 상위 문서 개수
+
+        Returns:
+            (Document, 결합 점수) 리스트 (점수 내림차순)
+        """
+        vector_hits, bm25_hits = self.search_legs(query, k=k)
+        return self._fuse(vector_hits, bm25_hits, k)
+
+    async def aretrieve_with_scores(
+        self, query: str, k: int = 10, embedding: list[float] | None = None
+    ) -> list[tuple[Document, float]]:
+        """retrieve_with_scores의 비동기 버전 (embedding: 미리 계산된 쿼리 임베딩)"""
+        vector_hits, bm25_hits = await self.asearch_legs(query, k=k, embedding=embedding)
+        return self._fuse(vector_hits, bm25_hits, k)
+
+    async def abatch_retrieve_with_scores(
+        self, queries: list[str], k: int = 10
+    ) -> list[list[tuple[Document, float]]]:
+        """여러 쿼리를 한 번의 임베딩 요청으로 묶어 동시에 검색"""
+        embeddings = [None] * len(queries)
+        if self.embeddings is not None and queries:
+            try:
+                embeddings = await asyncio.to_thread(self.embeddings.embed_documents, list(queries))
+            except Exception as e:
+                print(f"Batch query embedding error: {e}")
+        return await asyncio.gather(*[
+            self.aretrieve_with_scores(q, k=k, embedding=e) for q, e in zip(queries, embeddings)
+        ])
+
+    def _shard_of(self, doc: Document) -> int | None:
+        """검색 결과 문서가 속한 샤드 번호 (샤드의 청크 객체와 같은지로 판단)"""
+        chunk_id = doc.metadata.get("chunk_id")
+        if isinstance(chunk_id, int):
+            for shard_idx, shard in enumerate(self.shards):
+                if chunk_id < len(shard.documents) and shard.documents[chunk_id] is doc:
+                    return shard_idx
+        return None
+
+    def vectors_for_docs(self, docs: list[Document]) -> np.ndarray | None:
+        """
+        검색 결과 문서들의 청크 임베딩을 각 문서가 속한 샤드에서 조회
+
+        Args:
+            docs: 이 코퍼스가 반환한 Document 리스트
+
+        Returns:
+            (문서 수, 차원) 배열 (조회할 수 없는 문서가 있으면 None)
+        """
+        positions = {}  # 샤드 번호 -> 결과 내 위치 리스트
+        for pos, doc in enumerate(docs):
+            shard_idx = self._shard_of(doc)
+            if shard_idx is None:
+                return None
+            positions.setdefault(shard_idx, []).append(pos)
+
+        vectors = [None] * len(docs)
+        for shard_idx, shard_positions in positions.items():
+            found = self.shards[shard_idx].vectors_for_docs([docs[pos] for pos in shard_positions])
+            if found is None:
+                return None
+            for pos, vector in zip(shard_positions, found):
+                vectors[pos] = vector
+        return np.vstack(vectors) if vectors else None
+
+    def retrieve(self, query: str, k: int = 10) -> list[Document]:
+        return [doc for doc, _ in self.retrieve_with_scores(query, k=k)]
+
+    async def ainvoke(self, query: str, k: int = 10) -> list[Document]:
+        """비동기 버전의 retrieve 메서드"""
+        return [doc for doc, _ in await self.aretrieve_with_scores(query, k=k)]
+
+    def invoke(self, query: str, k: int = 10) -> list[Document]:
+        """RunnableLambda 호환 인터페이스"""
+        return self.retrieve(query, k=k)
+
+
+async def _aretrieve_docs(retriever, query: str) -> list[Document]:
+    """검색기 종류에 맞는 비동기 검색 호출"""
+    if hasattr(retriever, "ainvoke"):
+        return await retriever.ainvoke(query)
+    if hasattr(retriever, "aget_relevant_documents"):
+        return await retriever.aget_relevant_documents(query)
+    return await asyncio.to_thread(retriever.get_relevant_documents, query)
+
+
+def _dedupe_docs(doc_lists) -> list[Document]:
+    """
+    여러 검색 결과를 앞 순서를 유지하며 중복 없이 합침
+
+    인덱싱 시 부여한 정수 청크 id(metadata["chunk_id"])로 비교하므로 본문을 해시하지 않습니다.
+    청크 id는 문서마다 0부터 시작하므로 여러 문서 코퍼스에서는 문서 키(문서 해시)와 함께 비교합니다.
+    id가 없는 문서(외부 검색기 결과)만 (문서 키, 페이지, 본문)으로 비교합니다.
+    """
+    seen_ids = set()
+    seen_other = set()
+    merged = []
+    for docs in doc_lists:
+        for d in docs:
+            chunk_id = d.metadata.get("chunk_id")
+            if isinstance(chunk_id, int):
+                key = (doc_key(d), chunk_id)
+                if key in seen_ids:
+                    continue
+                seen_ids.add(key)
+            else:
+                key = (doc_key(d), d.metadata.get("page"), d.page_content)
+                if key in seen_other:
+                    continue
+                seen_other.add(key)
+            merged.append(d)
+    return merged
+
+
+async def retrieve_docs_for_queries(retriever, queries: list[str]) -> list:
+    if hasattr(retriever, "abatch_retrieve_with_scores"):
+        # 확장 쿼리 전체를 한 번의 임베딩 요청으로 묶어 동시에 검색
+        scored = await retriever.abatch_retrieve_with_scores(queries)
+        results = [[doc for doc, _ in hits] for hits in scored]
+    else:
+        tasks = [_aretrieve_docs(retriever, q) for q in queries]
+        results = await asyncio.gather(*tasks)
+
+    return _dedupe_docs(results)
+
+
+# 쿼리 확장 전용 스레드 풀
+# (asyncio.run()은 기본 실행기의 스레드 종료를 기다리므로, 마감 시간을 넘긴 확장 호출이
+#  응답을 붙잡지 않도록 별도 실행기 사용)
+_speculative_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="query-expansion")
+
+
+async def speculative_retrieve(
+    retriever,
+    query: str,
+    expand_fn=None,
+    deadline: float = EXPANSION_DEADLINE,
+) -> list[Document]:
+    """
+    쿼리 확장과 원본 질문 검색을 겹쳐 실행하는 추측 검색
+
+    확장 LLM 호출을 시작하자마자 원본 질문으로 하이브리드 검색을 수행하고,
+    확장 쿼리가 마감 시간 안에 도착하면 그 검색 결과를 뒤에 합칩니다.
+    마감 시간을 넘긴 확장/검색 결과는 버리고 원본 결과만 반환합니다.
+    (늦게 끝난 확장 결과도 expansion_cache에는 저장되어 다음 질문에서 재사용됨)
+
+    Args:
+        retriever: 검색기 (HybridRetriever 또는 DocumentCorpus 권장)
+        query: 원본 질문
+        expand_fn: 질문 -> [원본, 확장 쿼리...]를 반환하는 함수 (기본값: query_expansion)
+        deadline: 시작 시점부터 확장 결과를 기다리는 최대 시간(초)
+
+    Returns:
+        원본 검색 결과 + 확장 쿼리 검색 결과 (중복 제거)
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    expand_fn = expand_fn or query_expansion
+
+    def remaining() -> float:
+        return max(0.0, deadline - (loop.time() - started))
+
+    expansion = loop.run_in_executor(_speculative_executor, expand_fn, query)
+    primary = await _aretrieve_docs(retriever, query)
+
+    try:
+        expanded = await asyncio.wait_for(expansion, remaining())
+    except asyncio.TimeoutError:
+        logger.info("query expansion missed the %.1fs deadline, using original results only", deadline)
+        return primary
+    except Exception as e:
+        print(f"Query expansion error: {e}")
+        return primary
+
+    extra = [q for q in dict.fromkeys(expanded) if q != query]
+    if not extra:
+        return primary
+
+    # 확장 쿼리는 한 번의 임베딩 요청으로 묶고 검색은 동시에 진행
+    scored = hasattr(retriever, "aretrieve_with_scores")
+    embeddings = getattr(retriever, "embeddings", None) if scored else None
+    query_vectors = [None] * len(extra)
+    if embeddings is not None:
+        try:
+            # 마감 시간을 넘겨도 asyncio.run()이 기다리지 않도록 전용 실행기에서 동기 API 호출
+            query_vectors = await asyncio.wait_for(
+                loop.run_in_executor(_speculative_executor, embeddings.embed_documents, extra),
+                remaining(),
+            )
+        except asyncio.TimeoutError:
+            logger.info("expanded query embedding missed the deadline")
+            return primary
+        except Exception as e:
+            print(f"Batch query embedding error: {e}")
+
+    if scored:
+        tasks = [
+            asyncio.ensure_future(retriever.aretrieve_with_scores(q, embedding=v))
+            for q, v in zip(extra, query_vectors)
+        ]
+    else:
+        tasks = [asyncio.ensure_future(_aretrieve_docs(retriever, q)) for q in extra]
+
+    done, pending = await asyncio.wait(tasks, timeout=remaining())
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.info("dropped %d expanded query results after the deadline", len(pending))
+
+    results = [primary]
+    for task in tasks:
+        if task not in done or task.exception() is not None:
+            continue
+        hits = task.result()
+        results.append([doc for doc, _ in hits] if scored else hits)
+    return _dedupe_docs(results)
+
+
+# =========================
+# SQLite LRU 저장소
+# =========================
+class SQLiteLRUStore:
+    """
+    키-값을 SQLite 테이블에 저장하고 항목 수 상한을 LRU로 유지하는 저장소
+
+    임베딩 캐시와 페이지 요약 캐시가 공유합니다. 여러 Streamlit 프로세스가 같은 파일을
+    동시에 읽고 쓸 수 있도록 WAL 모드를 쓰고, 연결은 작업마다 열고 닫습니다.
+    항목 수가 max_entries를 넘으면 마지막 사용 시각이 오래된 것부터 삭제합니다.
+    """
+
+    def __init__(self, db_path: str, table: str, value_column: str, value_type: str, max_entries: int):
+        """
+        Args:
+            db_path: SQLite 파일 경로
+            table: 테이블 이름
+            value_column: 값 컬럼 이름
+            value_type: 값 컬럼 타입 ("BLOB" 또는 "TEXT")
+            max_entries: 최대 저장 항목 수
+        """
+        self.db_path = db_path
+        self.table = table
+        self.value_column = value_column
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._init_db(value_type)
+
+    def _connect(self) -> sqlite3.Connection:
+        # with conn:은 커밋/롤백만 하고 연결을 닫지 않으므로 사용하는 쪽에서 closing()으로 감쌈
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _init_db(self, value_type: str):
+        """테이블과 마지막 사용 시각 인덱스 초기화"""
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key TEXT PRIMARY KEY,
+                    {self.value_column} {value_type} NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{self.table}_last_access ON {self.table} (last_access)"
+            )
+
+    def get_many(self, keys: list[str]) -> dict:
+        """
+        키 목록 조회 (찾은 항목은 마지막 사용 시각 갱신)
+
+        Args:
+            keys: 조회할 키 리스트
+
+        Returns:
+            {키: 값} (없는 키는 제외)
+        """
+        found = {}
+        with self._lock, closing(self._connect()) as conn, conn:
+            # SQLite 변수 개수 제한을 피하기 위해 나눠서 조회
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                marks = ",".join("?" * len(part))
+                rows = conn.execute(
+                    f"SELECT key, {self.value_column} FROM {self.table} WHERE key IN ({marks})", part
+                ).fetchall()
+                found.update(rows)
+                if rows:
+                    conn.execute(
+                        f"UPDATE {self.table} SET last_access = ? WHERE key IN ({marks})",
+                        [time.time(), *part],
+                    )
+
+            hit_count = sum(1 for k in keys if k in found)
+            self.hits += hit_count
+            self.misses += len(keys) - hit_count
+        return found
+
+    def put_many(self, items: list[tuple[str, object]]) -> None:
+        """
+        (키, 값) 저장 후 용량 초과 시 오래 사용되지 않은 항목 삭제
+
+        Args:
+            items: (키, 값) 리스트
+        """
+        if not items:
+            return
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, {self.value_column}, last_access) VALUES (?, ?, ?)",
+                [(key, value, now) for key, value in items],
+            )
+            count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    f"""
+                    DELETE FROM {self.table} WHERE key IN (
+                        SELECT key FROM {self.table} ORDER BY last_access ASC LIMIT ?
+                    )
+                    """,
+                    (count - self.max_entries,),
+                )
+
+    def stats(self) -> dict:
+        """적중/미스 통계"""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+
+# =========================
+# 임베딩 캐시
+# =========================
+class CachedEmbeddings(Embeddings):
+    """
+    SQLite 기반 임베딩 캐시 래퍼
+
+    (모델명 + 텍스트) 해시를 키로 벡터를 저장하므로, 수정된 문서를 다시 인덱싱해도
+    바뀐 청크만 실제 임베딩 API를 호출합니다. 문서 임베딩과 쿼리 임베딩 모두에 적용되며,
+    항목 수가 max_entries를 넘으면 마지막 사용 시각이 오래된 것부터 삭제합니다.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str = EMBEDDING_MODEL,
+        db_path: str = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+    ):
+        """
+        Args:
+            embeddings: 실제 임베딩을 계산할 Embeddings 객체 (예: OpenAIEmbeddings)
+            model_name: 캐시 키에 포함할 모델 이름
+            db_path: SQLite 파일 경로
+            max_entries: 최대 저장 항목 수
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.store_db = SQLiteLRUStore(db_path, "embeddings", "vector", "BLOB", max_entries)
+
+    def _key(self, text: str) -> str:
+        return sha256(f"{self.model_name}\0{text}".encode()).hexdigest()
+
+    def lookup(self, texts: list[str]) -> list[list[float] | None]:
+        """
+        캐시에서 벡터 조회 (없는 항목은 None)
+
+        Args:
+            texts: 조회할 텍스트 리스트
+
+        Returns:
+            texts와 같은 순서의 벡터 리스트
+        """
+        if not texts:
+            return []
+        keys = [self._key(t) for t in texts]
+        found = self.store_db.get_many(keys)
+        return [
+            np.frombuffer(found[k], dtype=np.float32).tolist() if k in found else None
+            for k in keys
+        ]
+
+    def store(self, texts: list[str], vectors: list[list[float]]) -> None:
+        """
+        벡터를 캐시에 저장하고 용량 초과 시 LRU 삭제
+
+        Args:
+            texts: 텍스트 리스트
+            vectors: texts와 같은 순서의 벡터 리스트
+        """
+        if not texts:
+            return
+        self.store_db.put_many(
+            [(self._key(t), np.asarray(v, dtype=np.float32).tobytes()) for t, v in zip(texts, vectors)]
+        )
+
+    def _merge(self, texts: list[str], cached: list, missing_texts: list[str], new_vectors: list) -> list[list[float]]:
+        """캐시 결과와 새로 계산한 벡터를 원래 순서로 합침"""
+        computed = dict(zip(missing_texts, new_vectors))
+        return [v if v is not None else computed[t] for t, v in zip(texts, cached)]
+
+    @staticmethod
+    def _missing_texts(texts: list[str], cached: list) -> list[str]:
+        # 같은 배치 안의 중복 텍스트는 한 번만 임베딩
+        return list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        cached = self.lookup(texts)
+        missing = self._missing_texts(texts, cached)
+        new_vectors = self.embeddings.embed_documents(missing) if missing else []
+        self.store(missing, new_vectors)
+        return self._merge(texts, cached, missing, new_vectors)
+
+    def embed_query(self, text: str) -> list[float]:
+        cached = self.lookup([text])[0]
+        if cached is not None:
+            return cached
+        vector = self.embeddings.embed_query(text)
+        self.store([text], [vector])
+        return vector
+
+    # 비동기 버전도 동기 API를 스레드에서 호출
+    # (OpenAIEmbeddings의 비동기 클라이언트는 처음 사용한 이벤트 루프에 묶여
+    #  asyncio.run()을 반복 호출하는 환경에서 "Event loop is closed"로 실패)
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await asyncio.to_thread(self.embed_query, text)
+
+    def stats(self) -> dict:
+        """캐시 적중/미스 통계"""
+        return self.store_db.stats()
+
+
+_shared_embeddings = None
+_shared_embeddings_lock = threading.Lock()
+
+
+def get_embeddings() -> CachedEmbeddings:
+    """
+    프로세스 전체에서 공유하는 캐시 임베딩 객체 반환
+    (적중/미스 카운터도 세션 간에 누적됨)
+    """
+    global _shared_embeddings
+    with _shared_embeddings_lock:
+        if _shared_embeddings is None:
+            _shared_embeddings = CachedEmbeddings(OpenAIEmbeddings(model=EMBEDDING_MODEL))
+        return _shared_embeddings
+
+
+# =========================
+# 병렬 임베딩 (인덱싱 파이프라인)
+# =========================
+_token_encoder = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    텍스트의 토큰 수 계산 (tiktoken 사용, 없으면 글자 수 기반 근사치)
+
+    Args:
+        text: 토큰 수를 셀 텍스트
+
+    Returns:
+        토큰 수
+    """
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            import tiktoken
+            _token_encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _token_encoder = False
+    if _token_encoder:
+        return len(_token_encoder.encode(text, disallowed_special=()))
+    # 한국어는 대략 2글자당 1토큰
+    return max(1, len(text) // 2)
+
+
+class TokenBucket:
+    """
+    토큰 버킷 속도 제한기 (스레드 안전)
+
+    초당 rate만큼 토큰이 채워지며, acquire()는 필요한 토큰이 모일 때까지 대기합니다.
+    """
+
+    def __init__(self, rate_per_sec: float, capacity: float | None = None):
+        """
+        Args:
+            rate_per_sec: 초당 충전되는 토큰 수
+            capacity: 버킷 최대 용량 (기본값: 1초 분량)
+        """
+        self.rate = rate_per_sec
+        self.capacity = capacity if capacity is not None else rate_per_sec
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> None:
+        # 용량보다 큰 요청은 버킷이 가득 찼을 때 통과시킴
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def call_with_retries(fn, *args, retries: int = EMBED_MAX_RETRIES, base_delay: float = 1.0):
+    """
+    실패 시 지수 백오프로 재시도하며 함수 호출
+
+    Args:
+        fn: 호출할 함수
+        *args: 함수 인자
+        retries: 최대 재시도 횟수
+        base_delay: 첫 재시도 대기 시간(초), 이후 2배씩 증가
+
+    Returns:
+        fn의 반환값 (마지막 시도까지 실패하면 예외 전파)
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"Retry {attempt + 1}/{retries} after error: {e}")
+            time.sleep(base_delay * (2 ** attempt))
+
+
+def make_token_batches(texts: list[str], max_tokens: int) -> list[list[int]]:
+    """
+    텍스트 인덱스를 토큰 수 한도 내의 배치로 묶음 (순서 유지)
+
+    Args:
+        texts: 텍스트 리스트
+        max_tokens: 배치당 최대 토큰 수
+
+    Returns:
+        배치별 인덱스 리스트
+    """
+    batches, current, current_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        n = count_tokens(text)
+        if current and current_tokens + n > max_tokens:
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += n
+    if current:
+        batches.append(current)
+    return batches
+
+
+# 임베딩 요청 공유 실행기/속도 제한기
+# (호출마다 새로 만들면 배치·문서를 넘어 동시 요청 수와 분당 토큰 한도가 지켜지지 않으므로
+#  모든 embed_texts_concurrently 호출이 같은 한도를 나눠 씀)
+_embed_executor = ThreadPoolExecutor(max_workers=EMBED_MAX_IN_FLIGHT, thread_name_prefix="embedding")
+_embed_rate_limiter = TokenBucket(
+    EMBED_TOKENS_PER_MINUTE / 60.0, capacity=max(EMBED_BATCH_TOKENS, EMBED_TOKENS_PER_MINUTE / 60.0)
+)
+
+
+def embed_texts_concurrently(
+    texts: list[str],
+    embeddings: Embeddings,
+    batch_tokens: int = EMBED_BATCH_TOKENS,
+    max_retries: int = EMBED_MAX_RETRIES,
+    progress_callback=None,
+    executor: ThreadPoolExecutor | None = None,
+    rate_limiter: TokenBucket | None = None,
+) -> list[list[float]]:
+    """
+    청크 텍스트를 토큰 한도 배치로 나눠 병렬로 임베딩
+
+    CachedEmbeddings인 경우 캐시에 있는 청크는 요청하지 않으며,
+    결과는 입력과 같은 순서로 반환됩니다.
+    요청은 공유 실행기(EMBED_MAX_IN_FLIGHT)와 공유 속도 제한기(EMBED_TOKENS_PER_MINUTE)를 거치므로
+    여러 스레드에서 동시에 호출해도 전체 한도를 넘지 않습니다.
+
+    Args:
+        texts: 임베딩할 텍스트 리스트
+        embeddings: Embeddings 객체 (CachedEmbeddings 권장)
+        batch_tokens: 요청 1건의 최대 토큰 수
+        max_retries: 배치별 재시도 횟수
+        progress_callback: (완료 청크 수, 전체 청크 수)를 받는 함수.
+            호출한 스레드에서 실행되므로 Streamlit 위젯을 직접 갱신해도 됨
+        executor: 요청 실행기 (기본값: 공유 실행기)
+        rate_limiter: 토큰 버킷 (기본값: 공유 속도 제한기)
+
+    Returns:
+        texts와 같은 순서의 벡터 리스트
+    """
+    executor = executor or _embed_executor
+    bucket = rate_limiter or _embed_rate_limiter
+    total = len(texts)
+    if isinstance(embeddings, CachedEmbeddings):
+        vectors = embeddings.lookup(texts)
+        embed_fn = embeddings.embeddings.embed_documents
+    else:
+        vectors = [None] * total
+        embed_fn = embeddings.embed_documents
+
+    pending = [i for i, v in enumerate(vectors) if v is None]
+    done = total - len(pending)
+    if progress_callback:
+        progress_callback(done, total)
+    if not pending:
+        return vectors
+
+    batches = [
+        [pending[j] for j in batch]
+        for batch in make_token_batches([texts[i] for i in pending], batch_tokens)
+    ]
+
+    def _embed_batch(indices: list[int]) -> list[list[float]]:
+        batch_texts = [texts[i] for i in indices]
+        bucket.acquire(sum(count_tokens(t) for t in batch_texts))
+        return call_with_retries(embed_fn, batch_texts, retries=max_retries)
+
+    futures = {executor.submit(_embed_batch, batch): batch for batch in batches}
+    try:
+        for future in as_completed(futures):
+            batch = futures[future]
+            batch_vectors = future.result()
+            for i, v in zip(batch, batch_vectors):
+                vectors[i] = v
+            if isinstance(embeddings, CachedEmbeddings):
+                embeddings.store([texts[i] for i in batch], batch_vectors)
+            done += len(batch)
+            if progress_callback:
+                progress_callback(done, total)
+    finally:
+        # 실패/중단 시 아직 시작하지 않은 요청이 공유 실행기를 차지하지 않도록 취소
+        for future in futures:
+            future.cancel()
+
+    return vectors
+
+
+# =========================
+# 페이지별 요약 (병렬 map-reduce)
+# =========================
+PAGE_SUMMARY_PROMPT = ChatPromptTemplate.from_template("""당신은 업로드된 문서의 '해당 페이지'만 정확히 요약하는 어시스턴트입니다.
+이 페이지에 없는 내용은 절대 쓰지 마세요. 외부지식/추측/인터넷 정보도 사용하지 마세요.
+
+[출력 형식]
+## 핵심 요지 (3가지)
+1. (가장 중요한 내용)
+2. (부가 정보)
+3. (주의/예외사항)
+
+## 중요 규정·절차·수치·주의사항
+- 항목 1
+- 항목 2
+(있으면 2~4개)
+
+페이지 내용:
+{page_text}
+
+한국어로 명확하게 작성하세요.
+""")
+
+PACKED_PAGE_SUMMARY_PROMPT = ChatPromptTemplate.from_template("""당신은 업로드된 문서의 여러 페이지를 '페이지마다 따로' 정확히 요약하는 어시스턴트입니다.
+각 페이지 요약에는 그 페이지에 있는 내용만 쓰세요. 다른 페이지 내용을 섞지 말고, 외부지식/추측/인터넷 정보도 사용하지 마세요.
+
+아래에는 {page_count}개의 페이지가 `=== PAGE 번호 ===` 구분선으로 나뉘어 있습니다.
+각 페이지마다 입력과 같은 구분선 줄(`=== PAGE 번호 ===`)을 먼저 쓰고, 그 아래에 다음 형식으로 요약하세요.
+
+[출력 형식]
+## 핵심 요지 (3가지)
+1. (가장 중요한 내용)
+2. (부가 정보)
+3. (주의/예외사항)
+
+## 중요 규정·절차·수치·주의사항
+- 항목 1
+- 항목 2
+(있으면 2~4개)
+
+페이지 내용:
+{pages_text}
+
+한국어로 명확하게 작성하세요.
+""")
+
+_PACKED_PAGE_MARKER = re.compile(r"^\s*=== PAGE (\d+) ===\s*$", re.MULTILINE)
+
+
+def pack_pages(page_texts: list[str], token_budget: int, max_pages: int) -> list[list[int]]:
+    """
+    짧은 페이지를 토큰 한도 내에서 연속으로 묶음 (페이지 순서 유지)
+
+    한도를 넘는 긴 페이지는 단독 요청이 됩니다.
+
+    Args:
+        page_texts: 페이지 텍스트 리스트
+        token_budget: 묶음 1개에 담을 최대 토큰 수
+        max_pages: 묶음 1개에 담을 최대 페이지 수
+
+    Returns:
+        묶음별 페이지 인덱스 리스트
+    """
+    packs, current, current_tokens = [], [], 0
+    for i, text in enumerate(page_texts):
+        n = count_tokens(text)
+        if current and (current_tokens + n > token_budget or len(current) >= max_pages):
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += n
+    if current:
+        packs.append(current)
+    return packs
+
+
+def split_packed_summary(output: str, count: int) -> dict[int, str]:
+    """
+    묶음 요청의 응답을 `=== PAGE 번호 ===` 구분선 기준으로 페이지별로 나눔
+
+    Args:
+        output: LLM 응답 텍스트
+        count: 묶음에 포함된 페이지 수
+
+    Returns:
+        {묶음 내 위치(0부터): 요약} (누락되거나 비어 있는 페이지는 제외)
+    """
+    parts = _PACKED_PAGE_MARKER.split(output or "")
+    result = {}
+    # split 결과: [머리말, 번호, 본문, 번호, 본문, ...]
+    for label, body in zip(parts[1::2], parts[2::2]):
+        pos = int(label) - 1
+        body = body.strip()
+        if 0 <= pos < count and body and pos not in result:
+            result[pos] = body
+    return result
+
+
+class PageSummaryCache:
+    """
+    SQLite 기반 페이지 요약 캐시
+
+    (페이지 본문 해시, 프롬프트 버전, 모델명)을 키로 요약을 저장하므로,
+    같은 문서를 다시 요청하거나 일부만 수정된 문서는 바뀐 페이지만 새로 요약합니다.
+    항목 수가 max_entries를 넘으면 마지막 사용 시각이 오래된 것부터 삭제합니다.
+    """
+
+    def __init__(
+        self,
+        db_path: str = PAGE_SUMMARY_CACHE_PATH,
+        prompt_version: int = PAGE_SUMMARY_PROMPT_VERSION,
+        max_entries: int = PAGE_SUMMARY_CACHE_MAX_ENTRIES,
+    ):
+        """
+        Args:
+            db_path: SQLite 파일 경로
+            prompt_version: 캐시 키에 포함할 요약 프롬프트 버전
+            max_entries: 최대 저장 항목 수
+        """
+        self.prompt_version = prompt_version
+        self.store_db = SQLiteLRUStore(db_path, "page_summaries", "summary", "TEXT", max_entries)
+
+    def _key(self, page_text: str, model_name: str) -> str:
+        page_hash = sha256(page_text.encode()).hexdigest()
+        return sha256(f"{page_hash}\0{self.prompt_version}\0{model_name}".encode()).hexdigest()
+
+    def lookup(self, page_texts: list[str], model_name: str) -> list[str | None]:
+        """
+        캐시에서 요약 조회 (없는 항목은 None)
+
+        Args:
+            page_texts: 페이지 본문 리스트
+            model_name: 요약 모델 이름
+
+        Returns:
+            page_texts와 같은 순서의 요약 리스트
+        """
+        if not page_texts:
+            return []
+        keys = [self._key(t, model_name) for t in page_texts]
+        found = self.store_db.get_many(keys)
+        return [found.get(k) for k in keys]
+
+    def store(self, page_texts: list[str], summaries: list[str], model_name: str) -> None:
+        """
+        요약을 캐시에 저장하고 용량 초과 시 LRU 삭제
+
+        Args:
+            page_texts: 페이지 본문 리스트
+            summaries: page_texts와 같은 순서의 요약 리스트
+            model_name: 요약 모델 이름
+        """
+        if not page_texts:
+            return
+        self.store_db.put_many([(self._key(t, model_name), s) for t, s in zip(page_texts, summaries)])
+
+    def stats(self) -> dict:
+        """캐시 적중/미스 통계"""
+        return self.store_db.stats()
+
+
+_shared_page_summary_cache = None
+_shared_page_summary_cache_lock = threading.Lock()
+
+
+def get_page_summary_cache() -> PageSummaryCache:
+    """프로세스 전체에서 공유하는 페이지 요약 캐시 반환"""
+    global _shared_page_summary_cache
+    with _shared_page_summary_cache_lock:
+        if _shared_page_summary_cache is None:
+            _shared_page_summary_cache = PageSummaryCache()
+        return _shared_page_summary_cache
+
+
+class PageSummarizer:
+    """
+    페이지별 요약을 동시성 제한/속도 제한/재시도와 함께 병렬로 생성
+
+    짧은 페이지는 토큰 한도 내에서 한 요청으로 묶고, 묶음 응답에서 빠진 페이지는
+    단일 페이지 요청으로 다시 요약합니다. 캐시가 주어지면 이미 요약한 페이지는
+    요청하지 않습니다. 결과는 항상 페이지 순서로 반환됩니다.
+    """
+
+    def __init__(
+        self,
+        llm,
+        max_concurrency: int = PAGE_SUMMARY_MAX_CONCURRENCY,
+        requests_per_minute: int = PAGE_SUMMARY_REQUESTS_PER_MINUTE,
+        max_retries: int = PAGE_SUMMARY_MAX_RETRIES,
+        pack_token_budget: int = PAGE_PACK_TOKEN_BUDGET,
+        pack_max_pages: int = PAGE_PACK_MAX_PAGES,
+        cache: PageSummaryCache | None = None,
+    ):
+        """
+        Args:
+            llm: 요약에 사용할 LLM
+            max_concurrency: 동시에 보낼 최대 요청 수
+            requests_per_minute: 분당 요청 한도
+            max_retries: 요청별 재시도 횟수
+            pack_token_budget: 묶음 요청 1건에 담을 페이지 본문 최대 토큰 수
+            pack_max_pages: 묶음 요청 1건에 담을 최대 페이지 수
+            cache: 페이지 요약 캐시 (None이면 캐시 미사용)
+        """
+        self.llm = llm
+        self.model_name = getattr(llm, "model_name", None) or MODEL_NAME
+        self.cache = cache
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.pack_token_budget = pack_token_budget
+        self.pack_max_pages = max(1, pack_max_pages)
+        self.bucket = TokenBucket(requests_per_minute / 60.0, capacity=self.max_concurrency)
+
+    def _invoke(self, prompt_text: str) -> str:
+        self.bucket.acquire(1)
+        return call_with_retries(self.llm.invoke, prompt_text, retries=self.max_retries).content
+
+    def _summarize_page(self, text: str) -> str:
+        return self._invoke(PAGE_SUMMARY_PROMPT.format(page_text=text)).strip()
+
+    def _summarize_pack(self, texts: list[str]) -> list[str]:
+        if len(texts) == 1:
+            return [self._summarize_page(texts[0])]
+
+        pages_text = "\n\n".join(f"=== PAGE {i + 1} ===\n{t}" for i, t in enumerate(texts))
+        try:
+            output = self._invoke(
+                PACKED_PAGE_SUMMARY_PROMPT.format(page_count=len(texts), pages_text=pages_text)
+            )
+            parsed = split_packed_summary(output, len(texts))
+        except Exception as e:
+            print(f"Packed page summary error: {e}")
+            parsed = {}
+
+        # 묶음 응답에서 누락된 페이지는 단독 요청으로 보충
+        missing = [i for i in range(len(texts)) if i not in parsed]
+        if missing:
+            logger.info("packed page summary missed %d/%d pages, retrying individually", len(missing), len(texts))
+        for i in missing:
+            parsed[i] = self._summarize_page(texts[i])
+        return [parsed[i] for i in range(len(texts))]
+
+    def _summarize_and_store(self, texts: list[str]) -> list[str]:
+        summaries = self._summarize_pack(texts)
+        if self.cache is not None:
+            try:
+                self.cache.store(texts, summaries, self.model_name)
+            except Exception as e:
+                print(f"Page summary cache store error: {e}")
+        return summaries
+
+    def iter_summaries(self, pages: list[tuple]):
+        """
+        (페이지 번호, 본문) 리스트를 요약하며 페이지 순서대로 하나씩 반환
+
+        모든 요청을 먼저 제출하고 앞 페이지부터 완료를 기다리므로,
+        뒤 페이지는 앞 페이지를 기다리는 동안 이미 병렬로 처리됩니다.
+
+        Args:
+            pages: (페이지 번호, 본문) 리스트 (페이지 순서로 정렬되어 있어야 함)
+
+        Yields:
+            (페이지 번호, 요약)
+        """
+        if not pages:
+            return
+        texts = [text for _, text in pages]
+        cached = [None] * len(texts)
+        if self.cache is not None:
+            try:
+                cached = self.cache.lookup(texts, self.model_name)
+            except Exception as e:
+                print(f"Page summary cache lookup error: {e}")
+
+        # 캐시에 없는 페이지만 묶어서 요청
+        pending = [i for i, s in enumerate(cached) if s is None]
+        packs = [
+            [pending[j] for j in pack]
+            for pack in pack_pages([texts[i] for i in pending], self.pack_token_budget, self.pack_max_pages)
+        ]
+
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            # 페이지 인덱스 -> (묶음 future, 묶음 내 위치)
+            slots = {}
+            for pack in packs:
+                future = executor.submit(self._summarize_and_store, [texts[i] for i in pack])
+                for pos, i in enumerate(pack):
+                    slots[i] = (future, pos)
+
+            for i, (page_no, _) in enumerate(pages):
+                if cached[i] is not None:
+                    yield page_no, cached[i]
+                else:
+                    future, pos = slots[i]
+                    yield page_no, future.result()[pos]
+        finally:
+            # 소비자가 중간에 멈추면 아직 시작하지 않은 요청은 취소
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def summarize(self, pages: list[tuple]) -> list[tuple]:
+        """
+        iter_summaries의 결과를 리스트로 반환
+
+        Args:
+            pages: (페이지 번호, 본문) 리스트
+
+        Returns:
+            페이지 순서의 (페이지 번호, 요약) 리스트
+        """
+        return list(self.iter_summaries(pages))
+
+
+# =========================
+# 인덱스 저장소 (문서 해시 기반 캐시)
+# =========================
+def _documents_to_json(docs: list[Document]) -> list[dict]:
+    return [{"page_content": d.page_content, "metadata": d.metadata} for d in docs]
+
+
+def _documents_from_json(items: list[dict]) -> list[Document]:
+    return [Document(page_content=it["page_content"], metadata=it["metadata"]) for it in items]
+
+
+def file_md5(path: str) -> str:
+    """파일 내용의 MD5 해시 (app.py의 업로드 해시와 동일한 방식)"""
+    h = md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class IndexStore:
+    """
+    문서 해시 기반 인덱스 저장소
+
+    페이지 문서, 청크 목록, FAISS 인덱스, BM25 구조를 디스크에 저장해 두고
+    같은 문서가 다시 업로드되면 로드/분할/임베딩 없이 바로 복원합니다.
+    캐시 키에는 청크·임베딩 파라미터와 저장 포맷 버전이 포함되므로
+    파라미터가 바뀌면 기존 캐시는 자연스럽게 무시됩니다.
+    """
+
+    MANIFEST = "manifest.json"
+    EXACT_VECTORS = "exact_vectors.npy"  # IVF-PQ 인덱스의 원래 임베딩 (float32, mmap으로 읽음)
+
+    def __init__(self, root: str = INDEX_CACHE_DIR):
+        self.root = root
+
+    @staticmethod
+    def make_key(doc_hash: str) -> str:
+        """
+        문서 해시 + 인덱싱 파라미터로 캐시 키 생성
+
+        Args:
+            doc_hash: 문서 내용의 해시 (app.py의 MD5)
+
+        Returns:
+            디렉터리 이름으로 쓸 수 있는 캐시 키
+        """
+        params = f"v{INDEX_STORE_VERSION}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{EMBEDDING_MODEL}|{FAISS_INDEX_TYPE}"
+        return f"{doc_hash}_{md5(params.encode()).hexdigest()[:8]}"
+
+    def path_for(self, doc_hash: str) -> str:
+        return os.path.join(self.root, self.make_key(doc_hash))
+
+    def load(self, doc_hash: str, embeddings) -> dict | None:
+        """
+        캐시된 인덱스 로드
+
+        Args:
+            doc_hash: 문서 내용의 해시
+            embeddings: 쿼리 임베딩에 사용할 Embeddings 객체
+
+        Returns:
+            {"pages", "chunks", "vectorstore", "bm25_retriever", "exact_vectors", "index_settled"} 딕셔너리
+            (없으면 None)
+        """
+        path = self.path_for(doc_hash)
+        if not os.path.exists(os.path.join(path, self.MANIFEST)):
+            return None
+
+        try:
+            with open(os.path.join(path, self.MANIFEST), encoding="utf-8") as f:
+                manifest = json.load(f)
+            with open(os.path.join(path, "pages.json"), encoding="utf-8") as f:
+                pages = _documents_from_json(json.load(f))
+            with open(os.path.join(path, "chunks.json"), encoding="utf-8") as f:
+                chunks = _documents_from_json(json.load(f))
+            # 직접 저장한 파일이므로 역직렬화 허용
+            vectorstore = FAISS.load_local(
+                os.path.join(path, "faiss"),
+                embeddings,
+                allow_dangerous_deserialization=True,
+            )
+            # 검색 파라미터(nprobe/efSearch)는 현재 설정값 적용
+            set_search_params(vectorstore.index)
+            bm25_retriever = BM25Retriever.load(path, chunks)
+            exact_vectors = self.load_exact_vectors(doc_hash)
+        except Exception as e:
+            print(f"Index cache load error: {e}")
+            return None
+
+        return {
+            "pages": pages,
+            "chunks": chunks,
+            "vectorstore": vectorstore,
+            "bm25_retriever": bm25_retriever,
+            "exact_vectors": exact_vectors,
+            "index_settled": manifest.get("index_settled", False),
+        }
+
+    def load_exact_vectors(self, doc_hash: str) -> np.ndarray | None:
+        """
+        저장된 원래 임베딩을 mmap으로 열기 (IVF-PQ 인덱스가 아니면 파일이 없어 None)
+
+        수백만 개 벡터도 메모리에 올리지 않고, 조회한 청크의 페이지만 디스크에서 읽습니다.
+        """
+        path = os.path.join(self.path_for(doc_hash), self.EXACT_VECTORS)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode="r")
+
+    @staticmethod
+    def _temp_file(dir_path: str, suffix: str) -> str:
+        """dir_path 안의 빈 임시 파일 경로 (os.replace로 교체할 파일을 먼저 쓸 곳)"""
+        fd, path = tempfile.mkstemp(prefix=".tmp_", suffix=suffix, dir=dir_path)
+        os.close(fd)
+        return path
+
+    def save_vector_index(self, doc_hash: str, vectorstore, exact_vectors: np.ndarray | None = None) -> None:
+        """
+        저장된 문서의 FAISS 인덱스만 교체 (코퍼스 인덱스 변환 결과 저장)
+
+        청크/문서 저장소(index.pkl)는 변환해도 바뀌지 않으므로 index.faiss와 원래 임베딩 파일만
+        임시 파일에 쓴 뒤 os.replace로 교체하고, manifest에 종류와 확정 여부를 기록합니다.
+
+        Args:
+            doc_hash: 문서 내용의 해시
+            vectorstore: 변환된 인덱스를 가진 FAISS 벡터스토어
+            exact_vectors: IVF-PQ 인덱스의 원래 임베딩 (다른 종류면 None, 기존 파일 삭제)
+        """
+        path = self.path_for(doc_hash)
+        if not os.path.exists(os.path.join(path, self.MANIFEST)):
+            return
+        tmp_files = []
+        try:
+            tmp_files.append(self._temp_file(path, ".faiss"))
+            faiss.write_index(vectorstore.index, tmp_files[-1])
+            os.replace(tmp_files[-1], os.path.join(path, "faiss", "index.faiss"))
+            exact_path = os.path.join(path, self.EXACT_VECTORS)
+            if exact_vectors is not None:
+                tmp_files.append(self._temp_file(path, ".npy"))
+                np.save(tmp_files[-1], np.asarray(exact_vectors, dtype=np.float32))
+                os.replace(tmp_files[-1], exact_path)
+            elif os.path.exists(exact_path):
+                os.remove(exact_path)
+        except (OSError, RuntimeError) as e:
+            print(f"Index cache update error: {e}")
+            return
+        finally:
+            for tmp_file in tmp_files:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        self.update_manifest(doc_hash, index_type=index_type_of(vectorstore.index), index_settled=True)
+
+    def update_manifest(self, doc_hash: str, **fields) -> None:
+        """저장된 문서의 manifest 항목 갱신 (임시 파일에 쓴 뒤 교체)"""
+        path = self.path_for(doc_hash)
+        try:
+            with open(os.path.join(path, self.MANIFEST), encoding="utf-8") as f:
+                manifest = json.load(f)
+            manifest.update(fields)
+            tmp_manifest = self._temp_file(path, ".json")
+            with open(tmp_manifest, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_manifest, os.path.join(path, self.MANIFEST))
+        except (OSError, ValueError) as e:
+            print(f"Index cache update error: {e}")
+
+    def save(
+        self,
+        doc_hash: str,
+        pages: list[Document],
+        chunks: list[Document],
+        vectorstore,
+        bm25_retriever: BM25Retriever,
+        exact_vectors: np.ndarray | None = None,
+    ) -> None:
+        """
+        인덱스를 임시 디렉터리에 모두 기록한 뒤 원자적으로 교체
+        (동시에 같은 문서를 저장해도 반쯤 쓰인 캐시가 보이지 않음)
+
+        exact_vectors가 있으면(IVF-PQ 인덱스) 인덱스 옆에 float32 .npy로 함께 저장합니다.
+        """
+        final_path = self.path_for(doc_hash)
+        if os.path.exists(os.path.join(final_path, self.MANIFEST)):
+            return
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=".tmp_", dir=self.root)
+        try:
+            with open(os.path.join(tmp_path, "pages.json"), "w", encoding="utf-8") as f:
+                json.dump(_documents_to_json(pages), f, ensure_ascii=False)
+            with open(os.path.join(tmp_path, "chunks.json"), "w", encoding="utf-8") as f:
+                json.dump(_documents_to_json(chunks), f, ensure_ascii=False)
+            vectorstore.save_local(os.path.join(tmp_path, "faiss"))
+            bm25_retriever.save(tmp_path)
+            if exact_vectors is not None:
+                np.save(os.path.join(tmp_path, self.EXACT_VECTORS), np.asarray(exact_vectors, dtype=np.float32))
+
+            # manifest는 마지막에 기록 (존재 여부 = 저장 완료)
+            with open(os.path.join(tmp_path, self.MANIFEST), "w", encoding="utf-8") as f:
+                json.dump({
+                    "version": INDEX_STORE_VERSION,
+                    "doc_hash": doc_hash,
+                    "chunk_size": CHUNK_SIZE,
+                    "chunk_overlap": CHUNK_OVERLAP,
+                    "embedding_model": EMBEDDING_MODEL,
+                    "index_type": index_type_of(vectorstore.index),
+                    "num_pages": len(pages),
+                    "num_chunks": len(chunks),
+                    "created_at": time.time(),
+                }, f)
+
+            os.replace(tmp_path, final_path)
+        except OSError:
+            # 다른 프로세스가 먼저 저장한 경우 등
+            pass
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+index_store = IndexStore()
+
+
+# =========================
+# PDF 로드
+# =========================
+def load_pdf_pages(
+    pdf_path: str | None = None,
+    pdf_bytes: bytes | None = None,
+    source_name: str | None = None,
+) -> list[Document]:
+    """
+    PDF를 페이지 단위 Document 리스트로 로드
+
+    바이트가 주어지면 디스크에 쓰지 않고 PyMuPDF가 메모리 스트림에서 바로 엽니다.
+    메타데이터(page, source, total_pages 등)는 PyMuPDFLoader와 같습니다.
+
+    Args:
+        pdf_path: PDF 파일 경로
+        pdf_bytes: PDF 파일 내용 (pdf_path 대신 사용)
+        source_name: 메타데이터 source에 기록할 이름 (pdf_bytes 사용 시)
+
+    Returns:
+        페이지 순서의 Document 리스트
+    """
+    if pdf_bytes is None:
+        return PyMuPDFLoader(pdf_path).load()
+    blob = Blob.from_data(bytes(pdf_bytes), path=source_name or "uploaded.pdf", mime_type="application/pdf")
+    return list(PyMuPDFParser().lazy_parse(blob))
+
+
+def _pdf_base_metadata(doc, source_name: str) -> dict:
+    """PyMuPDFLoader와 같은 형태의 문서 공통 메타데이터"""
+    metadata = {
+        "producer": "PyMuPDF",
+        "creator": "PyMuPDF",
+        "creationdate": "",
+        "source": source_name,
+        "file_path": source_name,
+        "total_pages": len(doc),
+    }
+    for key, value in (doc.metadata or {}).items():
+        if isinstance(value, str):
+            metadata[key.lower()] = value.strip()
+        elif isinstance(value, int):
+            metadata[key.lower()] = value
+    for key in ("modDate", "creationDate"):
+        if key in (doc.metadata or {}):
+            metadata[key] = doc.metadata[key]
+    return metadata
+
+
+# 앱 프로세스 수명 동안 재사용하는 PDF 추출 프로세스 풀 (작업자 수별)
+# (spawn 작업 프로세스는 시작 시 __main__ 스크립트를 다시 임포트하므로 - Streamlit에서는 app.py 전체,
+#  작업자당 약 2초 - 문서마다 풀을 새로 만들지 않고 첫 사용 시 한 번만 시작)
+_pdf_executors: dict[int, ProcessPoolExecutor] = {}
+_pdf_executors_lock = threading.Lock()
+
+
+def _get_pdf_executor(max_workers: int) -> ProcessPoolExecutor:
+    """공유 PDF 추출 프로세스 풀 반환 (없으면 생성)"""
+    with _pdf_executors_lock:
+        executor = _pdf_executors.get(max_workers)
+        if executor is None:
+            # Streamlit 스크립트 스레드에서 fork하면 잠금 상태가 복제될 수 있으므로 spawn 사용
+            # (작업 함수는 pymupdf만 임포트하는 pdf_worker 모듈에 있어 이 모듈을 다시 불러오지 않음)
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _pdf_executors[max_workers] = executor
+        return executor
+
+
+def iter_pdf_pages(
+    pdf_path: str | None = None,
+    pdf_bytes: bytes | None = None,
+    source_name: str | None = None,
+    max_workers: int = PDF_EXTRACT_WORKERS,
+    pages_per_task: int = PDF_PAGES_PER_TASK,
+    min_parallel_pages: int = PDF_PARALLEL_MIN_PAGES,
+):
+    """
+    PDF 페이지를 페이지 순서대로 하나씩 반환 (대용량 문서는 프로세스 풀로 병렬 추출)
+
+    페이지 범위를 나눠 여러 프로세스가 동시에 텍스트를 추출하고, 앞 범위부터 완료되는 대로
+    Document를 내보내므로 호출 측은 남은 페이지 추출과 겹쳐서 분할 등 후처리를 할 수 있습니다.
+    작은 문서나 작업자가 1개인 경우에는 load_pdf_pages와 같은 단일 프로세스 경로를 사용합니다.
+
+    Args:
+        pdf_path: PDF 파일 경로
+        pdf_bytes: PDF 파일 내용 (pdf_path 대신 사용)
+        source_name: 메타데이터 source에 기록할 이름
+        max_workers: 추출 프로세스 수
+        pages_per_task: 작업 1건이 맡을 연속 페이지 수
+        min_parallel_pages: 병렬 추출을 사용할 최소 페이지 수
+
+    Yields:
+        페이지 단위 Document (metadata["page"]는 0부터 시작)
+    """
+    import pymupdf
+
+    if pdf_bytes is not None:
+        doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    else:
+        doc = pymupdf.open(pdf_path)
+    with doc:
+        total = len(doc)
+        base_metadata = _pdf_base_metadata(doc, source_name or pdf_path or "uploaded.pdf")
+
+    if max_workers <= 1 or total < min_parallel_pages:
+        yield from load_pdf_pages(pdf_path, pdf_bytes=pdf_bytes, source_name=source_name)
+        return
+
+    ranges = [(start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task)]
+    executor = _get_pdf_executor(max_workers)
+    temp_path = None
+    if pdf_bytes is not None:
+        # 작업마다 바이트를 다시 보내지 않도록 문서당 한 번만 임시 파일로 전달
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            f.write(pdf_bytes)
+            temp_path = f.name
+    futures = []
+    try:
+        futures = [
+            executor.submit(pdf_worker.extract_page_texts, temp_path or pdf_path, start, end)
+            for start, end in ranges
+        ]
+        for (start, _), future in zip(ranges, futures):
+            for offset, text in enumerate(future.result()):
+                yield Document(page_content=text, metadata={**base_metadata, "page": start + offset})
+    except BrokenProcessPool:
+        # 작업 프로세스가 비정상 종료된 풀은 버리고 다음 호출에서 새로 생성
+        with _pdf_executors_lock:
+            if _pdf_executors.get(max_workers) is executor:
+                del _pdf_executors[max_workers]
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
+        if temp_path is not None:
+            # 취소되지 않은 작업이 남아 있으면 파일을 읽기 전에 지우지 않도록 완료를 기다림
+            wait(futures)
+            os.remove(temp_path)
+
+
+# =========================
+# 증분 인덱싱 파이프라인
+# =========================
+def make_text_splitter() -> RecursiveCharacterTextSplitter:
+    """QA/요약(RAG)용 청크 분할기"""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=len,
+        separators=["\n\n", "\n", " ", ""],
+    )
+
+
+def iter_ingest_batches(
+    pages,
+    embeddings: Embeddings,
+    batch_pages: int = INGEST_BATCH_PAGES,
+    doc_id: str | None = None,
+):
+    """
+    페이지 스트림을 배치 단위로 분할/임베딩하는 제너레이터 파이프라인
+
+    전체 페이지/청크/벡터 리스트를 한꺼번에 만들지 않고 배치마다 내보내므로,
+    호출 측은 배치를 받는 즉시 인덱스에 추가해 앞 페이지부터 검색 가능하게 할 수 있습니다.
+    다음 배치의 임베딩은 이전 배치를 내보내기 전에 시작하므로, 호출 측이 배치 N을
+    인덱싱하는 동안 배치 N+1의 임베딩 요청이 진행됩니다.
+    청크 id는 배치를 넘어 0부터 순서대로 부여합니다.
+
+    Args:
+        pages: 페이지 단위 Document iterable (페이지 순서)
+        embeddings: 청크 임베딩 객체 (CachedEmbeddings 권장)
+        batch_pages: 배치 1개에 담을 페이지 수
+        doc_id: 페이지/청크 메타데이터에 기록할 문서 식별자 (문서 해시, 코퍼스에서 문서 구분에 사용)
+
+    Yields:
+        (페이지 리스트, 청크 리스트, 청크 벡터 리스트)
+    """
+    text_splitter = make_text_splitter()
+    next_chunk_id = 0
+
+    def _page_batches():
+        batch = []
+        for page in pages:
+            if doc_id is not None:
+                # 파일 이름은 표시용일 뿐 같은 이름의 다른 문서가 있을 수 있으므로 해시로 구분
+                page.metadata["doc_id"] = doc_id
+            batch.append(page)
+            if len(batch) >= batch_pages:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _start(page_batch, prefetch):
+        nonlocal next_chunk_id
+        chunks = text_splitter.split_documents(page_batch)
+        # 청크 순서대로 정수 id 부여 (FAISS/BM25 결과를 이 id로 결합)
+        for d in chunks:
+            d.metadata["chunk_id"] = next_chunk_id
+            next_chunk_id += 1
+        future = prefetch.submit(embed_texts_concurrently, [d.page_content for d in chunks], embeddings) if chunks else None
+        return page_batch, chunks, future
+
+    def _finish(started):
+        page_batch, chunks, future = started
+        return page_batch, chunks, future.result() if future is not None else []
+
+    # 배치 N과 N+1의 임베딩을 기다리는 스레드 2개 (실제 요청은 공유 임베딩 실행기에서 실행)
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="ingest-embedding") as prefetch:
+        previous = None
+        for page_batch in _page_batches():
+            started = _start(page_batch, prefetch)
+            if previous is not None:
+                yield _finish(previous)
+            previous = started
+        if previous is not None:
+            yield _finish(previous)
+
+
+# =========================
+# 질문 모드 감지
+# =========================
+SUMMARY_HINTS = ("요약", "정리", "보고", "리포트", "개요", "핵심", "전반", "전체", "구조", "목차")
+PAGEWISE_HINTS = ("페이지별", "page by page", "페이지 단위", "쪽별", "p별")
+
+
+def detect_mode(question: str) -> str:
+    """
+    질문에 맞는 답변 모드 판별
+
+    Args:
+        question: 사용자 질문
+
+    Returns:
+        "pagewise" (페이지별 요약) / "summary" (전체 요약) / "qa" (질의응답)
+    """
+    q = (question or "").strip().lower()
+    if any(k in q for k in PAGEWISE_HINTS):
+        return "pagewise"
+    if any(k in q for k in SUMMARY_HINTS):
+        return "summary"
+    return "qa"
+
+
+# =========================
+# 답변 캐시 (정확 일치 + 의미 유사도)
+# =========================
+class LRUCache:
+    """
+    크기 제한(LRU)과 만료 시간(TTL)을 갖는 스레드 안전 메모리 캐시
+
+    Streamlit은 스크립트를 다시 실행해도 모듈은 한 번만 임포트하므로,
+    모듈 전역 인스턴스는 세션 간에 공유됩니다.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        """
+        Args:
+            maxsize: 최대 항목 수 (초과 시 가장 오래 사용되지 않은 항목 삭제)
+            ttl: 항목 유효 시간(초), None이면 만료 없음
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (저장 시각, 값)
+        self._lock = threading.Lock()
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[0], time.time()):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self) -> list[tuple]:
+        """만료되지 않은 (키, 값) 목록 (적중 통계/사용 순서에 영향 없음)"""
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (t, _) in self._data.items() if self._expired(t, now)]:
+                del self._data[key]
+            return [(k, v) for k, (_, v) in self._data.items()]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """캐시 적중/미스 통계"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def normalize_question(question: str) -> str:
+    """캐시 키용 질문 정규화 (소문자, 공백 정리, 끝의 문장부호 제거)"""
+    q = re.sub(r"\s+", " ", (question or "").strip().lower())
+    return q.rstrip("?!.。？！ ")
+
+
+def question_anchors(question: str) -> frozenset[str]:
+    """
+    의미 캐시에서 두 질문이 반드시 같아야 하는 요소 (숫자, 영문 약어, 따옴표 안 표현)
+
+    "p.3 마감일은?"과 "p.4 마감일은?"처럼 임베딩은 거의 같지만 답이 다른 질문을 구분합니다.
+
+    Args:
+        question: 사용자 질문
+
+    Returns:
+        요소 집합 (모두 소문자)
+    """
+    anchors = {f"#{n}" for n in re.findall(r"\d+(?:[.,:/-]\d+)*", normalize_question(question))}
+    anchors.update(a.lower() for a in re.findall(r"(?<![A-Za-z0-9])[A-Z][A-Z0-9&]+(?![A-Za-z0-9])", question or ""))
+    anchors.update(
+        f'"{q.strip().lower()}"'
+        for q in re.findall(r"[\"'“‘「『]([^\"'”’」』]+)[\"'”’」』]", question or "")
+    )
+    return frozenset(anchors)
+
+
+class AnswerCache:
+    """
+    문서 해시 + 질문 기반 답변 캐시
+
+    1차로 정규화한 질문의 정확 일치를 찾고, 없으면 같은 문서·같은 답변 모드에서
+    질문 임베딩 코사인 유사도가 임계값 이상인 이전 질문(같은 뜻의 다른 표현)의 답변을 재사용합니다.
+    의미 일치는 숫자·약어·인용 표현(question_anchors)이 모두 같은 질문끼리만 인정합니다.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = ANSWER_CACHE_MAX_ENTRIES,
+        ttl: float | None = ANSWER_CACHE_TTL,
+        similarity_threshold: float = ANSWER_CACHE_SIMILARITY,
+        embeddings: Embeddings | None = None,
+    ):
+        """
+        Args:
+            maxsize: 최대 저장 답변 수
+            ttl: 답변 유효 시간(초)
+            similarity_threshold: 의미 일치로 볼 최소 코사인 유사도
+            embeddings: 질문 임베딩 객체 (기본값: get_embeddings())
+        """
+        self.entries = LRUCache(maxsize, ttl)
+        self.similarity_threshold = similarity_threshold
+        self._embeddings = embeddings
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @property
+    def embeddings(self) -> Embeddings:
+        if self._embeddings is None:
+            self._embeddings = get_embeddings()
+        return self._embeddings
+
+    @staticmethod
+    def _key(doc_hash: str, question: str, variant: str) -> tuple:
+        return (doc_hash, variant, normalize_question(question))
+
+    def _embed(self, question: str) -> np.ndarray | None:
+        try:
+            vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        except Exception as e:
+            print(f"Answer cache embedding error: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def get(self, doc_hash: str, question: str, variant: str = "default") -> tuple[str, str] | None:
+        """
+        캐시된 답변 조회
+
+        Args:
+            doc_hash: 문서 해시
+            question: 사용자 질문
+            variant: 같은 질문이라도 따로 캐시할 실행 옵션 (예: 쿼리 확장 여부)
+
+        Returns:
+            (답변, "exact" 또는 "semantic"), 없으면 None
+        """
+        if not doc_hash:
+            return None
+        entry = self.entries.get(self._key(doc_hash, question, variant))
+        if entry is not None:
+            self.exact_hits += 1
+            return entry["answer"], "exact"
+
+        mode = detect_mode(question)
+        anchors = question_anchors(question)
+        candidates = [
+            (key, entry) for key, entry in self.entries.items()
+            if key[0] == doc_hash and key[1] == variant
+            and entry["mode"] == mode and entry["anchors"] == anchors and entry["vector"] is not None
+        ]
+        if candidates:
+            vector = self._embed(question)
+            if vector is not None:
+                sims = np.stack([entry["vector"] for _, entry in candidates]) @ vector
+                best = int(np.argmax(sims))
+                if sims[best] >= self.similarity_threshold:
+                    key, entry = candidates[best]
+                    # 사용 순서 갱신
+                    self.entries.get(key)
+                    self.semantic_hits += 1
+                    logger.info("answer cache semantic hit (similarity %.3f)", sims[best])
+                    return entry["answer"], "semantic"
+
+        self.misses += 1
+        return None
+
+    def put(self, doc_hash: str, question: str, answer: str, variant: str = "default") -> None:
         """
-        하이브리드 검색: 벡터 검색과 BM25 검색의 결과를 가중 합산
-        
+        답변 저장
+
         Args:
-            query: 검색 쿼리
-            k: 반환할 상위 문서 개수
-        
-        Returns:
-            하이브리드 검색 결과 (점수 기반 정렬)
+            doc_hash: 문서 해시
+            question: 사용자 질문
+            answer: 생성된 답변 (UI 장식 적용 전)
+            variant: get()과 같은 실행 옵션
         """
-        # 1. 벡터 기반 검색 (MMR 적용)
-        try:
-            if hasattr(self.vectorstore_retriever, "invoke"):
-                vector_results = self.vectorstore_retriever.invoke(query)
-            else:
-                vector_results = self.vectorstore_retriever.get_relevant_documents(query)
-        except Exception as e:
-            print(f"Vector search error: {e}")
-            vector_results = []
-        
-        # 2. BM25 기반 검색
-        try:
-            bm25_results = self.bm25_retriever.retrieve(query, k=k)
-        except Exception as e:
-            print(f"BM25 search error: {e}")
-            bm25_results = []
-        
-        # 3. 결과 병합 및 점수 계산
-        doc_scores = {}  # {key: (doc, combined_score)}
-        
-        # 벡터 검색 결과 추가
-        for i, doc in enumerate(vector_results):
-            key = self._get_doc_key(doc)
-            # 벡터 검색 점수 정규화 (역순: 처음이 높음)
-            vector_score = (len(vector_results) - i) / len(vector_results) if vector_results else 0
-            doc_scores[key] = (doc, vector_score * self.vector_weight)
-        
-        # BM25 검색 결과 추가 (기존 결과가 있으면 가중치 합산)
-        for i, doc in enumerate(bm25_results):
-            key = self._get_doc_key(doc)
-            # BM25 검색 점수 정규화 (역순: 처음이 높음)
-            bm25_score = (len(bm25_results) - i) / len(bm25_results) if bm25_results else 0
-            
-            if key in doc_scores:
-                # 기존 점수가 있으면 합산 (두 검색 모두에서 찾아진 경우)
-                doc_scores[key] = (doc, doc_scores[key][1] + bm25_score * self.bm25_weight)
-            else:
-                doc_scores[key] = (doc, bm25_score * self.bm25_weight)
-        
-        # 4. 점수 기준으로 정렬 및 상위 k개 반환
-        sorted_results = sorted(
-            doc_scores.items(),
-            key=lambda x: x[1][1],
-            reverse=True
+        if not doc_hash or not answer:
+            return
+        self.entries.put(
+            self._key(doc_hash, question, variant),
+            {
+                "answer": answer,
+                "mode": detect_mode(question),
+                "anchors": question_anchors(question),
+                "vector": self._embed(question),
+            },
         )
-        
-        return [doc for _, (doc, _) in sorted_results[:k]]
-    
-    async def ainvoke(self, query: str, k: int = 10) -> list[Document]:
-        """비동기 버전의 retrieve 메서드"""
-        return self.retrieve(query, k=k)
-    
-    def invoke(self, query: str, k: int = 10) -> list[Document]:
-        """RunnableLambda 호환 인터페이스"""
-        return self.retrieve(query, k=k)
 
+    def stats(self) -> dict:
+        """정확/의미 적중 및 미스 통계"""
+        total = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / total if total else 0.0,
+        }
 
-async def retrieve_docs_for_queries(retriever, queries: list[str]) -> list:
-    async def _retrieve(query: str):
-        if hasattr(retriever, "ainvoke"):
-            return await retriever.ainvoke(query)
-        if hasattr(retriever, "aget_relevant_documents"):
-            return await retriever.aget_relevant_documents(query)
-        return await asyncio.to_thread(retriever.get_relevant_documents, query)
 
-    tasks = [_retrieve(q) for q in queries]
-    results = await asyncio.gather(*tasks)
+answer_cache = AnswerCache()
 
-    seen = set()
-    merged = []
-    for docs in results:
-        for d in docs:
-            key = (d.metadata.get("source"), d.metadata.get("page"), d.page_content)
-            if key in seen:
-                continue
-            seen.add(key)
-            merged.append(d)
-    return merged
 
+def build_hybrid_retriever(
+    pdf_path: str | None = None,
+    doc_hash: str | None = None,
+    progress_callback=None,
+    pdf_bytes: bytes | None = None,
+    source_name: str | None = None,
+    background: bool = INGEST_IN_BACKGROUND,
+) -> HybridRetriever:
+    """
+    PDF 1개를 인덱싱해 하이브리드 검색기(코퍼스에서는 샤드 1개)를 생성
+
+    인덱싱은 페이지 배치 단위 파이프라인으로 진행됩니다. background가 True면 첫 배치만
+    인덱싱한 뒤 바로 반환하고, 나머지 페이지는 백그라운드에서 검색기에 추가됩니다.
+    진행 상태는 hybrid_retriever.ingest_status로 확인할 수 있습니다.
 
-def create_rag_chain(pdf_path: str):
-    # [1단계] 문서 로드 (Document Load) - PyMuPDFLoader는 보통 페이지 단위 Document를 반환
-    loader = PyMuPDFLoader(pdf_path)
-    docs = loader.load()
+    Args:
+        pdf_path: PDF 파일 경로
+        doc_hash: 문서 내용 해시 (없으면 파일/바이트에서 계산). 인덱스 캐시 키로 사용
+        progress_callback: 인덱싱 진행률 콜백 (완료 페이지 수, 전체 페이지 수).
+            background가 True면 첫 배치까지만 호출되며, 이후 진행률은 ingest_status를 주기적으로 읽어 확인
+        pdf_bytes: PDF 파일 내용 (업로드 파일을 임시 파일 없이 바로 처리할 때 pdf_path 대신 사용)
+        source_name: pdf_bytes 사용 시 메타데이터에 기록할 파일 이름
+        background: 첫 배치 이후 나머지 인덱싱을 백그라운드 스레드에서 진행할지 여부
 
-    # [2단계] 문서 분할 (Text Split) - QA/요약(RAG)용
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        length_function=len,
-        separators=["\n\n", "\n", " ", ""],
-    )
-    split_documents = text_splitter.split_documents(docs)
+    Returns:
+        HybridRetriever (pages에 페이지 단위 Document 포함)
+    """
+    if pdf_path is None and pdf_bytes is None:
+        raise ValueError("pdf_path 또는 pdf_bytes 중 하나는 필요합니다.")
+    if doc_hash is None:
+        doc_hash = md5(pdf_bytes).hexdigest() if pdf_bytes is not None else file_md5(pdf_path)
 
-    # [3~4단계] 임베딩 및 벡터 DB 저장
-    embeddings = OpenAIEmbeddings()
-    vectorstore = FAISS.from_documents(documents=split_documents, embedding=embeddings)
+    # 임베딩 캐시를 거쳐 인덱싱/쿼리 임베딩 모두 재사용
+    embeddings = get_embeddings()
+
+    # [0단계] 같은 문서/파라미터로 만든 인덱스가 있으면 그대로 재사용
+    cached = index_store.load(doc_hash, embeddings)
+    remaining_batches = None
+    if cached is not None:
+        docs = cached["pages"]
+        split_documents = cached["chunks"]
+        vectorstore = cached["vectorstore"]
+        bm25_retriever = cached["bm25_retriever"]
+    else:
+        # [1~4단계] 문서 로드 → 분할 → 임베딩을 페이지 배치 단위로 흘려보냄
+        # 청크가 나오는 첫 배치까지만 여기서 처리하고, 나머지는 검색기 생성 후 증분 추가
+        pages = iter_pdf_pages(pdf_path, pdf_bytes=pdf_bytes, source_name=source_name)
+        remaining_batches = iter_ingest_batches(pages, embeddings, doc_id=doc_hash)
+        docs = []
+        split_documents = []
+        vectors = []
+        for page_batch, chunks, chunk_vectors in remaining_batches:
+            docs.extend(page_batch)
+            split_documents.extend(chunks)
+            vectors.extend(chunk_vectors)
+            if progress_callback:
+                progress_callback(len(docs), page_batch[-1].metadata.get("total_pages", len(docs)))
+            if split_documents:
+                break
+
+        # 벡터 DB 저장 - 원래 청크 순서 유지
+        vectorstore = FAISS.from_embeddings(
+            text_embeddings=list(zip([d.page_content for d in split_documents], vectors)),
+            embedding=embeddings,
+            metadatas=[d.metadata for d in split_documents],
+        )
+        del vectors
+
+        # [5-1단계] BM25 기반 검색기 생성
+        bm25_retriever = BM25Retriever(documents=split_documents)
 
     # [5단계] 검색기(Retriever) 생성 - 벡터 기반 (MMR 옵션 포함)
     vector_retriever = vectorstore.as_retriever(
@@ -284,9 +3536,6 @@ def create_rag_chain(pdf_path: str):
         },
     )
 
-    # [5-1단계] BM25 기반 검색기 생성
-    bm25_retriever = BM25Retriever(documents=split_documents)
-
     # [5-2단계] 하이브리드 검색기 생성 (벡터 + BM25)
     hybrid_retriever = HybridRetriever(
         vectorstore_retriever=vector_retriever,
@@ -294,10 +3543,78 @@ def create_rag_chain(pdf_path: str):
         vector_weight=VECTOR_WEIGHT,
         bm25_weight=BM25_WEIGHT,
     )
+    hybrid_retriever.doc_hash = doc_hash
+    if cached is not None:
+        hybrid_retriever.exact_vectors = cached["exact_vectors"]
+        hybrid_retriever.index_settled = cached["index_settled"]
+    # docs는 페이지별 요약 체인과 공유되므로 증분 인덱싱 중에는 제자리에서 확장
+    hybrid_retriever.pages = docs
+    total_pages = docs[-1].metadata.get("total_pages", len(docs)) if docs else 0
+    status = hybrid_retriever.ingest_status
+    status.update(pages=len(docs), total_pages=total_pages, chunks=len(split_documents))
+
+    if remaining_batches is not None:
+        status["done"] = False
+
+        def finish_ingest(report_progress: bool):
+            """남은 페이지 배치를 검색 중인 인덱스에 추가하고 완료 후 캐시에 저장"""
+            try:
+                for page_batch, chunks, chunk_vectors in remaining_batches:
+                    docs.extend(page_batch)
+                    hybrid_retriever.add_chunks(chunks, chunk_vectors)
+                    status.update(pages=len(docs), chunks=len(hybrid_retriever.documents))
+                    if report_progress and progress_callback:
+                        progress_callback(len(docs), status["total_pages"])
+                # 배치별 BM25 세그먼트를 하나로 합치고, 청크 수가 많으면 근사 인덱스로 교체한 뒤 저장
+                bm25_retriever.compact()
+                hybrid_retriever.optimize_vector_index()
+                index_store.save(
+                    doc_hash, docs, hybrid_retriever.documents, vectorstore, bm25_retriever,
+                    exact_vectors=hybrid_retriever.exact_vectors,
+                )
+                if hybrid_retriever.exact_vectors is not None:
+                    # 메모리에 있는 원래 임베딩 대신 저장한 파일을 mmap으로 사용
+                    mapped = index_store.load_exact_vectors(doc_hash)
+                    if mapped is not None:
+                        hybrid_retriever.exact_vectors = mapped
+            except Exception as e:
+                # 일부 페이지만 인덱싱된 상태: done은 False로 두고 실패만 기록 (캐시에도 저장하지 않음)
+                status["error"] = str(e)
+                print(f"Incremental indexing error: {e}")
+                return
+            status["done"] = True
+            logger.info("indexed %d pages / %d chunks for %s", len(docs), status["chunks"], doc_hash)
+
+        if background:
+            # 앞 페이지는 이미 검색 가능, 나머지는 백그라운드에서 추가
+            # (Streamlit 위젯은 스크립트 스레드에서만 갱신 가능하므로 진행률 콜백은 호출하지 않음,
+            #  app.py는 ingest_status를 주기적으로 읽어 진행률을 표시)
+            hybrid_retriever.ingest_thread = threading.Thread(
+                target=finish_ingest, args=(False,), name=f"ingest-{doc_hash[:8]}", daemon=True
+            )
+            hybrid_retriever.ingest_thread.start()
+        else:
+            finish_ingest(True)
+
+    return hybrid_retriever
+
+
+def build_rag_chain(retriever):
+    """
+    검색기 위에 질문 유형별(QA/요약/페이지별 요약) RAG 체인을 구성
+
+    Args:
+        retriever: HybridRetriever 또는 DocumentCorpus (retrieve_with_scores와 pages 제공)
 
+    Returns:
+        rag_chain (질문 유형에 따라 분기하는 RunnableBranch)
+    """
     # [6~7단계] LLM
     llm = ChatOpenAI(model_name=MODEL_NAME, temperature=TEMPERATURE)
 
+    # [8단계] 재정렬기 (기본: LLM 호출 없는 로컬 재정렬)
+    reranker = build_reranker(RERANKER_MODE, retriever, llm)
+
     # -------------------------
     # 컨텍스트 포맷팅(페이지 표기 포함) & Rerank 적용
     # -------------------------
@@ -324,10 +3641,11 @@ def create_rag_chain(pdf_path: str):
             docs = inp if isinstance(inp, list) else []
         
         if docs and query:
-            # rerank 적용
-            reranked_docs = rerank_results(query, docs, llm)
-            return format_docs_with_pages(reranked_docs)
-        return format_docs_with_pages(docs)
+            # rerank 적용 (점수가 없으므로 순위 기반 점수 사용)
+            scored_docs = [(d, float(len(docs) - i)) for i, d in enumerate(docs)]
+            reranked_docs = reranker.rerank(query, scored_docs)
+            return pack_context(reranked_docs)[0]
+        return pack_context(docs)[0]
 
     question_selector = RunnableLambda(extract_question)
     format_docs_runnable = RunnableLambda(format_docs_with_pages)
@@ -336,20 +3654,27 @@ def create_rag_chain(pdf_path: str):
     def retrieve_with_hybrid_and_rerank(inp):
         """
         질문을 받아 하이브리드 검색(벡터 + BM25)으로 검색하고 rerank 적용
-        벡터 검색의 MMR 옵션은 hybrid_retriever 내에서 자동으로 적용됨
+        벡터 검색의 MMR 옵션은 retriever 내에서 자동으로 적용됨
+        (코퍼스면 모든 문서를 동시에 검색한 뒤 전체 상위 k개로 결합)
         """
         query = extract_question(inp)
         # 하이브리드 검색 (벡터 0.7 + BM25 0.3의 가중치로 결합)
-        if hasattr(hybrid_retriever, "invoke"):
-            docs = hybrid_retriever.invoke(query)
-        else:
-            docs = hybrid_retriever.retrieve(query)
+        scored_docs = retriever.retrieve_with_scores(query)
         
         # rerank 적용
-        reranked_docs = rerank_results(query, docs, llm)
-        return format_docs_with_pages(reranked_docs)
+        reranked_docs = reranker.rerank(query, scored_docs)
+        return pack_context(reranked_docs)[0]
+
+    async def aretrieve_with_hybrid_and_rerank(inp):
+        """retrieve_with_hybrid_and_rerank의 비동기 버전 (astream/ainvoke 경로)"""
+        query = extract_question(inp)
+        scored_docs = await retriever.aretrieve_with_scores(query)
+        reranked_docs = await asyncio.to_thread(reranker.rerank, query, scored_docs)
+        return pack_context(reranked_docs)[0]
     
-    retriever_with_hybrid_and_rerank = RunnableLambda(retrieve_with_hybrid_and_rerank)
+    retriever_with_hybrid_and_rerank = RunnableLambda(
+        retrieve_with_hybrid_and_rerank, afunc=aretrieve_with_hybrid_and_rerank
+    )
     context_chain = question_selector | retriever_with_hybrid_and_rerank
     context_selector = RunnableBranch(
         (has_context, RunnableLambda(extract_context)),
@@ -365,7 +3690,7 @@ def create_rag_chain(pdf_path: str):
 1. <Context>에 근거가 없으면 답을 만들지 말고 "문서에서 확인되지 않는 사항"이라고 명확히 말할 것
 2. 사용자의 질문 의도를 정확히 이해한 후 한 줄로 재구성 제시
 3. 답변은 사용자가 바로 이해하고 행동/결정할 수 있도록 구조화할 것
-4. 모든 근거에는 p.(페이지번호)를 포함할 것
+4. 모든 근거에는 p.(페이지번호)를 포함할 것 (<Context>에 문서 이름이 표기된 경우 문서 이름도 함께)
 5. 핵심 정보 우선으로, 필요한 경우만 세부사항 추가
 6. 질문이 모호한 경우 문서에서 찾을 수 있는 관련 항목들을 제시
 
@@ -380,7 +3705,7 @@ def create_rag_chain(pdf_path: str):
 (필요한 배경정보, 조건, 예외사항 등 - bullet list 형식)
 
 ## 근거 (출처 명시)
-- p.번호: (해당 내용 요약)
+- (문서 이름) p.번호: (해당 내용 요약)
 (2~4개의 핵심 근거)
 
 ## 확인하면 좋은 추가 정보
@@ -412,7 +3737,7 @@ def create_rag_chain(pdf_path: str):
 아래 <Context>에 포함된 내용만 근거로 사용하세요. 외부지식/추측/인터넷 정보는 절대 사용하지 마세요.
 는 사항"에 명시할 것
 3. 보고서처럼 깔끔하고 구조적으로 작성
-4. 가능하면 p.번호를 함께 표기
+4. 가능하면 p.번호를 함께 표기 (<Context>에 문서 이름이 표기된 경우 문서 이름도 함께)
 5. 사용자의 요청 관점에 맞춰 핵심 정보 우선 정렬
 
 [출력 형식 (엄격히 준수)]
@@ -423,7 +3748,7 @@ def create_rag_chain(pdf_path: str):
 (사용자 요청 관점으로 체계적 정리)
 
 ## 🔍 문서 기반 근거
-- p.번호: (내용요약)
+- (문서 이름) p.번호: (내용요약)
 (2~5개의 주요 근거)
 
 ---
@@ -448,29 +3773,18 @@ def create_rag_chain(pdf_path: str):
 
     
     # 3) 페이지별 요약 모드 (read-all, 누락 최소화)
-    page_prompt = ChatPromptTemplate.from_template("""당신은 업로드된 문서의 '해당 페이지'만 정확히 요약하는 어시스턴트입니다.
-이 페이지에 없는 내용은 절대 쓰지 마세요. 외부지식/추측/인터넷 정보도 사용하지 마세요.
-
-[출력 형식]
-## 핵심 요지 (3가지)
-1. (가장 중요한 내용)
-2. (부가 정보)
-3. (주의/예외사항)
-
-## 중요 규정·절차·수치·주의사항
-- 항목 1
-- 항목 2
-(있으면 2~4개)
-
-페이지 내용:
-{page_text}
-
-한국어로 명확하게 작성하세요.
-""")
+    page_summarizer = PageSummarizer(llm, cache=get_page_summary_cache())
 
-    def summarize_pages_to_text(_question: str) -> str:
-        """docs(페이지 단위)를 순회하며 p.별 요약을 만들고 문자열로 합침"""
-        items = []
+    def iter_page_summaries(_question=None):
+        """
+        retriever.pages(페이지 단위)를 병렬로 요약하며 ((문서 이름, p), 요약)을
+        페이지 순서대로 완료되는 즉시 반환 (문서가 하나면 문서 이름은 None)
+        """
+        docs = retriever.pages
+        labels = source_labels(docs)
+        multi_source = len(labels) > 1
+        source_order = {key: i for i, key in enumerate(labels)}
+        pages = []
         for d in docs:
             page = d.metadata.get("page", None)
             page_no = page + 1 if isinstance(page, int) else None
@@ -478,39 +3792,38 @@ def create_rag_chain(pdf_path: str):
             text = (d.page_content or "").strip()
             if not text:
                 continue
+            key = doc_key(d)
+            name = labels[key] if multi_source else None
+            pages.append((source_order[key], (name, page_no), text))
 
-            summary = llm.invoke(page_prompt.format(page_text=text)).content
-            if page_no is None:
-                items.append((10**9, summary))
-            else:
-                items.append((page_no, summary))
+        # 문서 순서를 유지하고 문서 안에서는 페이지 순 (페이지 번호 없는 항목은 맨 뒤로)
+        pages.sort(key=lambda x: (x[0], x[1][1] if x[1][1] is not None else 10**9))
+        yield from page_summarizer.iter_summaries([(key, text) for _, key, text in pages])
 
-        items.sort(key=lambda x: x[0])
+    def stream_pagewise_text(_question):
+        """p.별 요약을 완성되는 대로 마크다운 블록으로 반환 (invoke 시에는 전체가 합쳐짐)"""
+        for i, ((name, p), s) in enumerate(iter_page_summaries(_question)):
+            page_str = "?" if p is None else p
+            header = f"## {name} p.{page_str}" if name else f"## p.{page_str}"
+            yield ("\n\n" if i else "") + f"{header}\n{s.strip()}"
 
-        out_lines = []
-        for p, s in items:
-            if p == 10**9:
-                out_lines.append("## p.?\n" + s.strip())
-            else:
-                out_lines.append(f"## p.{p}\n{s.strip()}")
-        return "\n\n".join(out_lines)
+    async def astream_pagewise_text(_question):
+        # 동기 제너레이터를 스레드에서 한 단계씩 진행 (이벤트 루프 차단 방지)
+        iterator = stream_pagewise_text(_question)
+        done = object()
+        while True:
+            chunk = await asyncio.to_thread(next, iterator, done)
+            if chunk is done:
+                break
+            yield chunk
 
-    pagewise_chain = RunnableLambda(summarize_pages_to_text)
+    pagewise_chain = RunnableLambda(stream_pagewise_text, afunc=astream_pagewise_text)
 
     # -------------------------
     # 모드 감지/라우팅
     # -------------------------
-    SUMMARY_HINTS = ("요약", "정리", "보고", "리포트", "개요", "핵심", "전반", "전체", "구조", "목차")
-    PAGEWISE_HINTS = ("페이지별", "page by page", "페이지 단위", "쪽별", "p별")
-
     def route(question_or_input) -> str:
-        q = extract_question(question_or_input)
-        q = (q or "").strip().lower()
-        if any(k in q for k in PAGEWISE_HINTS):
-            return "pagewise"
-        if any(k in q for k in SUMMARY_HINTS):
-            return "summary"
-        return "qa"
+        return detect_mode(extract_question(question_or_input))
 
     def is_pagewise(q: str) -> bool:
         return route(q) == "pagewise"
@@ -524,20 +3837,310 @@ def create_rag_chain(pdf_path: str):
         qa_chain,  # default
     )
 
-    return rag_chain, hybrid_retriever
+    return rag_chain
+
+
+def create_rag_chain(
+    pdf_path: str | None = None,
+    doc_hash: str | None = None,
+    progress_callback=None,
+    pdf_bytes: bytes | None = None,
+    source_name: str | None = None,
+    background: bool = INGEST_IN_BACKGROUND,
+):
+    """
+    PDF로부터 RAG 체인과 하이브리드 검색기를 생성
+
+    Args:
+        pdf_path: PDF 파일 경로
+        doc_hash: 문서 내용 해시 (없으면 파일/바이트에서 계산). 인덱스 캐시 키로 사용
+        progress_callback: 인덱싱 진행률 콜백 (완료 페이지 수, 전체 페이지 수).
+            background가 True면 첫 배치까지만 호출되며, 이후 진행률은 ingest_status를 주기적으로 읽어 확인
+        pdf_bytes: PDF 파일 내용 (업로드 파일을 임시 파일 없이 바로 처리할 때 pdf_path 대신 사용)
+        source_name: pdf_bytes 사용 시 메타데이터에 기록할 파일 이름
+        background: 첫 배치 이후 나머지 인덱싱을 백그라운드 스레드에서 진행할지 여부
+
+    Returns:
+        (rag_chain, hybrid_retriever) 튜플
+    """
+    hybrid_retriever = build_hybrid_retriever(
+        pdf_path,
+        doc_hash=doc_hash,
+        progress_callback=progress_callback,
+        pdf_bytes=pdf_bytes,
+        source_name=source_name,
+        background=background,
+    )
+    return build_rag_chain(hybrid_retriever), hybrid_retriever
+
+
+def create_corpus_chain(shards: list[HybridRetriever]):
+    """
+    여러 문서의 검색기(샤드)를 묶은 코퍼스 위에 RAG 체인을 생성
+
+    샤드는 문서별로 build_hybrid_retriever/create_rag_chain이 만들고 문서 해시별로 캐시하므로,
+    문서를 추가하거나 빼도 나머지 문서는 다시 인덱싱하지 않습니다.
+    벡터 인덱스 종류는 코퍼스 전체 벡터 수로 정해 백그라운드에서 샤드에 적용합니다.
+
+    Args:
+        shards: 문서별 HybridRetriever 리스트 (코퍼스 내 문서 순서)
+
+    Returns:
+        (rag_chain, corpus) 튜플
+    """
+    corpus = DocumentCorpus(shards)
+    if len(corpus.shards) > 1:
+        # 변환 중에도 기존 인덱스로 검색 가능 (샤드 인덱싱이 끝나길 기다린 뒤 적용)
+        threading.Thread(target=corpus.optimize_vector_indexes, name="corpus-index", daemon=True).start()
+    return build_rag_chain(corpus), corpus
+
 
 # =========================
-# 추가 유틸리티 함수
+# 프로세스 공유 RAG 엔진 레지스트리
 # =========================
+def estimate_engine_bytes(retriever: HybridRetriever | DocumentCorpus) -> int:
+    """
+    검색기가 차지하는 메모리 대략치 (청크 본문 + FAISS 인덱스 + BM25 배열)
 
-def query_expansion(query: str) -> list[str]:
+    Args:
+        retriever: create_rag_chain이 반환한 HybridRetriever 또는 create_corpus_chain이 반환한 DocumentCorpus
+
+    Returns:
+        바이트 수 (코퍼스는 모든 샤드의 합)
     """
-    사용자의 원본 질문을 여러 관점에서 재구성하여
-    검색 정확도를 높입니다. (Hybrid Search 기초)
+    if isinstance(retriever, DocumentCorpus):
+        return sum(estimate_engine_bytes(shard) for shard in retriever.shards)
+    total = sum(len(d.page_content.encode()) for d in retriever.documents)
+    vectorstore = retriever.vectorstore
+    if vectorstore is not None:
+        total += vector_index_bytes(vectorstore.index)
+    for segment in getattr(retriever.bm25_retriever, "segments", ()):
+        total += sum(getattr(segment, name).nbytes for name in BM25Index._ARRAYS)
+    return total
+
+
+class RAGEngine:
     """
-    llm = ChatOpenAI(model_name=MODEL_NAME, temperature=0.7)
-    
-    expansion_prompt = ChatPromptTemplate.from_template("""
+    문서 1개에 대한 RAG 체인과 검색기 묶음
+
+    생성 후에는 읽기 전용으로 사용되므로 여러 Streamlit 세션이 같은 객체를 공유합니다.
+    세션별 사용 기록(lease)을 세어 참조 수로 사용합니다.
+    """
+
+    def __init__(self, doc_hash: str, rag_chain, retriever: HybridRetriever | DocumentCorpus):
+        self.doc_hash = doc_hash
+        self.rag_chain = rag_chain
+        self.retriever = retriever
+        self.leases = {}  # 세션 id -> 마지막 사용 시각
+        self.last_used = time.time()
+
+    @property
+    def size_bytes(self) -> int:
+        # 백그라운드 인덱싱 중에는 크기가 계속 늘어나므로 매번 계산
+        return estimate_engine_bytes(self.retriever)
+
+    @property
+    def refcount(self) -> int:
+        return len(self.leases)
+
+    @property
+    def shards(self) -> list[HybridRetriever]:
+        """이 엔진이 메모리에 붙잡고 있는 문서별 검색기 (코퍼스면 모든 샤드)"""
+        if isinstance(self.retriever, DocumentCorpus):
+            return self.retriever.shards
+        return [self.retriever]
+
+
+class EngineRegistry:
+    """
+    문서 해시별 RAGEngine을 프로세스 전체에서 한 번만 생성해 공유하는 레지스트리
+
+    같은 PDF를 연 세션들은 하나의 FAISS 인덱스/청크/BM25를 함께 사용합니다.
+    세션이 엔진을 쓸 때마다 lease를 갱신하고, 일정 시간 활동이 없는 세션의 lease는 만료됩니다.
+    사용 중인 세션이 없는 엔진은 idle_ttl이 지나거나 전체 메모리가 예산을 넘으면
+    오래 사용되지 않은 순서로 해제됩니다.
+    """
+
+    def __init__(
+        self,
+        memory_budget_bytes: int = ENGINE_MEMORY_BUDGET_MB * 1024 * 1024,
+        idle_ttl: float = ENGINE_IDLE_TTL,
+        session_ttl: float = ENGINE_SESSION_TTL,
+    ):
+        """
+        Args:
+            memory_budget_bytes: 엔진 전체 메모리 예산
+            idle_ttl: 사용하는 세션이 없는 엔진을 유지하는 시간(초)
+            session_ttl: 활동 없는 세션의 lease 만료 시간(초)
+        """
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_ttl = idle_ttl
+        self.session_ttl = session_ttl
+        self.engines = {}  # 문서 해시 -> RAGEngine
+        self.builds = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._build_locks = {}  # 문서 해시 -> 생성 중 잠금 (같은 문서를 동시에 두 번 만들지 않음)
+
+    @staticmethod
+    def _memory_bytes(engines, sizes: dict | None = None) -> int:
+        """
+        엔진들이 붙잡고 있는 검색기 메모리 합계
+
+        코퍼스는 샤드 검색기를 직접 참조하므로 샤드의 문서별 엔진이 해제돼도 메모리가 남습니다.
+        그래서 엔진 단위가 아니라 샤드 단위로 세고, 코퍼스와 문서별 엔진이 공유하는 샤드는 한 번만 셉니다.
+
+        Args:
+            engines: RAGEngine iterable
+            sizes: 샤드별 크기 메모 (id(샤드) -> 바이트 수, 여러 번 계산할 때 재사용)
+        """
+        sizes = {} if sizes is None else sizes
+        shards = {id(shard): shard for engine in engines for shard in engine.shards}
+        total = 0
+        for key, shard in shards.items():
+            if key not in sizes:
+                sizes[key] = estimate_engine_bytes(shard)
+            total += sizes[key]
+        return total
+
+    def _lease(self, engine: RAGEngine, session_id: str) -> None:
+        now = time.time()
+        engine.leases[session_id] = now
+        engine.last_used = now
+
+    def get(self, doc_hash: str, session_id: str) -> RAGEngine | None:
+        """
+        이미 생성된 엔진을 반환하고 세션 lease 갱신 (없으면 None)
+
+        Args:
+            doc_hash: 문서 해시
+            session_id: 세션 식별자
+        """
+        with self._lock:
+            engine = self.engines.get(doc_hash)
+            if engine is not None:
+                self._lease(engine, session_id)
+            return engine
+
+    def acquire(self, doc_hash: str, session_id: str, build) -> RAGEngine:
+        """
+        엔진을 반환하고 없으면 생성 (같은 문서에 대한 동시 요청은 한 번만 생성)
+
+        Args:
+            doc_hash: 문서 해시
+            session_id: 세션 식별자
+            build: (rag_chain, retriever)를 반환하는 생성 함수
+
+        Returns:
+            RAGEngine
+        """
+        engine = self.get(doc_hash, session_id)
+        if engine is not None:
+            return engine
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault(doc_hash, threading.Lock())
+        with build_lock:
+            # 다른 세션이 먼저 생성했으면 그대로 사용
+            engine = self.get(doc_hash, session_id)
+            if engine is None:
+                rag_chain, retriever = build()
+                engine = RAGEngine(doc_hash, rag_chain, retriever)
+                with self._lock:
+                    self.engines[doc_hash] = engine
+                    self._lease(engine, session_id)
+                    self.builds += 1
+                    self._build_locks.pop(doc_hash, None)
+                logger.info("built RAG engine %s (%.1f MB)", doc_hash, engine.size_bytes / 2**20)
+        self.evict()
+        return engine
+
+    def release(self, doc_hash: str | None, session_id: str) -> None:
+        """
+        세션의 lease 해제 (문서를 바꾸거나 대화를 떠날 때)
+
+        Args:
+            doc_hash: 문서 해시
+            session_id: 세션 식별자
+        """
+        with self._lock:
+            engine = self.engines.get(doc_hash)
+            if engine is not None:
+                engine.leases.pop(session_id, None)
+                engine.last_used = time.time()
+        self.evict()
+
+    def discard(self, doc_hash: str) -> None:
+        """
+        사용 중인 세션과 관계없이 엔진을 레지스트리에서 제거 (인덱싱 실패 등)
+
+        이미 엔진을 받은 세션은 계속 사용할 수 있고, 다음 acquire에서 새로 생성됩니다.
+
+        Args:
+            doc_hash: 문서 해시
+        """
+        with self._lock:
+            engine = self.engines.pop(doc_hash, None)
+        if engine is not None:
+            logger.info("discarded RAG engine %s", doc_hash)
+
+    def evict(self) -> list[str]:
+        """
+        만료된 lease를 정리하고, 사용 중이 아닌 엔진을 TTL/메모리 예산 기준으로 해제
+
+        Returns:
+            해제된 문서 해시 리스트
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            for engine in self.engines.values():
+                for sid in [s for s, t in engine.leases.items() if now - t > self.session_ttl]:
+                    del engine.leases[sid]
+
+            idle = sorted(
+                (e for e in self.engines.values() if e.refcount == 0),
+                key=lambda e: e.last_used,
+            )
+            sizes = {}
+            total = self._memory_bytes(self.engines.values(), sizes)
+            for engine in idle:
+                if now - engine.last_used > self.idle_ttl or total > self.memory_budget_bytes:
+                    del self.engines[engine.doc_hash]
+                    # 코퍼스가 아직 쓰는 샤드는 해제해도 메모리가 줄지 않으므로 다시 계산
+                    total = self._memory_bytes(self.engines.values(), sizes)
+                    evicted.append(engine.doc_hash)
+            self.evictions += len(evicted)
+
+        for doc_hash in evicted:
+            logger.info("evicted RAG engine %s", doc_hash)
+        if total > self.memory_budget_bytes:
+            logger.warning(
+                "RAG engines in use exceed the memory budget (%.1f / %.1f MB)",
+                total / 2**20, self.memory_budget_bytes / 2**20,
+            )
+        return evicted
+
+    def stats(self) -> dict:
+        """엔진 수, 메모리 사용량, 생성/해제 횟수"""
+        with self._lock:
+            return {
+                "engines": len(self.engines),
+                "memory_bytes": self._memory_bytes(self.engines.values()),
+                "sessions": sum(e.refcount for e in self.engines.values()),
+                "builds": self.builds,
+                "evictions": self.evictions,
+            }
+
+
+engine_registry = EngineRegistry()
+
+
+# =========================
+# 추가 유틸리티 함수
+# =========================
+
+EXPANSION_PROMPT = ChatPromptTemplate.from_template("""
 당신은 사용자의 질문을 다양한 관점에서 재구성하는 전문가입니다.
 
 원본 질문: {query}
@@ -551,15 +4154,47 @@ def query_expansion(query: str) -> list[str]:
 
 형식: 마크다운 번호 리스트로, 각 항목은 한 줄씩만 제공하세요.
 """)
-    
-    chain = expansion_prompt | llm | StrOutputParser()
-    result = chain.invoke({"query": query})
+
+_expansion_chain = None
+_expansion_chain_lock = threading.Lock()
+expansion_cache = LRUCache(EXPANSION_CACHE_MAX_ENTRIES, EXPANSION_CACHE_TTL)
+
+
+def get_expansion_chain():
+    """
+    프로세스 전체에서 공유하는 쿼리 확장 체인 반환
+    (ChatOpenAI 클라이언트와 HTTP 연결을 호출마다 새로 만들지 않음)
+    """
+    global _expansion_chain
+    with _expansion_chain_lock:
+        if _expansion_chain is None:
+            llm = ChatOpenAI(model_name=EXPANSION_MODEL_NAME, temperature=EXPANSION_TEMPERATURE)
+            _expansion_chain = EXPANSION_PROMPT | llm | StrOutputParser()
+        return _expansion_chain
+
+
+def query_expansion(query: str) -> list[str]:
+    """
+    사용자의 원본 질문을 여러 관점에서 재구성하여
+    검색 정확도를 높입니다. (Hybrid Search 기초)
+
+    같은 질문(정규화 기준)의 확장 결과는 expansion_cache에서 재사용합니다.
+    """
+    key = (EXPANSION_MODEL_NAME, normalize_question(query))
+    cached = expansion_cache.get(key)
+    if cached is not None:
+        return [query] + cached
+
+    result = get_expansion_chain().invoke({"query": query})
     
     # 응답을 리스트로 파싱
     lines = [line.strip() for line in result.split('\n') if line.strip() and line[0].isdigit()]
     queries = [line.split('. ', 1)[-1] if '. ' in line else line for line in lines]
-    
-    return [query] + queries[:4]  # 원본 + 4가지
+
+    expansions = queries[:4]
+    if expansions:
+        expansion_cache.put(key, expansions)
+    return [query] + expansions  # 원본 + 4가지
 
 
 def rerank_results(query: str, retrieved_docs: list, llm=None) -> list:
@@ -601,6 +4236,179 @@ def rerank_results(query: str, retrieved_docs: list, llm=None) -> list:
         return retrieved_docs  # 파싱 실패시 원본 반환
 
 
+# =========================
+# 재정렬기 (Reranker)
+# =========================
+class Reranker(ABC):
+    """
+    검색 결과 재정렬기 인터페이스
+
+    rerank()는 (Document, 결합 점수) 리스트를 받아 관련도 순으로 정렬한 Document 리스트를 반환합니다.
+    """
+
+    @abstractmethod
+    def rerank(self, query: str, scored_docs: list[tuple[Document, float]]) -> list[Document]:
+        ...
+
+
+class LLMReranker(Reranker):
+    """LLM에게 관련도 순서를 묻는 재정렬기 (정확하지만 LLM 왕복 1회 추가)"""
+
+    def __init__(self, llm=None):
+        self.llm = llm
+
+    def rerank(self, query: str, scored_docs: list[tuple[Document, float]]) -> list[Document]:
+        return rerank_results(query, [doc for doc, _ in scored_docs], self.llm)
+
+
+class LocalReranker(Reranker):
+    """
+    LLM 호출 없이 수 밀리초 안에 끝나는 로컬 재정렬기
+
+    쿼리-청크 코사인 유사도(인덱스의 청크 임베딩 재사용), 쿼리 키워드 겹침 비율,
+    하이브리드 결합 점수를 각각 정규화해 가중 합산합니다.
+    쿼리 임베딩은 검색 단계에서 이미 캐시되므로 추가 API 호출이 없습니다.
+    """
+
+    def __init__(self, retriever: HybridRetriever, weights: tuple = LOCAL_RERANK_WEIGHTS):
+        """
+        Args:
+            retriever: 청크 임베딩과 쿼리 임베딩을 제공하는 HybridRetriever 또는 DocumentCorpus
+            weights: (코사인 유사도, 키워드 겹침, 결합 점수) 가중치
+        """
+        self.retriever = retriever
+        self.weights = weights
+
+    @staticmethod
+    def _minmax(values: np.ndarray) -> np.ndarray:
+        span = values.max() - values.min()
+        return (values - values.min()) / span if span > 0 else np.zeros_like(values)
+
+    def rerank(self, query: str, scored_docs: list[tuple[Document, float]]) -> list[Document]:
+        if len(scored_docs) <= 1:
+            return [doc for doc, _ in scored_docs]
+
+        docs = [doc for doc, _ in scored_docs]
+        fusion = np.asarray([score for _, score in scored_docs], dtype=np.float64)
+
+        # 1. 코사인 유사도
+        cosine = np.zeros(len(docs))
+        embeddings = self.retriever.embeddings
+        if embeddings is not None:
+            try:
+                vectors = self.retriever.vectors_for_docs(docs)
+                if vectors is not None:
+                    q = np.asarray(embeddings.embed_query(query), dtype=np.float64)
+                    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(q)
+                    cosine = (vectors @ q) / np.where(norms > 0, norms, 1.0)
+            except Exception as e:
+                print(f"Local rerank embedding error: {e}")
+
+        # 2. 키워드 겹침 비율 (BM25와 같은 토큰화)
+        query_tokens = set(BM25Retriever.tokenize(query))
+        overlap = np.asarray([
+            len(query_tokens & set(BM25Retriever.tokenize(d.page_content))) / len(query_tokens)
+            if query_tokens else 0.0
+            for d in docs
+        ])
+
+        w_cos, w_overlap, w_fusion = self.weights
+        combined = (
+            w_cos * self._minmax(cosine)
+            + w_overlap * overlap
+            + w_fusion * self._minmax(fusion)
+        )
+        # 동점이면 기존 순서 유지
+        order = sorted(range(len(docs)), key=lambda i: -combined[i])
+        return [docs[i] for i in order]
+
+
+class AdaptiveRerankPolicy:
+    """
+    결합 점수 분포를 보고 재정렬이 필요한지 판단하는 정책
+
+    1위와 2위의 점수 차가 상위 후보 전체 점수 폭에서 차지하는 비율(margin)이
+    기준 이상이면 검색 결과가 확실하다고 보고 재정렬을 생략합니다.
+    비율 기반이라 minmax/zscore/rrf 어떤 결합 방식에도 같은 기준을 쓸 수 있습니다.
+    """
+
+    def __init__(self, skip_margin: float = RERANK_SKIP_MARGIN):
+        self.skip_margin = skip_margin
+        self.skipped = 0
+        self.reranked = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def margin(scored_docs: list[tuple[Document, float]]) -> float:
+        """(1위 - 2위) / (1위 - 최하위) 비율 (후보가 1개 이하면 1.0)"""
+        if len(scored_docs) <= 1:
+            return 1.0
+        scores = [score for _, score in scored_docs]
+        span = scores[0] - min(scores)
+        return (scores[0] - scores[1]) / span if span > 0 else 0.0
+
+    def should_rerank(self, scored_docs: list[tuple[Document, float]]) -> bool:
+        margin = self.margin(scored_docs)
+        decisive = margin >= self.skip_margin
+        with self._lock:
+            if decisive:
+                self.skipped += 1
+            else:
+                self.reranked += 1
+            skipped, reranked = self.skipped, self.reranked
+        logger.info(
+            "Rerank %s (margin=%.3f); skipped=%d, reranked=%d",
+            "skipped" if decisive else "applied", margin, skipped, reranked,
+        )
+        return not decisive
+
+    def stats(self) -> dict:
+        with self._lock:
+            skipped, reranked = self.skipped, self.reranked
+        total = skipped + reranked
+        return {
+            "skipped": skipped,
+            "reranked": reranked,
+            "skip_rate": skipped / total if total else 0.0,
+        }
+
+
+class GatedReranker(Reranker):
+    """정책이 필요하다고 판단할 때만 내부 재정렬기를 호출하는 래퍼"""
+
+    def __init__(self, reranker: Reranker, policy: AdaptiveRerankPolicy):
+        self.reranker = reranker
+        self.policy = policy
+
+    def rerank(self, query: str, scored_docs: list[tuple[Document, float]]) -> list[Document]:
+        if not self.policy.should_rerank(scored_docs):
+            return [doc for doc, _ in scored_docs]
+        return self.reranker.rerank(query, scored_docs)
+
+
+# 프로세스 전체에서 재정렬 생략/적용 횟수를 집계
+rerank_policy = AdaptiveRerankPolicy()
+
+
+def build_reranker(mode: str, retriever: HybridRetriever | DocumentCorpus, llm=None, gated: bool = RERANK_GATING) -> Reranker:
+    """
+    설정에 맞는 재정렬기 생성
+
+    Args:
+        mode: "local" 또는 "llm"
+        retriever: HybridRetriever 또는 DocumentCorpus 인스턴스
+        llm: LLM 재정렬에 사용할 모델
+        gated: True면 검색 결과가 확실할 때 재정렬을 생략
+
+    Returns:
+        Reranker 인스턴스
+    """
+    reranker = LLMReranker(llm) if mode == "llm" else LocalReranker(retriever)
+    if gated:
+        return GatedReranker(reranker, rerank_policy)
+    return reranker
+
+
 def add_confidence_score(response: str, context_quality: float) -> str:
     """
     LLM의 답변에 신뢰도 점수를 표기합니다.